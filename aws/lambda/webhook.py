@@ -26,6 +26,7 @@ This causes installed packages (like requests) to be imported so it has
 to be placed after the path fix above.
 """
 import handlers
+from handlers.gate import admit
 
 
 def handler(event, context):
@@ -34,19 +35,12 @@ def handler(event, context):
     endpoint. Expects the request data to be mapped to a json event
     record as defined by aws/api-gateway/request-mapping.json.
     """
-    logger.debug("AWS request context: {}".format(context))
-    my_access_token = settings.get("accessToken")
-    access_token = event.get("accessToken")
-    body = event.get("body")
-    query = event.get("query")
-    method = event.get("method")
     try:
-        if not access_token:
-            raise Exception("400 Bad Request; missing access token")
-        if access_token != my_access_token:
-            raise Exception("403 Forbidden; bad access token")
-        else:
-            return handlers.dispatch(method, query, body)
+        # shed bad requests before doing anything else, including logging
+        admit(event)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("AWS request context: {}".format(context))
+        return handlers.dispatch(event.get("method"), event.get("query"), event.get("body"))
     except Exception as e:
         logger.error("{}".format(e))
         raise
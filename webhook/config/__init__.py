@@ -1,5 +1,7 @@
+import contextlib
 import json
 import os
+import threading
 
 """
 Read in the the settings from config/settings.json.
@@ -9,3 +11,67 @@ settings = None
 current_dir = os.path.dirname(os.path.realpath(__file__))
 with open(os.path.join(current_dir, "settings.json"), "rb") as f:
     settings = json.loads(f.read())
+
+
+"""
+One deployment can serve several pages. The "pages" setting maps page ids
+to settings that override the global ones for that page, most importantly
+its own "pageToken":
+
+    "pages": {
+        "1789953497899630": {"pageToken": "...", "graphBatchSize": 20}
+    }
+
+The handlers run each event in a page_context() for the page it came from,
+and code that needs a per-page setting reads it from page_settings(). The
+settings for each page are merged once and cached. Only these are read
+per page, overriding any other key has no effect:
+
+    pageToken               the send, profile and broadcast calls
+    graphBatchSize          profiles.prefetch()
+    broadcastConcurrency    messages.broadcast()
+    broadcastRate           messages.broadcast()
+"""
+_pages = dict((str(page_id), overrides) for (page_id, overrides) in settings.get("pages", {}).items())
+_page_cache = {}
+_local = threading.local()
+
+
+def for_page(page_id):
+    """
+    Returns the settings for a page: the global settings with the page's
+    overrides applied, and "pageId" set to the page id. Pages with no
+    overrides get the global settings.
+    """
+    page_id = str(page_id)
+    merged = _page_cache.get(page_id)
+    if merged is None:
+        merged = dict(settings)
+        merged.update(_pages.get(page_id, {}))
+        merged["pageId"] = page_id
+        _page_cache[page_id] = merged
+    return merged
+
+
+def page_settings():
+    """
+    Returns the settings for the page whose event is being handled on this
+    thread, or the global settings outside of a page_context().
+    """
+    return getattr(_local, "page", None) or settings
+
+
+@contextlib.contextmanager
+def page_context(page_id):
+    """
+    Context manager that makes page_settings() return the settings for
+    page_id on this thread until the block ends. Threads started in the
+    block don't inherit it, code that starts them should pass the page id
+    along. A page_id of None selects the global settings.
+    """
+    previous = getattr(_local, "page", None)
+    _local.page = for_page(page_id) if page_id is not None else None
+    try:
+        yield
+    finally:
+        _local.page = previous
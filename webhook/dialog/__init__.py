@@ -1,18 +1,103 @@
 from config import settings
 import importlib
 import logging
+import metrics
+import threading
+import time
 
 
 logger = logging.getLogger()
 
 
-active_bot = "dialog.bots.{}".format(settings["activeBot"])
-try:
-    bot = importlib.import_module(active_bot)
-    bot.ping()
-except Exception as e:
-    logger.error("Failed to load bot: {}, error: {}".format(active_bot, e))
-    raise
+"""
+Routes each event to the bot for the page it came from. The "pageBots"
+setting maps page ids to bot names, and pages that are not listed go to the
+"activeBot" bot. Bots are the modules in dialog.bots, imported the first
+time an event for one of their pages arrives and kept loaded for the life of
+the container, so one deployment can serve many pages and bots.
+"""
+_page_bots = dict((str(page_id), name) for (page_id, name) in settings.get("pageBots", {}).items())
+_default_bot = settings.get("activeBot")
+_bots = {}
+_bots_lock = threading.Lock()
+
+
+def _load_bot(name):
+    """
+    Imports the named bot, or returns it if it is already loaded.
+    """
+    bot = _bots.get(name)
+    if bot is not None:
+        return bot
+    with _bots_lock:
+        bot = _bots.get(name)
+        if bot is None:
+            module = "dialog.bots.{}".format(name)
+            try:
+                bot = importlib.import_module(module)
+                bot.ping()
+            except Exception as e:
+                logger.error("Failed to load bot: {}, error: {}".format(module, e))
+                raise
+            _bots[name] = bot
+    return bot
+
+
+def bot_for(source):
+    """
+    Returns the bot module that handles events from source, a page id.
+    """
+    name = _page_bots.get(str(source), _default_bot)
+    if name is None:
+        raise Exception("500 Internal Server Error; no bot configured for page {}".format(source))
+    return _load_bot(name)
+
+
+def _call_bot(hook, args):
+    return getattr(bot_for(args[0]), hook)(*args)
+
+
+"""
+Every hook call runs through a chain of the middleware listed in the
+"dialogMiddleware" setting, see dialog.middleware, and then the bot. The
+chain is built once, when this module is imported. Each stage records the
+time spent in it, not counting the stages after it, in metrics as
+dialog.stage.<middleware name>, and the bot's as dialog.stage.bot.
+"""
+_stage_time = threading.local()
+
+
+def _timed_stage(name, handler):
+    metric = "dialog.stage.{}".format(name)
+
+    def timed(hook, args):
+        start = time.time()
+        # set by the next stage when it returns
+        _stage_time.inner = 0.0
+        try:
+            return handler(hook, args)
+        finally:
+            elapsed = time.time() - start
+            metrics.record(metric, elapsed - _stage_time.inner)
+            _stage_time.inner = elapsed
+    return timed
+
+
+def build_chain(names):
+    """
+    Returns a callable taking a hook name and its arguments that runs the
+    named middleware, in order, and then the bot.
+    Params:
+        names: list of module names in dialog.middleware
+    """
+    handler = _timed_stage("bot", _call_bot)
+    for name in reversed(names):
+        module = importlib.import_module("dialog.middleware.{}".format(name))
+        handler = _timed_stage(name, module.wrap(handler))
+    return handler
+
+
+_chain = build_chain(settings.get("dialogMiddleware", []))
 
 
 def user_selected(source, sender_id, time, pass_through):
@@ -29,7 +114,7 @@ def user_selected(source, sender_id, time, pass_through):
     """
     logger.debug("dialog.user_selected: source: {}, sender_id: {}, time: {}, pass_through: {}".format(
         source, sender_id, time, pass_through))
-    bot.user_selected(source, sender_id, time, pass_through)
+    _chain("user_selected", (source, sender_id, time, pass_through))
 
 
 def open(source, sender_id, time, pass_through):
@@ -46,7 +131,7 @@ def open(source, sender_id, time, pass_through):
     """
     logger.debug("dialog.open: source: {}, sender_id: {}, time: {}, pass_through: {}".format(
         source, sender_id, time, pass_through))
-    bot.open(source, sender_id, time, pass_through)
+    _chain("open", (source, sender_id, time, pass_through))
 
 
 def message_in(source, sender_id, time, message):
@@ -65,6 +150,7 @@ def message_in(source, sender_id, time, message):
                     "id" : "the-message-id",                # required
                     "seq" : the-message-sequence-number,    # optional
                     "text" : "the-text-message",            # optional
+                    "nlu": {"intent": ..., "confidence": ...},  # optional, see nlu
                     "attachments": [                        # optional
                         {
                             "type": "image/video/audio",
@@ -75,7 +161,7 @@ def message_in(source, sender_id, time, message):
     """
     logger.debug("dialog.message_in: source: {}, sender_id: {}, time: {}, message: {}".format(
         source, sender_id, time, message))
-    bot.message_in(source, sender_id, time, message)
+    _chain("message_in", (source, sender_id, time, message))
 
 
 def message_seen(source, message_ids, message_seq, watermark, time):
@@ -94,4 +180,4 @@ def message_seen(source, message_ids, message_seq, watermark, time):
     """
     logger.debug("dialog.message_seen: source: {}, message_ids: {}, message_seq: {}, watermark: {}, time: {}".format(
         source, message_ids, message_seq, watermark, time))
-    bot.message_seen(source, message_ids, message_seq, watermark, time)
\ No newline at end of file
+    _chain("message_seen", (source, message_ids, message_seq, watermark, time))
\ No newline at end of file
@@ -0,0 +1,19 @@
+"""
+Middleware that runs around the dialog hooks before an event reaches the
+bot. Each middleware is a module in this package with a wrap() function:
+
+    def wrap(next):
+        def handle(hook, args):
+            ...
+            return next(hook, args)
+        return handle
+
+hook is the name of the dialog hook, "user_selected", "open", "message_in"
+or "message_seen", and args is the tuple of arguments it was called with,
+starting with the source page id. A middleware can change the arguments,
+do work before or after calling next, or drop the event by returning
+without calling it.
+
+The "dialogMiddleware" setting lists the middleware to run, in order, by
+module name. See dialog.build_chain().
+"""
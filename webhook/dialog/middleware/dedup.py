@@ -0,0 +1,30 @@
+from config import settings
+import metrics
+from platform.cache import LRUCache
+
+
+"""
+Drops messages that have already been handled. Facebook resends a
+callback that it thinks has failed, so the same message can arrive twice.
+Message ids are remembered once the message has been handled without an
+error, for "dedupTtl" seconds, up to "dedupCacheSize"
+of them, in this container only. Dropped messages are counted in metrics
+as dialog.dedup.dropped.
+"""
+_seen = LRUCache(settings.get("dedupCacheSize", 10000), ttl=settings.get("dedupTtl", 600))
+
+
+def wrap(next):
+    def dedup(hook, args):
+        if hook == "message_in":
+            key = (str(args[0]), args[3]["id"])
+            if _seen.get(key) is not None:
+                metrics.incr("dialog.dedup.dropped")
+                return
+            result = next(hook, args)
+            # only once handled, so a message the bot failed on is handled
+            # when Facebook resends it
+            _seen.put(key, True)
+            return result
+        return next(hook, args)
+    return dedup
@@ -0,0 +1,38 @@
+from config import settings
+import metrics
+from platform.cache import LRUCache
+import threading
+import time
+
+
+"""
+Drops events from users who send more than "rateLimitEvents" events in
+"rateLimitWindow" seconds, counted per page and user in this container.
+The window starts with a user's first event in it. Delivery receipts are
+not counted. Dropped events are counted in metrics as
+dialog.ratelimit.dropped.
+"""
+_limit = settings.get("rateLimitEvents", 30)
+_window = settings.get("rateLimitWindow", 60)
+# (page, user) -> (window start, events in the window)
+_counts = LRUCache(settings.get("rateLimitUsers", 10000), ttl=_window)
+_lock = threading.Lock()
+
+
+def wrap(next):
+    def ratelimit(hook, args):
+        if hook != "message_seen":
+            key = (str(args[0]), str(args[1]))
+            now = time.time()
+            with _lock:
+                window = _counts.get(key)
+                if window is None or now - window[0] >= _window:
+                    window = (now, 1)
+                else:
+                    window = (window[0], window[1] + 1)
+                _counts.put(key, window)
+            if window[1] > _limit:
+                metrics.incr("dialog.ratelimit.dropped")
+                return
+        return next(hook, args)
+    return ratelimit
@@ -1,7 +1,11 @@
-from config import settings
+from config import page_context, settings
 import dialog
 import logging
-from validation import validate_postback
+import metrics
+import nlu
+from platform import profiles, sessions
+from platform.validation import log_warning_summary_if_due
+from validation import check_postback
 
 
 logger = logging.getLogger()
@@ -44,6 +48,7 @@ def message_received(page_id, time, envelope):
         "id": envelope["message"]["mid"],
         "seq": envelope["message"]["seq"],
         "text": envelope["message"].get("text"),
+        "nlu": envelope["message"].get("nlu"),
         "attachments": []
     }
     attachments = envelope["message"].get("attachments")
@@ -68,27 +73,82 @@ def message_delivered(page_id, time, receipt):
     dialog.message_seen(page_id, receipt["delivery"]["mids"], receipt["delivery"]["seq"], receipt["delivery"]["watermark"], time)
 
 
+def prefetch_profiles(body):
+    """
+    Loads the profiles of all the distinct senders in a callback into the
+    profile cache with as few graph API calls as possible, so that bots
+    calling profiles.get() while the callback is dispatched hit the cache.
+    Failures are logged and otherwise ignored, the bots will fetch what
+    they need themselves. Timed in metrics as handlers.prefetch_profiles.
+    """
+    with metrics.timed("handlers.prefetch_profiles"):
+        # user ids are page-scoped, so each page's are fetched with its token
+        sender_ids = {}
+        for entry in body["entry"]:
+            for envelope in entry["messaging"]:
+                sender_ids.setdefault(entry["id"], set()).add(envelope["sender"]["id"])
+        for (page_id, ids) in sender_ids.items():
+            try:
+                with page_context(page_id):
+                    profiles.prefetch(ids)
+            except Exception as e:
+                logger.error("Profile prefetch for page {} failed: {}".format(page_id, e))
+
+
+def parse_messages(body):
+    """
+    Finds the intents of the text of all the messages in a callback with a
+    single call to the NLU backend, so that backends that score a batch at
+    once do, and adds each result to its message as $.message.nlu, see nlu.
+    Failures are logged and otherwise ignored, leaving the messages without
+    results. Timed in metrics as handlers.parse_messages.
+    """
+    with metrics.timed("handlers.parse_messages"):
+        messages = [envelope["message"] for entry in body["entry"] for envelope in entry["messaging"]
+            if envelope.get("message", {}).get("text")]
+        if not messages:
+            return
+        try:
+            results = nlu.parse_batch([message["text"] for message in messages])
+        except Exception as e:
+            logger.error("NLU parse failed: {}".format(e))
+            return
+        for (message, result) in zip(messages, results):
+            message["nlu"] = result
+
+
 def dispatch_postback(body):
     """
     Recieves a postback event and walks the entry and messaging lists
-    passing the data to the proper handlers.
+    passing the data to the proper handlers. If the "prefetchProfiles"
+    setting is true the profiles of all the senders are loaded first, and
+    if the "nluBackend" setting is not "none" the intents of all the
+    message texts are found. Each entry is handled in the page context of
+    its page, see config.
     """
-    validate_postback(body)
+    check_postback(body)
+
+    if settings.get("prefetchProfiles"):
+        prefetch_profiles(body)
+
+    if settings.get("nluBackend", "none") != "none":
+        parse_messages(body)
 
     entries = body["entry"]
     for entry in entries:
         page_id = entry["id"]
         time = entry["time"]
         messages = entry["messaging"]
-        for envelope in messages:
-            if "optin" in envelope:
-                return auth_received(page_id, time, envelope)
-            elif "message" in envelope:
-                return message_received(page_id, time, envelope)
-            elif "delivery" in envelope:
-                return message_delivered(page_id, time, envelope)
-            else:
-                return postback_received(page_id, time, envelope)
+        with page_context(page_id):
+            for envelope in messages:
+                if "optin" in envelope:
+                    auth_received(page_id, time, envelope)
+                elif "message" in envelope:
+                    message_received(page_id, time, envelope)
+                elif "delivery" in envelope:
+                    message_delivered(page_id, time, envelope)
+                else:
+                    postback_received(page_id, time, envelope)
 
 
 def verify_webhook(query):
@@ -122,12 +182,20 @@ def verify_webhook(query):
 def dispatch(method, query, body):
     """
     Receives all events from the webhook entrypoint and figures out which
-    handler method to call.
+    handler method to call. Session changes made while handling a callback
+    are written back in one batch when it has been handled, see
+    platform.sessions.unit_of_work(), and then any message length warnings
+    are logged if their summary is due, see platform.validation.
     """
-    logger.debug("{} method received; query={}, body={}".format(method, query, body))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("{} method received; query={}, body={}".format(method, query, body))
     if method == "GET":
         return verify_webhook(query)
     elif method == "POST":
-        return dispatch_postback(body)
+        try:
+            with sessions.unit_of_work():
+                return dispatch_postback(body)
+        finally:
+            log_warning_summary_if_due()
     else:
         raise Exception("400 Bad Request; unhandled method {}".format(method))
@@ -0,0 +1,106 @@
+from config import settings
+import base64
+import hashlib
+import hmac
+import metrics
+
+
+"""
+The front door. admit() runs before any other work on an event and sheds
+bad or abusive requests with a handful of cheap checks, in this order:
+
+    - the access token, compared in constant time
+    - the method
+    - for POST, the raw body size, against "maxBodyBytes"
+    - for POST, the X-Hub-Signature HMAC of the raw body, if "appSecret" is set
+    - for POST, object == "page" and the number of entries and messaging
+      items, against "maxEntries" and "maxMessaging"
+
+The raw body is passed base64 encoded in event["rawBody"] by the API gateway
+request mapping. Rejections are counted in metrics as gate.rejected.<reason>.
+"""
+
+
+def _reject(reason, message):
+    metrics.incr("gate.rejected.{}".format(reason))
+    raise Exception(message)
+
+
+def _matches(expected, actual):
+    if isinstance(expected, unicode):
+        expected = expected.encode("utf-8")
+    if isinstance(actual, unicode):
+        actual = actual.encode("utf-8")
+    return hmac.compare_digest(expected, actual)
+
+
+def _header(event, name):
+    """
+    Returns the value of the named request header, ignoring case.
+    """
+    headers = event.get("headers") or {}
+    name = name.lower()
+    for (k, v) in headers.iteritems():
+        if k.lower() == name:
+            return v
+
+
+def _check_signature(event, raw_body):
+    app_secret = settings.get("appSecret")
+    if not app_secret:
+        return
+    signature = _header(event, "X-Hub-Signature")
+    if not signature or not signature.startswith("sha1="):
+        _reject("signature", "403 Forbidden; missing request signature")
+    if raw_body is None:
+        _reject("signature", "403 Forbidden; request body not available to verify signature")
+    if isinstance(app_secret, unicode):
+        app_secret = app_secret.encode("utf-8")
+    expected = hmac.new(app_secret, raw_body, hashlib.sha1).hexdigest()
+    if not _matches(expected, signature[5:]):
+        _reject("signature", "403 Forbidden; bad request signature")
+
+
+def _check_shape(body):
+    if not isinstance(body, dict) or body.get("object") != "page":
+        _reject("object", "400 Bad Request; bad value: $.object must be set to 'page'")
+    entries = body.get("entry")
+    if not isinstance(entries, list):
+        return
+    if len(entries) > settings.get("maxEntries", 100):
+        _reject("entries", "400 Bad Request; too many entries: {}".format(len(entries)))
+    max_messaging = settings.get("maxMessaging", 100)
+    for entry in entries:
+        messaging = entry.get("messaging") if isinstance(entry, dict) else None
+        if isinstance(messaging, list) and len(messaging) > max_messaging:
+            _reject("messaging", "400 Bad Request; too many messaging items: {}".format(len(messaging)))
+
+
+def admit(event):
+    """
+    Raises an exception if the event should be rejected without further
+    processing. See above for the checks.
+    Params:
+        event: the event record built by the API gateway request mapping
+    """
+    access_token = event.get("accessToken")
+    if not access_token:
+        _reject("token", "400 Bad Request; missing access token")
+    if not _matches(settings.get("accessToken") or "", access_token):
+        _reject("token", "403 Forbidden; bad access token")
+
+    method = event.get("method")
+    if method == "GET":
+        return
+    if method != "POST":
+        _reject("method", "400 Bad Request; unhandled method {}".format(method))
+
+    raw_body = event.get("rawBody")
+    if raw_body is not None:
+        max_bytes = settings.get("maxBodyBytes", 262144)
+        # base64 is 4 chars per 3 bytes, reject before decoding if we can
+        if len(raw_body) > (max_bytes + 2) // 3 * 4:
+            _reject("size", "400 Bad Request; body exceeds {} bytes".format(max_bytes))
+        raw_body = base64.b64decode(raw_body)
+    _check_signature(event, raw_body)
+    _check_shape(event.get("body"))
@@ -1,3 +1,8 @@
+from config import settings
+import metrics
+import random
+
+
 def _raise_error(message):
     raise Exception("400 Bad Request; {}".format(message))
 
@@ -14,82 +19,293 @@ def _raise_empty_value(property_path):
     _raise_bad_value(property_path, "cannot be 'None' or empty.")
 
 
-def validate_auth_postback(auth):
-    if not auth:
-        _raise_missing_property("$.entry[].messaging[].optin")
-    s = auth.get("ref")
-    if not s:
-        _raise_missing_property("$.entry[].messaging[].optin.ref")
-
-
-def validate_attachment(attachment):
-    if not attachment:
-        _raise_missing_property("$.entry[].messaging[].message.attachment[]")
-    s = attachment.get("type")
-    if not s in ["image", "video", "audio"]:
-        _raise_bad_value("$.entry[].messaging[].message.attachment[].type",
-            "must be one of 'image', 'video' or 'audio'")
-    if not "payload" in attachment:
-        _raise_missing_property("$.entry[].messaging[].message.attachment[].payload")
-    s = attachment["payload"].get("url")
-    if not s:
-        _raise_missing_property("$.entry[].messaging[].message.attachment[].payload.url")
-
-
-def validate_message_postback(message):
-    if not message:
-        _raise_missing_property("$.entry[].messaging[].message")
-    s = message.get("mid")
-    if not s:
-        _raise_missing_property("$.entry[].messaging[].message.mid")
-
-    s = message.get("seq")
-    if not s:
-        _raise_missing_property("$.entry[].messaging[].message.seq")
-
-    if "text" in message:
-        s = message.get("text")
-        if not s:
-            _raise_missing_property("$.entry[].messaging[].message.text")
-    elif "attachments" in message:
-        if not len(message["attachments"]):
-            _raise_empty_value("$.entry[].messaging[].message.attachments")
-        for attachment in message["attachments"]:
-            validate_attachment(attachment)
-    else:
-        _raise_missing_property("$.entry[].messaging[].message must have one of: text, attachments")
+"""
+The callback schema. A node is a tuple of checks that are applied in order to
+one object, and each check is a tuple whose first item names its kind:
+
+    ("exists",)                     the object must not be None or empty
+    ("nonempty",)                   the object must have a length
+    ("present", key)                key must be in the object
+    ("truthy", key)                 object.get(key) must not be None or empty
+    ("among", key, values, desc)    object.get(key) must be one of values
+    ("child", key, node)            apply node to object[key]
+    ("items", path, node)           apply node to each item in the object,
+                                    reporting errors at path, which defaults
+                                    to the object's path followed by "[]"
+    ("oneof", cases, otherwise)     apply the node paired with the first key
+                                    in cases that is in the object to its
+                                    value, or report otherwise, which is one
+                                    of ("missing", path) or ("bad", path, desc)
+    ("envelope", desc)              apply the checks for the first envelope
+                                    type found in the object
+
+Property paths are derived from the keys unless given explicitly.
+"""
+_optin_schema = (
+    ("exists",),
+    ("truthy", "ref")
+)
+
+_attachment_schema = (
+    ("exists",),
+    ("among", "type", ("image", "video", "audio"), "must be one of 'image', 'video' or 'audio'"),
+    ("present", "payload"),
+    ("child", "payload", (
+        ("truthy", "url"),
+    ))
+)
+
+_message_schema = (
+    ("exists",),
+    ("truthy", "mid"),
+    ("truthy", "seq"),
+    ("oneof", (
+        ("text", (
+            ("exists",),
+        )),
+        ("attachments", (
+            ("nonempty",),
+            ("items", "$.entry[].messaging[].message.attachment[]", _attachment_schema)
+        ))
+    ), ("missing", "$.entry[].messaging[].message must have one of: text, attachments"))
+)
+
+_delivery_schema = (
+    ("exists",),
+    ("truthy", "watermark"),
+    ("truthy", "seq"),
+    ("present", "mids"),
+    ("child", "mids", (
+        ("nonempty",),
+        # TBD validate the actual mid format. Example:
+        # mid.1461992777559:e8027b338d2b553b73
+        ("items", None, (
+            ("exists",),
+        ))
+    ))
+)
+
+_postback_schema = (
+    ("exists",),
+    ("truthy", "payload")
+)
+
+"""
+The envelope types, in the order they are tested for, and the checks for
+each. A validator function is generated for every type.
+"""
+_envelope_types = (
+    ("optin", (
+        ("truthy", "timestamp"),
+        ("child", "optin", _optin_schema)
+    )),
+    ("message", (
+        ("truthy", "timestamp"),
+        ("child", "message", _message_schema)
+    )),
+    ("delivery", (
+        ("child", "delivery", _delivery_schema),
+    )),
+    ("postback", (
+        ("truthy", "timestamp"),
+        ("child", "postback", _postback_schema)
+    ))
+)
+
+_callback_schema = (
+    ("among", "object", ("page",), "must be set to 'page'"),
+    ("present", "entry"),
+    ("child", "entry", (
+        ("nonempty",),
+        ("items", None, (
+            ("truthy", "id"),
+            ("truthy", "time"),
+            ("present", "messaging"),
+            ("child", "messaging", (
+                ("nonempty",),
+                ("items", None, (
+                    ("present", "sender"),
+                    ("child", "sender", (
+                        ("truthy", "id"),
+                    )),
+                    ("present", "recipient"),
+                    ("child", "recipient", (
+                        ("truthy", "id"),
+                    )),
+                    ("envelope", "must contain one of 'optin', 'message', 'delivery' or 'postback'")
+                ))
+            ))
+        ))
+    ))
+)
+
+
+class _Generator(object):
+    """
+    Generates the Python source of a validator function from a schema node,
+    with every check, loop and branch inlined and property paths emitted as
+    literals. Values looked up once are kept in local variables and reused
+    by the checks that follow them in the same branch.
+    """
+    def __init__(self, name, argument):
+        self.lines = ["def {}({}):".format(name, argument)]
+        self.names = 0
+        # (object variable, key) -> variable holding its value, for the
+        # properties already looked up in the branch being emitted
+        self.bound = {}
+
+    def variable(self):
+        self.names += 1
+        return "_v{}".format(self.names)
+
+    def emit(self, indent, line):
+        self.lines.append("{}{}".format("    " * indent, line))
+
+    def lookup(self, var, key, indent, get=False):
+        """
+        Returns the variable holding var[key] (or var.get(key) if get is
+        True), emitting the lookup if it has not been done in this branch.
+        """
+        value = self.bound.get((var, key))
+        if value is None:
+            value = self.variable()
+            if get:
+                # same as var.get(key) for a dict, without the method call
+                self.emit(indent, "{0} = {1}[{2!r}] if {2!r} in {1} else None".format(value, var, key))
+            else:
+                self.emit(indent, "{} = {}[{!r}]".format(value, var, key))
+            self.bound[(var, key)] = value
+        return value
+
+    def branch(self, node, var, path, indent):
+        """
+        Emits node as the body of a branch. Values looked up inside the
+        branch are not visible to the code that follows it.
+        """
+        bound = dict(self.bound)
+        self.node(node, var, path, indent)
+        self.emit(indent, "pass")
+        self.bound = bound
+
+    def node(self, node, var, path, indent):
+        for check in node:
+            self.check(check, var, path, indent)
+
+    def otherwise(self, otherwise, indent):
+        if otherwise[0] == "missing":
+            self.emit(indent, "_raise_missing_property({!r})".format(otherwise[1]))
+        else:
+            self.emit(indent, "_raise_bad_value({!r}, {!r})".format(otherwise[1], otherwise[2]))
+
+    def check(self, check, var, path, indent):
+        kind = check[0]
+        emit = self.emit
+
+        if kind == "exists":
+            emit(indent, "if not {}:".format(var))
+            emit(indent + 1, "_raise_missing_property({!r})".format(path))
+
+        elif kind == "nonempty":
+            emit(indent, "if not len({}):".format(var))
+            emit(indent + 1, "_raise_empty_value({!r})".format(path))
+
+        elif kind == "present":
+            emit(indent, "if not {!r} in {}:".format(check[1], var))
+            emit(indent + 1, "_raise_missing_property({!r})".format("{}.{}".format(path, check[1])))
+
+        elif kind == "truthy":
+            value = self.lookup(var, check[1], indent, get=True)
+            emit(indent, "if not {}:".format(value))
+            emit(indent + 1, "_raise_missing_property({!r})".format("{}.{}".format(path, check[1])))
+
+        elif kind == "among":
+            key, values, description = check[1:]
+            value = self.lookup(var, key, indent, get=True)
+            emit(indent, "if not {} in {!r}:".format(value, values))
+            emit(indent + 1, "_raise_bad_value({!r}, {!r})".format("{}.{}".format(path, key), description))
+
+        elif kind == "child":
+            key, node = check[1:]
+            self.node(node, self.lookup(var, key, indent), "{}.{}".format(path, key), indent)
+
+        elif kind == "items":
+            item_path, node = check[1:]
+            item = self.variable()
+            emit(indent, "for {} in {}:".format(item, var))
+            self.branch(node, item, item_path or "{}[]".format(path), indent + 1)
+
+        elif kind == "oneof":
+            cases, otherwise = check[1:]
+            for (n, (key, node)) in enumerate(cases):
+                emit(indent, "{} {!r} in {}:".format("elif" if n else "if", key, var))
+                bound = dict(self.bound)
+                self.node(node, self.lookup(var, key, indent + 1), "{}.{}".format(path, key), indent + 1)
+                self.bound = bound
+            emit(indent, "else:")
+            self.otherwise(otherwise, indent + 1)
+
+        elif kind == "envelope":
+            for (n, (envelope_type, node)) in enumerate(_envelope_types):
+                emit(indent, "{} {!r} in {}:".format("elif" if n else "if", envelope_type, var))
+                self.branch(node, var, path, indent + 1)
+            emit(indent, "else:")
+            self.otherwise(("bad", path, check[1]), indent + 1)
+
+        else:
+            raise Exception("Unknown schema check: {}".format(kind))
+
+    def source(self, node, var, path):
+        self.node(node, var, path, 1)
+        self.emit(1, "pass")
+        return "\n".join(self.lines)
+
+
+"""
+The source generated for each validator, by function name. Useful when
+debugging the schema.
+"""
+generated_source = {}
+
+
+def _generate(name, node, path):
+    """
+    Generates, compiles and returns a validator function named name that
+    applies node to its argument at the given property path.
+    """
+    source = _Generator(name, "data").source(node, "data", path)
+    generated_source[name] = source
+    exec(compile(source, "<{}>".format(name), "exec"), _generated)
+    return _generated[name]
 
 
-def validate_delivery_postback(delivery):
-    if not delivery:
-        _raise_missing_property("$.entry[].messaging[].delivery")
-    n = delivery.get("watermark")
-    if not n:
-        _raise_missing_property("$.entry[].messaging[].delivery.watermark")
+"""
+Generated validators are compiled into this namespace so that they can
+call the error helpers and each other.
+"""
+_generated = {
+    "_raise_missing_property": _raise_missing_property,
+    "_raise_bad_value": _raise_bad_value,
+    "_raise_empty_value": _raise_empty_value
+}
 
-    n = delivery.get("seq")
-    if not n:
-        _raise_missing_property("$.entry[].messaging[].delivery.seq")
 
-    if not "mids" in delivery:
-        _raise_missing_property("$.entry[].messaging[].delivery.mids")
+"""
+One validator per envelope type, applied to a $.entry[].messaging[] item
+that is known to be of that type.
+"""
+envelope_validators = dict(
+    (envelope_type, _generate("_validate_{}_envelope".format(envelope_type), node, "$.entry[].messaging[]"))
+    for (envelope_type, node) in _envelope_types)
 
-    if not len(delivery["mids"]):
-        _raise_empty_value("$.entry[].messaging[].delivery.mids")
 
-    for mid in delivery["mids"]:
-        if not mid:
-            # TBD validate the actual mid format. Example:
-            # mid.1461992777559:e8027b338d2b553b73
-            _raise_missing_property("$.entry[].messaging[].delivery.mids[]")
+validate_auth_postback = _generate("validate_auth_postback", _optin_schema, "$.entry[].messaging[].optin")
+validate_attachment = _generate("validate_attachment", _attachment_schema, "$.entry[].messaging[].message.attachment[]")
+validate_message_postback = _generate("validate_message_postback", _message_schema, "$.entry[].messaging[].message")
+validate_delivery_postback = _generate("validate_delivery_postback", _delivery_schema, "$.entry[].messaging[].delivery")
+validate_user_postback = _generate("validate_user_postback", _postback_schema, "$.entry[].messaging[].postback")
 
 
-def validate_user_postback(postback):
-    if not postback:
-        _raise_missing_property("$.entry[].messaging[].postback")
-    s = postback.get("payload")
-    if not s:
-        _raise_missing_property("$.entry[].messaging[].postback.payload")
+_validate_postback = _generate("_validate_postback", _callback_schema, "$")
 
 
 def validate_postback(data):
@@ -97,64 +313,110 @@ def validate_postback(data):
     Validates that the data received from facebook in a postback
     is complete and well-formed.
     """
-    s = data.get("object")
-    if not s in ["page"]:
-        _raise_bad_value("$.object", "must be set to 'page'")
+    _validate_postback(data)
 
-    if not "entry" in data:
-        _raise_missing_property("$.entry")
 
-    if not len(data["entry"]):
-        _raise_empty_value("$.entry")
+"""
+The validation policy, set by the "validationMode" setting:
 
-    for entry in data["entry"]:
-        n = entry.get("id")
-        if not n:
-            _raise_missing_property("$.entry[].id")
+    strict      every callback is fully validated (the default)
+    sampled     "validationSamplePercent" percent of callbacks are fully
+                validated, the rest only get a cheap structural check
+    trusted     callbacks come from facebook, not from our own templates, so
+                they are fully validated as in "strict"
 
-        n = entry.get("time")
-        if not n:
-            _raise_missing_property("$.entry[].time")
+Counters named validation.inbound.<mode>.<full|structural|violations> are
+kept in metrics.
+"""
+_validation_modes = ("strict", "sampled", "trusted")
+_validation_mode = None
+_sample_rate = None
 
-        if not "messaging" in entry:
-            _raise_missing_property("$.entry[].messaging")
 
-        if not len(entry["messaging"]):
-            _raise_empty_value("$.entry[].messaging")
+def set_validation_mode(mode, sample_percent=None):
+    """
+    Changes the validation policy for inbound callbacks.
+    Params:
+        mode: one of "strict", "sampled" or "trusted"
+        sample_percent: optional, percentage of callbacks fully validated in
+            "sampled" mode, defaults to the "validationSamplePercent" setting
+    """
+    global _validation_mode, _sample_rate
+    if not mode in _validation_modes:
+        raise Exception("Unknown validation mode: {}; must be one of {}".format(mode, ", ".join(_validation_modes)))
+    if sample_percent is None:
+        sample_percent = settings.get("validationSamplePercent", 10)
+    _validation_mode = mode
+    _sample_rate = sample_percent / 100.0
 
-        for envelope in entry["messaging"]:
-            if not "sender" in envelope:
-                _raise_missing_property("$.entry[].messaging[].sender")
 
-            n = envelope["sender"].get("id")
-            if not n:
-                _raise_missing_property("$.entry[].messaging[].sender.id")
+set_validation_mode(settings.get("validationMode", "strict"))
 
-            if not "recipient" in envelope:
-                _raise_missing_property("$.entry[].messaging[].recipient")
-
-            n = envelope["recipient"].get("id")
-            if not n:
-                _raise_missing_property("$.entry[].messaging[].recipient.id")
-
-            if "optin" in envelope:
-                n = envelope.get("timestamp")
-                if not n:
-                    _raise_missing_property("$.entry[].messaging[].timestamp")
-                validate_auth_postback(envelope["optin"])
-            elif "message" in envelope:
-                n = envelope.get("timestamp")
-                if not n:
-                    _raise_missing_property("$.entry[].messaging[].timestamp")
-                validate_message_postback(envelope["message"])
-            elif "delivery" in envelope:
-                validate_delivery_postback(envelope["delivery"])
-            elif "postback" in envelope:
-                n = envelope.get("timestamp")
-                if not n:
-                    _raise_missing_property("$.entry[].messaging[].timestamp")
-                validate_user_postback(envelope["postback"])
-            else:
-                _raise_bad_value("$.entry[].messaging[]",
-                    "must contain one of 'optin', 'message', 'delivery' or 'postback'")
 
+"""
+The keys the handlers read from each envelope type, in the order the
+handlers test for the types.
+"""
+_handled_keys = (
+    ("optin", ("ref",)),
+    ("message", ("mid", "seq")),
+    ("delivery", ("mids", "seq", "watermark")),
+    ("postback", ("payload",))
+)
+
+
+def _check_structure(data):
+    """
+    The cheap check used for unsampled callbacks in "sampled" mode. Verifies
+    that everything the handlers read is present, but not its values.
+    """
+    if data.get("object") != "page":
+        _raise_bad_value("$.object", "must be set to 'page'")
+    entries = data.get("entry")
+    if not entries:
+        _raise_missing_property("$.entry")
+    for entry in entries:
+        for key in ("id", "time"):
+            if key not in entry:
+                _raise_missing_property("$.entry[].{}".format(key))
+        if not entry.get("messaging"):
+            _raise_missing_property("$.entry[].messaging")
+        for envelope in entry["messaging"]:
+            sender = envelope.get("sender")
+            if not isinstance(sender, dict) or "id" not in sender:
+                _raise_missing_property("$.entry[].messaging[].sender.id")
+            for (kind, keys) in _handled_keys:
+                if kind in envelope:
+                    break
+            else:
+                _raise_bad_value("$.entry[].messaging[]", "must contain one of 'optin', 'message', 'delivery' or 'postback'")
+            content = envelope[kind]
+            if not isinstance(content, dict):
+                _raise_empty_value("$.entry[].messaging[].{}".format(kind))
+            for key in keys:
+                if key not in content:
+                    _raise_missing_property("$.entry[].messaging[].{}.{}".format(kind, key))
+            if kind == "message":
+                for attachment in content.get("attachments") or []:
+                    if not isinstance(attachment, dict) or "type" not in attachment:
+                        _raise_missing_property("$.entry[].messaging[].message.attachment[].type")
+                    if not isinstance(attachment.get("payload"), dict) or "url" not in attachment["payload"]:
+                        _raise_missing_property("$.entry[].messaging[].message.attachment[].payload.url")
+
+
+def check_postback(data):
+    """
+    Validates a callback according to the validation policy, and raises an
+    exception describing the first problem found if it is not valid.
+    """
+    mode = _validation_mode
+    if mode == "sampled" and random.random() >= _sample_rate:
+        check, validate = "structural", _check_structure
+    else:
+        check, validate = "full", _validate_postback
+    metrics.incr("validation.inbound.{}.{}".format(mode, check))
+    try:
+        validate(data)
+    except Exception:
+        metrics.incr("validation.inbound.{}.violations".format(mode))
+        raise
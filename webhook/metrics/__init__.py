@@ -0,0 +1,94 @@
+import contextlib
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger()
+
+
+"""
+In-process counters and timings. Everything is kept in memory for the life
+of the container and can be read with snapshot(), logged with log(), and
+cleared with reset().
+"""
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+
+
+def incr(name, count=1):
+    """
+    Adds count to the named counter.
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + count
+
+
+def record(name, seconds):
+    """
+    Records one duration, in seconds, for the named timing.
+    """
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            _timings[name] = [1, seconds, seconds]
+        else:
+            timing[0] += 1
+            timing[1] += seconds
+            if seconds > timing[2]:
+                timing[2] = seconds
+
+
+@contextlib.contextmanager
+def timed(name):
+    """
+    Context manager that records the time spent in its block for the named
+    timing, whether or not the block raises.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - start)
+
+
+def counter(name):
+    """
+    Returns the current value of the named counter.
+    """
+    return _counters.get(name, 0)
+
+
+def snapshot(prefix=""):
+    """
+    Returns a dictionary of the counters and timings whose names start with
+    prefix. Timings are reported as count, total and max seconds, and the
+    mean in milliseconds.
+    """
+    with _lock:
+        counters = dict((k, v) for (k, v) in _counters.items() if k.startswith(prefix))
+        timings = dict((k, {
+            "count": v[0],
+            "total": v[1],
+            "max": v[2],
+            "mean_ms": v[1] * 1000.0 / v[0]
+        }) for (k, v) in _timings.items() if k.startswith(prefix))
+    return {"counters": counters, "timings": timings}
+
+
+def log(prefix=""):
+    """
+    Writes the current counters and timings to the log at info level.
+    """
+    logger.info("metrics: {}".format(snapshot(prefix)))
+
+
+def reset(prefix=""):
+    """
+    Clears the counters and timings whose names start with prefix.
+    """
+    with _lock:
+        for table in (_counters, _timings):
+            for k in [k for k in table if k.startswith(prefix)]:
+                del table[k]
@@ -0,0 +1,204 @@
+from config import settings
+import collections
+import importlib
+import logging
+import metrics
+import os
+from platform.cache import LRUCache
+import re
+import unicodedata
+
+
+logger = logging.getLogger()
+
+
+"""
+Natural language understanding for bots: turns the text of a message into
+an intent. The work is done by a backend, chosen by the "nluBackend"
+setting:
+
+    - "keywords", a local phrase to intent table, see nlu.keywords
+    - "classifier", a local hashed n-gram classifier, see nlu.classifier
+    - "wit", the remote wit.ai service, see nlu.wit
+    - "none", the default, which finds no intents
+
+Any other Backend can be plugged in with set_backend(). Bots call parse()
+with the text of a message, and get back a dictionary:
+
+    {
+        "intent": the name of the best intent, or None,
+        "confidence": 0.0 to 1.0,
+        "matches": list of backend specific details, may be empty
+    }
+
+Many messages are short phrases that users send again and again, so
+results are cached in process, keyed by the backend's model version and the
+normalized text. Texts that normalize the same share a result. The cache
+holds up to "nluCacheSize" results for "nluCacheTtl" seconds, and only
+caches texts of up to "nluCacheMaxLength" characters once normalized, since
+longer ones rarely repeat. A size of 0 turns it off. Changing the backend to
+one with another model version empties the cache, and invalidate() empties
+it when a remote model changes without its version. Lookups are counted in
+metrics as nlu.cache.hits and nlu.cache.misses.
+"""
+
+
+class Backend(object):
+    """
+    The interface for NLU backends. version names the backend's model,
+    and changes whenever what it returns for a text can change.
+    """
+    version = None
+
+    def parse(self, text):
+        """
+        Returns the result for one text, see above.
+        """
+        raise NotImplementedError()
+
+    def parse_batch(self, texts):
+        """
+        Returns the results for a list of texts, in the same order. Backends
+        that can score several texts at once more cheaply override this.
+        """
+        return [self.parse(text) for text in texts]
+
+
+class NoBackend(Backend):
+    """
+    Finds no intents.
+    """
+    version = "none"
+
+    def parse(self, text):
+        return result(None, 0.0)
+
+
+def result(intent, confidence, matches=None):
+    """
+    Returns a result dictionary, see above.
+    """
+    return {"intent": intent, "confidence": confidence, "matches": matches or []}
+
+
+_separators = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize(text):
+    """
+    Returns text folded to lower case, with accents removed and everything
+    but letters and digits collapsed to single spaces, so that equivalent
+    phrasings compare equal.
+    """
+    if not isinstance(text, type(u"")):
+        text = text.decode("utf-8")
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = u"".join(c for c in text if not unicodedata.combining(c))
+    return _separators.sub(u" ", text).strip()
+
+
+def resolve_path(path):
+    """
+    Returns path, a model or data file named in the settings, made absolute
+    relative to the webhook directory.
+    """
+    if os.path.isabs(path):
+        return path
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), path)
+
+
+_backend = None
+_cache_size = settings.get("nluCacheSize", 10000)
+_cache_max_length = settings.get("nluCacheMaxLength", 100)
+_cache = LRUCache(_cache_size, ttl=settings.get("nluCacheTtl", 86400))
+
+
+def set_backend(backend):
+    """
+    Replaces the NLU backend with backend, a Backend. Cached results are
+    dropped if its model version is not the same as the old backend's.
+    """
+    global _backend
+    if getattr(_backend, "version", None) != getattr(backend, "version", None):
+        invalidate()
+    _backend = backend
+
+
+def get_backend():
+    """
+    Returns the NLU backend, creating it from the settings on first use.
+    """
+    if _backend is None:
+        name = settings.get("nluBackend", "none")
+        if name == "none":
+            set_backend(NoBackend())
+        else:
+            set_backend(importlib.import_module("nlu.{}".format(name)).from_settings())
+    return _backend
+
+
+def _cache_key(backend, text):
+    """
+    Returns the cache key for the result of text, or None if it should not
+    be cached.
+    """
+    if not _cache_size:
+        return None
+    text = normalize(text)
+    if len(text) > _cache_max_length:
+        return None
+    return (backend.version, text)
+
+
+def parse(text):
+    """
+    Returns the intent of a text, see above.
+    """
+    return parse_batch([text])[0]
+
+
+def parse_batch(texts):
+    """
+    Returns the intents of a list of texts, in the same order. Cached results
+    are returned as copies, and the texts that miss are parsed in one call
+    to the backend, each distinct one once.
+    """
+    backend = get_backend()
+    results = [None] * len(texts)
+    # the rows of the texts that missed, by cache key or row if uncached
+    misses = collections.OrderedDict()
+    for (row, text) in enumerate(texts):
+        text = text or u""
+        key = _cache_key(backend, text)
+        cached = _cache.get(key) if key is not None else None
+        if cached is not None:
+            results[row] = dict(cached)
+        else:
+            misses.setdefault(key or row, (text, []))[1].append(row)
+    hits = len(texts) - sum(len(rows) for (text, rows) in misses.values())
+    if hits:
+        metrics.incr("nlu.cache.hits", hits)
+    if misses:
+        metrics.incr("nlu.cache.misses", len(texts) - hits)
+        parsed = backend.parse_batch([text for (text, rows) in misses.values()])
+        for ((key, (text, rows)), result) in zip(misses.items(), parsed):
+            if isinstance(key, tuple):
+                _cache.put(key, result)
+            for row in rows:
+                results[row] = dict(result)
+    return results
+
+
+def invalidate():
+    """
+    Drops all cached results.
+    """
+    _cache.clear()
+
+
+def cache_stats():
+    """
+    Returns the hit, miss, eviction and expiration counters and the entry
+    count of the result cache.
+    """
+    return _cache.stats()
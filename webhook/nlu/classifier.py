@@ -0,0 +1,229 @@
+from config import settings
+import hashlib
+import json
+import logging
+from nlu import Backend, normalize, resolve_path, result
+import struct
+import sys
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+logger = logging.getLogger()
+
+
+"""
+A local intent classifier for fuzzier language than keywords can match.
+Each text becomes a vector of hashed features: its words, pairs of
+adjacent words, and the three letter sequences in each word. Feature counts
+are damped with log(1 + count), weighted by inverse document frequency, and
+scaled to unit length. Each intent is the normalized sum, or centroid, of
+the vectors of its training examples, and a text's score for an intent is
+the cosine of the angle between them. A whole batch of texts is scored with
+one matrix product.
+
+Models are trained offline with train() and written with save(), or from
+the command line, run in the webhook directory:
+
+    python -m nlu.classifier examples.json model.nlu [dimensions]
+
+where examples.json maps each intent to a list of example texts. load()
+maps a model file into memory read-only, so a cold start doesn't parse or
+copy it, and containers share its pages. Model files are:
+
+    "NLUC", format version (uint32), header length (uint32)
+    header, json: {"version", "dims", "intents"}
+    padding to a multiple of 64 bytes
+    idf weights, dims float32
+    centroids, one row of dims float32 per intent
+
+Needs numpy, which is not in libs/requirements.txt because it has to be
+built for the lambda runtime.
+"""
+_magic = b"NLUC"
+_format = 1
+_prefix = struct.Struct("<4sII")
+_align = 64
+_dtype = "<f4"
+
+
+def _features(text, dims):
+    """
+    Returns the hashed feature columns of a text, with repeats.
+    """
+    words = normalize(text).split()
+    features = [u"w:" + word for word in words]
+    features.extend(u"b:{} {}".format(first, second) for (first, second) in zip(words, words[1:]))
+    for word in words:
+        word = u" {} ".format(word)
+        features.extend(u"c:" + word[n:n + 3] for n in range(len(word) - 2))
+    # crc32 rather than hash() so columns are the same in every process
+    return [(zlib.crc32(feature.encode("utf-8")) & 0xffffffff) % dims for feature in features]
+
+
+def _vectors(texts, idf):
+    """
+    Returns a matrix with a row for each text, its weighted and normalized
+    feature vector.
+    """
+    dims = len(idf)
+    rows = []
+    columns = []
+    for (row, text) in enumerate(texts):
+        features = _features(text, dims)
+        rows.extend([row] * len(features))
+        columns.extend(features)
+    cells = numpy.array(rows, dtype=numpy.int64) * dims + numpy.array(columns, dtype=numpy.int64)
+    counts = numpy.bincount(cells, minlength=len(texts) * dims).reshape(len(texts), dims)
+    vectors = numpy.log1p(counts.astype(numpy.float32)) * idf
+    return _unit_rows(vectors)
+
+
+def _unit_rows(matrix):
+    lengths = numpy.sqrt((matrix * matrix).sum(axis=1))
+    lengths[lengths == 0] = 1
+    return matrix / lengths[:, numpy.newaxis]
+
+
+def _version(intents, idf, centroids):
+    digest = hashlib.sha1(json.dumps(intents).encode("utf-8"))
+    digest.update(numpy.ascontiguousarray(idf, dtype=_dtype).tobytes())
+    digest.update(numpy.ascontiguousarray(centroids, dtype=_dtype).tobytes())
+    return "classifier-{}".format(digest.hexdigest()[:12])
+
+
+class Classifier(Backend):
+    """
+    Scores texts against intent centroids, see above. The best intent is
+    the result, with its cosine score as the confidence, and the matches are
+    the top scoring intents. Texts that share no features with any intent
+    have no intent.
+    Params:
+        intents: list of intent names, one per centroid
+        idf: array of the dims feature weights
+        centroids: array of intents by dims, rows of unit length
+        version: optional, names the model, by default a hash of it
+        top: optional, the number of intents listed in the matches
+    """
+    def __init__(self, intents, idf, centroids, version=None, top=3):
+        self.intents = list(intents)
+        self.idf = idf
+        self.centroids = centroids
+        self.version = version or _version(self.intents, idf, centroids)
+        self.top = top
+
+    @property
+    def dims(self):
+        return len(self.idf)
+
+    def classify_batch(self, texts):
+        """
+        Returns the results for a list of texts, in the same order, scoring
+        them all in one matrix product.
+        """
+        if not texts:
+            return []
+        scores = _vectors(texts, self.idf).dot(self.centroids.T)
+        ranked = numpy.argsort(-scores, axis=1)[:, :self.top]
+        results = []
+        for (row, best) in enumerate(ranked):
+            matches = [{"intent": self.intents[column], "score": float(scores[row, column])}
+                for column in best if scores[row, column] > 0]
+            if matches:
+                results.append(result(matches[0]["intent"], min(1.0, matches[0]["score"]), matches))
+            else:
+                results.append(result(None, 0.0))
+        return results
+
+    def parse(self, text):
+        return self.classify_batch([text])[0]
+
+    def parse_batch(self, texts):
+        return self.classify_batch(texts)
+
+    def save(self, path):
+        """
+        Writes the model to a file that load() can map, see above.
+        """
+        header = json.dumps({"version": self.version, "dims": self.dims, "intents": self.intents}).encode("utf-8")
+        start = _prefix.size + len(header)
+        with open(path, "wb") as f:
+            f.write(_prefix.pack(_magic, _format, len(header)))
+            f.write(header)
+            f.write(b"\0" * (-start % _align))
+            f.write(numpy.ascontiguousarray(self.idf, dtype=_dtype).tobytes())
+            f.write(numpy.ascontiguousarray(self.centroids, dtype=_dtype).tobytes())
+
+
+def train(examples, dims=4096, chunk_size=1024):
+    """
+    Returns a Classifier trained on examples. The examples are vectorized a
+    chunk at a time to bound memory use.
+    Params:
+        examples: list of (text, intent) pairs
+        dims: number of hashed feature columns
+        chunk_size: number of examples vectorized at once
+    """
+    if numpy is None:
+        raise Exception("500 Internal Server Error; the nlu classifier needs numpy")
+    intents = sorted(set(intent for (text, intent) in examples))
+    index = dict((intent, n) for (n, intent) in enumerate(intents))
+    # document frequency: the number of examples each column appears in
+    df = numpy.zeros(dims, dtype=numpy.int64)
+    for (text, intent) in examples:
+        df[list(set(_features(text, dims)))] += 1
+    idf = (numpy.log((1.0 + len(examples)) / (1.0 + df)) + 1).astype(numpy.float32)
+    centroids = numpy.zeros((len(intents), dims), dtype=numpy.float32)
+    for start in range(0, len(examples), chunk_size):
+        chunk = examples[start:start + chunk_size]
+        vectors = _vectors([text for (text, intent) in chunk], idf)
+        numpy.add.at(centroids, [index[intent] for (text, intent) in chunk], vectors)
+    return Classifier(intents, idf, _unit_rows(centroids))
+
+
+def load(path):
+    """
+    Returns the Classifier in a model file written by save(), with its
+    arrays mapped read-only from the file.
+    """
+    if numpy is None:
+        raise Exception("500 Internal Server Error; the nlu classifier needs numpy")
+    with open(path, "rb") as f:
+        (magic, version, length) = _prefix.unpack(f.read(_prefix.size))
+        if magic != _magic or version != _format:
+            raise Exception("500 Internal Server Error; {} is not an nlu classifier model".format(path))
+        header = json.loads(f.read(length).decode("utf-8"))
+    start = _prefix.size + length
+    offset = start + (-start % _align)
+    dims = header["dims"]
+    data = numpy.memmap(path, dtype=_dtype, mode="r", offset=offset, shape=(len(header["intents"]) + 1, dims))
+    return Classifier(header["intents"], data[0], data[1:], header["version"])
+
+
+def from_settings():
+    """
+    Returns the Classifier in the model file named by the "nluModelFile"
+    setting, relative to the webhook directory.
+    """
+    path = resolve_path(settings.get("nluModelFile", "config/intents.nlu"))
+    classifier = load(path)
+    logger.info("Loaded NLU model {} with {} intents from {}".format(classifier.version, len(classifier.intents), path))
+    return classifier
+
+
+def main(examples_path, model_path, dims=4096):
+    with open(examples_path, "rb") as f:
+        table = json.loads(f.read())
+    examples = [(text, intent) for (intent, texts) in sorted(table.items()) for text in texts]
+    classifier = train(examples, dims)
+    classifier.save(model_path)
+    print("Wrote {} intents from {} examples to {}, version {}".format(
+        len(classifier.intents), len(examples), model_path, classifier.version))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2], *[int(arg) for arg in sys.argv[3:4]])
@@ -0,0 +1,118 @@
+from config import settings
+import collections
+import hashlib
+import json
+import logging
+from nlu import Backend, normalize, resolve_path, result
+
+
+logger = logging.getLogger()
+
+
+class KeywordMatcher(Backend):
+    """
+    A local NLU backend that finds an intent from a table of keywords and
+    phrases. The phrases are compiled into an Aho-Corasick automaton, so a
+    message is matched against all of them in one pass over its text, in
+    time proportional to the length of the text and the number of matches,
+    however many phrases there are. Phrases and text are normalized the same
+    way, see nlu.normalize(), and phrases only match whole words.
+
+    The intent with the most matched characters wins, and its confidence
+    is the fraction of the text they cover.
+    Params:
+        table: dictionary mapping phrases to intent names
+        version: optional, names this table, by default a hash of it
+    """
+    def __init__(self, table, version=None):
+        # the automaton: per state, its transitions by character, its
+        # failure link, and the (phrase, intent) pairs that end there
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for (phrase, intent) in table.items():
+            phrase = normalize(phrase)
+            if phrase:
+                # padded with spaces so phrases only match whole words
+                self._add(u" {} ".format(phrase), (phrase, intent))
+        self._link()
+        if version is None:
+            digest = hashlib.sha1(json.dumps(sorted(table.items()), sort_keys=True).encode("utf-8"))
+            version = "keywords-{}".format(digest.hexdigest()[:12])
+        self.version = version
+
+    def __len__(self):
+        return len(self._goto)
+
+    def _add(self, key, output):
+        state = 0
+        for c in key:
+            next_state = self._goto[state].get(c)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][c] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = next_state
+        self._out[state] += (output,)
+
+    def _link(self):
+        """
+        Sets the failure links breadth first, and merges into each state the
+        outputs of the states its failure link leads to.
+        """
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for (c, next_state) in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and c not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(c, 0)
+                self._fail[next_state] = fail if fail != next_state else 0
+                self._out[next_state] += self._out[self._fail[next_state]]
+
+    def matches(self, text):
+        """
+        Returns the (phrase, intent) pairs for every phrase found in text,
+        in the order they end, and the normalized text.
+        """
+        text = normalize(text)
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        state = 0
+        found = []
+        for c in u" {} ".format(text):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if out[state]:
+                found.extend(out[state])
+        return (found, text)
+
+    def parse(self, text):
+        (found, text) = self.matches(text)
+        if not found:
+            return result(None, 0.0)
+        scores = {}
+        for (phrase, intent) in found:
+            scores[intent] = scores.get(intent, 0) + len(phrase)
+        intent = max(scores, key=lambda name: (scores[name], name))
+        confidence = min(1.0, float(scores[intent]) / len(text))
+        return result(intent, confidence, [{"phrase": phrase, "intent": name} for (phrase, name) in found])
+
+
+def from_settings():
+    """
+    Returns a KeywordMatcher for the json table of phrases and intents in
+    the file named by the "nluKeywordsFile" setting, relative to the
+    webhook directory.
+    """
+    path = resolve_path(settings.get("nluKeywordsFile", "config/keywords.json"))
+    with open(path, "rb") as f:
+        table = json.loads(f.read())
+    logger.info("Loaded {} NLU keywords from {}".format(len(table), path))
+    return KeywordMatcher(table)
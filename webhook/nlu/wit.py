@@ -0,0 +1,50 @@
+from config import settings
+import logging
+from nlu import Backend, result
+import requests
+
+
+logger = logging.getLogger()
+
+
+class WitBackend(Backend):
+    """
+    A remote NLU backend that asks wit.ai for the intent of each text. The
+    best intent entity wit.ai returns is the result, and the full entities
+    are in its matches. Each parse is a network round trip, see the nlu
+    result cache to avoid repeating them.
+    Params:
+        token: the wit.ai server access token
+        url: optional, the message API url, formatted with the url-encoded
+            text
+        version: optional, names the wit.ai app version, so cached results
+            are dropped when the app is retrained
+        session: optional, requests module or a requests.Session
+    """
+    def __init__(self, token, url="https://api.wit.ai/message?v=20160526&q={}", version="wit", session=None):
+        self.token = token
+        self.url = url
+        self.version = version
+        self._session = session or requests
+
+    def parse(self, text):
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        response = self._session.get(self.url.format(requests.utils.quote(text)),
+            headers={"Authorization": "Bearer {}".format(self.token)})
+        if response.status_code != 200:
+            raise Exception("500 Internal Server Error; wit.ai call failed with status: {}; message: {}".format(
+                response.status_code, response.text))
+        entities = response.json().get("entities", {})
+        intents = entities.get("intent") or [{}]
+        best = max(intents, key=lambda intent: intent.get("confidence", 0.0))
+        return result(best.get("value"), best.get("confidence", 0.0), [entities] if entities else [])
+
+
+def from_settings():
+    """
+    Returns a WitBackend configured by the "witToken", "witUrl" and
+    "witVersion" settings.
+    """
+    return WitBackend(settings.get("witToken"), settings.get("witUrl", "https://api.wit.ai/message?v=20160526&q={}"),
+        settings.get("witVersion", "wit"))
@@ -0,0 +1,21 @@
+import imp
+import os
+
+
+"""
+This package is imported as "platform", the name of a standard library
+module, which it shadows for everything loaded after it, including
+installed packages like boto3 and numpy that call platform.system(),
+platform.python_version() and so on. So the standard module is loaded
+once here under another name, and its functions are made available from
+this package as well.
+"""
+_found = imp.find_module("platform", [os.path.dirname(os.__file__)])
+try:
+    _stdlib = imp.load_module("_stdlib_platform", *_found)
+finally:
+    _found[0].close()
+
+for _name in dir(_stdlib):
+    if not _name.startswith("__") and _name not in globals():
+        globals()[_name] = getattr(_stdlib, _name)
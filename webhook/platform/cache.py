@@ -0,0 +1,184 @@
+import collections
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger()
+
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe least-recently-used cache. When the cache holds
+    max_entries items the least recently used one is evicted to make room
+    for a new one. Items older than ttl seconds are treated as missing and
+    dropped when they are next looked up.
+    Params:
+        max_entries: maximum number of items to hold
+        ttl: optional, seconds an item stays valid, None for no expiry
+        sizeof: optional, callable returning the approximate size in bytes
+            of a cached value, used to report memory use in stats()
+    """
+    def __init__(self, max_entries, ttl=None, sizeof=None):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.sizeof = sizeof
+        # key -> (value, expiry time or None)
+        self._items = collections.OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def keys(self):
+        """
+        Returns a list of the cached keys, least recently used first. May
+        include expired items that have not been looked up since expiring.
+        """
+        with self._lock:
+            return list(self._items)
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for key and marks it most recently used, or
+        default if key is not in the cache or has expired.
+        """
+        with self._lock:
+            try:
+                item = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if item[1] is not None and item[1] <= time.time():
+                self._bytes -= self._sizes.pop(key, 0)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._items[key] = item
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, ttl=None):
+        """
+        Caches value under key, evicting the least recently used item if the
+        cache is full.
+        Params:
+            ttl: optional, seconds the item stays valid, overrides the
+                cache's ttl for this item
+        """
+        size = self.sizeof(value) if self.sizeof else 0
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            elif len(self._items) >= self.max_entries:
+                self._remove(next(iter(self._items)))
+                self.evictions += 1
+            self._items[key] = (value, expires)
+            if size:
+                self._sizes[key] = size
+                self._bytes += size
+
+    def invalidate(self, key):
+        """
+        Removes key from the cache. Returns True if it was present.
+        """
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+                return True
+            return False
+
+    def clear(self):
+        """
+        Removes all items from the cache. Counters are not reset.
+        """
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Returns a dictionary of cache counters: entries, max_entries, hits,
+        misses, evictions, expirations, hit_rate and, if a sizeof callable
+        was supplied, the approximate bytes held.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                "entries": len(self._items),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0
+            }
+            if self.sizeof:
+                stats["bytes"] = self._bytes
+            return stats
+
+    def _remove(self, key):
+        del self._items[key]
+        self._bytes -= self._sizes.pop(key, 0)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key. While a call for a key is
+    in flight, other callers for that key wait for it and share its result
+    or exception instead of making their own call.
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Returns fn(*args, **kwargs), or the result of the call already in
+        flight for key. Raises the exception the call raised, if any.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+                self.calls += 1
+            else:
+                leader = False
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
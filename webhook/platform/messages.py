@@ -1,10 +1,15 @@
-from config import settings
+from cache import LRUCache
+from config import page_settings, settings
+import hashlib
 import json
 import logging
 import os
+import Queue
 import re
 import requests
-from validation import validate_message
+import threading
+import time
+from validation import check_message, validate_message
 
 
 logger = logging.getLogger()
@@ -13,6 +18,44 @@ logger = logging.getLogger()
 templates_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "templates/")
 
 
+_json_headers = {"Content-Type": "application/json"}
+
+
+class RenderedMessage(dict):
+    """
+    A message dict built from a template by make_message() or
+    make_cached_message(). 'validated' is True when the message was
+    validated when it was rendered into the cache, in which case
+    send_message() does not validate it again. Functions in this module
+    that modify a message clear the flag. In the "trusted" validation mode
+    rendered messages are not validated at all.
+    """
+    rendered = True
+    validated = False
+
+
+_message_cache = LRUCache(settings.get("messageCacheSize", 256), sizeof=lambda entry: entry[1])
+
+
+def _post_message(data, session=requests, page_token=None):
+    """
+    Posts an already serialized message to the graph send API and returns
+    the decoded response.
+    Params:
+
+        data: json string containing the rendered message
+        session: optional, requests module or a requests.Session to post with
+        page_token: optional, the page token to send with, by default the
+            token of the page whose event is being handled
+    """
+    url = settings.get("graphSendUrl").format(page_token or page_settings().get("pageToken"))
+    response = session.post(url, headers=_json_headers, data=data)
+    if response.status_code == 200:
+        return json.loads(response.text)
+    else:
+        raise Exception("FB graph API call failed; status: {}; data: {}".format(response.status_code, response.text))
+
+
 def send_message(message):
     """
     Sends a structured or unstructured message to a specific page-scoped
@@ -24,14 +67,8 @@ def send_message(message):
     Returns:
         stuff
     """
-    validate_message(message)
-    url = settings.get("graphSendUrl").format(settings.get("pageToken"))
-    headers = {"Content-Type": "application/json"}
-    response = requests.post(url, headers=headers, data=json.dumps(message))
-    if response.status_code == 200:
-        return json.loads(response.text)
-    else:
-        raise Exception("FB graph API call failed; status: {}; data: {}".format(response.status_code, response.text))
+    check_message(message)
+    return _post_message(json.dumps(message))
 
 
 def _render(template, data):
@@ -81,7 +118,73 @@ def make_message(recipient_id, template_name, data=None, buttons=None):
         template = _render(template, data)
     if buttons:
         template["message"]["attachment"]["payload"]["buttons"].extend(buttons)
-    return template
+    return RenderedMessage(template)
+
+
+def _copy_message(value):
+    """
+    Returns a copy of a rendered message. Messages only contain dicts, lists
+    and scalars, so this is considerably cheaper than copy.deepcopy.
+    """
+    if isinstance(value, dict):
+        return dict((k, _copy_message(v)) for (k, v) in value.iteritems())
+    elif isinstance(value, list):
+        return [_copy_message(v) for v in value]
+    else:
+        return value
+
+
+def make_cached_message(recipient_id, template_name, data=None, buttons=None):
+    """
+    Same as make_message(), but renders each distinct (template_name, data,
+    buttons) combination only once and returns copies of the cached result
+    on later calls. Use it for replies that are identical across users such
+    as menus, help text and error prompts. The cache is bounded by the
+    "messageCacheSize" setting.
+    Params:
+
+        recipient_id: required, FB page-scoped id of the recipient user
+        template_name: required, string name of template to load
+        data: optional, dictionary of template values
+        buttons: optional, list of buttons to add, template must be "button_message"
+
+    Returns:
+        a RenderedMessage that differs from other copies only in recipient.id
+    """
+    key = "{}:{}".format(template_name, hashlib.sha1(
+        json.dumps([data, buttons], sort_keys=True, separators=(",", ":"))).hexdigest())
+    entry = _message_cache.get(key)
+    if entry is None:
+        template = make_message("", template_name, data, buttons)
+        try:
+            template["recipient"]["id"] = "-"
+            validate_message(template)
+            validated = True
+        except Exception as e:
+            # cache it anyway, send_message will report the error
+            logger.debug("Cached message {} failed validation: {}".format(template_name, e))
+            validated = False
+        entry = (_copy_message(template), len(json.dumps(template)), validated)
+        _message_cache.put(key, entry)
+    message = RenderedMessage(_copy_message(entry[0]))
+    message["recipient"]["id"] = recipient_id
+    message.validated = entry[2] and bool(recipient_id)
+    return message
+
+
+def message_cache_stats():
+    """
+    Returns the hit, miss and eviction counters, hit rate, entry count and
+    approximate bytes held by the make_cached_message() cache.
+    """
+    return _message_cache.stats()
+
+
+def clear_message_cache():
+    """
+    Empties the make_cached_message() cache, e.g. after changing templates.
+    """
+    _message_cache.clear()
 
 
 def add_message_element(message, title, subtitle="", image_url="", item_url="", buttons=None):
@@ -96,6 +199,8 @@ def add_message_element(message, title, subtitle="", image_url="", item_url="",
         item_url: optional, string url to open when element is tapped
         buttons: optional, list of buttons created with make_message_button()
     """
+    if isinstance(message, RenderedMessage):
+        message.validated = False
     template_file = os.path.join(templates_dir, "_element.json")
     with open(template_file, "rb") as f:
         template = json.loads(f.read())
@@ -137,3 +242,199 @@ def make_postback_button(title, payload):
         template = json.loads(f.read())
     return _render(template, {"button_payload":payload, "button_title":title})
 
+
+
+_broadcast_sentinel = "__broadcast_recipient_id__"
+
+
+class _RateLimiter(object):
+    """
+    Token bucket shared by the broadcast workers. Allows up to 'rate'
+    acquisitions per second with bursts of at most 'rate' tokens. A rate
+    of None or 0 disables limiting.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate) if rate else None
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def _read_recipients(recipients):
+    """
+    Yields recipient ids from an iterable, or from a file containing one
+    id per line if recipients is a string path. Blank lines are skipped.
+    """
+    if isinstance(recipients, basestring):
+        with open(recipients, "rb") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+    else:
+        for recipient_id in recipients:
+            yield recipient_id
+
+
+def _read_checkpoint(checkpoint_file, template_name):
+    """
+    Returns the (position, failed) state stored in a broadcast checkpoint
+    file, or (0, []) if the file does not exist.
+    """
+    if not checkpoint_file or not os.path.exists(checkpoint_file):
+        return 0, []
+    with open(checkpoint_file, "rb") as f:
+        state = json.loads(f.read())
+    if state.get("template") != template_name:
+        raise Exception("Broadcast checkpoint {} belongs to template {}, not {}".format(
+            checkpoint_file, state.get("template"), template_name))
+    return state["position"], state["failed"]
+
+
+def _write_checkpoint(checkpoint_file, template_name, position, failed):
+    """
+    Atomically replaces the broadcast checkpoint file with the current
+    progress.
+    """
+    temp_file = "{}.tmp".format(checkpoint_file)
+    with open(temp_file, "wb") as f:
+        f.write(json.dumps({"template": template_name, "position": position, "failed": failed}))
+    os.rename(temp_file, checkpoint_file)
+
+
+def broadcast(recipients, template_name, data=None, buttons=None, concurrency=None, rate=None,
+              checkpoint_file=None, checkpoint_every=100):
+    """
+    Sends the same message to many page-scoped user IDs. The template is
+    rendered, validated and serialized once, and only the recipient id is
+    substituted for each send.
+    Params:
+
+        recipients: required, iterable of page-scoped ids, or the path of a
+            file containing one id per line. Consumed lazily.
+        template_name: required, string name of template to load
+        data: optional, dictionary of template values
+        buttons: optional, list of buttons to add, template must be "button_message"
+        concurrency: optional, number of concurrent sends, defaults to the
+            "broadcastConcurrency" setting of the current page
+        rate: optional, maximum sends per second, defaults to the
+            "broadcastRate" setting of the current page. 0 or None disables
+            rate limiting.
+        checkpoint_file: optional, path of a file used to record progress. If
+            the file exists the broadcast resumes after the recipients it has
+            already recorded as done.
+        checkpoint_every: optional, number of completed sends between
+            checkpoint writes
+
+    Returns:
+        dictionary of the form:
+            {
+                "sent": number of successful sends in this run,
+                "skipped": number of recipients skipped from the checkpoint,
+                "failed": [{"id": recipient id, "error": error message}, ...]
+            }
+        "failed" includes failures recorded in the checkpoint by earlier runs.
+
+    Raises an exception, after stopping the workers, if the broadcast can't
+    go on, for instance because a checkpoint write failed.
+    """
+    if concurrency is None:
+        concurrency = page_settings().get("broadcastConcurrency", 8)
+    if rate is None:
+        rate = page_settings().get("broadcastRate", 40)
+    concurrency = max(1, concurrency)
+
+    message = make_message(_broadcast_sentinel, template_name, data, buttons)
+    check_message(message)
+    body = json.dumps(message).split(json.dumps(_broadcast_sentinel))
+    if len(body) != 2:
+        raise Exception("Broadcast template {} cannot be rendered once; recipient id placeholder is ambiguous".format(
+            template_name))
+    prefix, suffix = body
+
+    skipped, failed = _read_checkpoint(checkpoint_file, template_name)
+    limiter = _RateLimiter(rate)
+    work = Queue.Queue(maxsize=concurrency * 2)
+    lock = threading.Lock()
+    state = {"sent": 0, "position": skipped, "completed": set(), "since_checkpoint": 0, "error": None}
+
+    def _complete(index):
+        # advance the low watermark over contiguous completed indices so that
+        # a resumed broadcast never skips a recipient that was not sent
+        with lock:
+            state["completed"].add(index)
+            while state["position"] in state["completed"]:
+                state["completed"].remove(state["position"])
+                state["position"] += 1
+            state["since_checkpoint"] += 1
+            if checkpoint_file and state["since_checkpoint"] >= checkpoint_every:
+                state["since_checkpoint"] = 0
+                _write_checkpoint(checkpoint_file, template_name, state["position"], failed)
+
+    # the workers don't share this thread's page context
+    page_token = page_settings().get("pageToken")
+
+    def _worker():
+        session = requests.Session()
+        while True:
+            item = work.get()
+            if item is None:
+                break
+            # after a fatal error the queue is drained without sending, so
+            # the producer never blocks on a full queue
+            if state["error"] is not None:
+                continue
+            index, recipient_id = item
+            try:
+                limiter.acquire()
+                try:
+                    _post_message("{}{}{}".format(prefix, json.dumps(str(recipient_id)), suffix), session, page_token)
+                    with lock:
+                        state["sent"] += 1
+                except Exception as e:
+                    logger.error("Broadcast to {} failed: {}".format(recipient_id, e))
+                    with lock:
+                        failed.append({"id": str(recipient_id), "error": str(e)})
+                _complete(index)
+            except Exception as e:
+                with lock:
+                    if state["error"] is None:
+                        logger.error("Broadcast stopped: {}".format(e))
+                        state["error"] = e
+
+    workers = [threading.Thread(target=_worker) for i in range(concurrency)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    try:
+        for index, recipient_id in enumerate(_read_recipients(recipients)):
+            if state["error"] is not None:
+                break
+            if index < skipped:
+                continue
+            work.put((index, recipient_id))
+    finally:
+        for worker in workers:
+            work.put(None)
+        for worker in workers:
+            worker.join()
+        if checkpoint_file and state["error"] is None:
+            _write_checkpoint(checkpoint_file, template_name, state["position"], failed)
+
+    if state["error"] is not None:
+        raise Exception("Broadcast stopped after {} sends: {}".format(state["sent"], state["error"]))
+    return {"sent": state["sent"], "skipped": skipped, "failed": failed}
@@ -0,0 +1,144 @@
+from cache import LRUCache
+from config import settings
+import logging
+import metrics
+import stores
+
+
+logger = logging.getLogger()
+
+
+"""
+Persistent user preferences, a dictionary of fields for each page-scoped
+user id. The backend is set by the "prefsStore" setting, which takes the
+same values as "sessionStore": "sqlite" (the default, at "prefsStorePath"),
+"memory", or "dynamodb" (the table "prefsTable", with "prefsStoreEndpoint"
+for a local stand-in). Any other Store can be plugged in with set_store().
+
+Bots read preferences on every turn and write them rarely, so reads go
+through an in-process cache of whole preference dictionaries, with its
+size and time to live set by "prefsCacheSize" and "prefsCacheTtl". A
+cache hit costs a dictionary lookup. set(), update() and unset() change
+only the named fields, with one atomic write that returns the updated
+dictionary, which replaces the cached one. With sqlite, a SqliteFieldStore,
+and with dynamodb, the write touches only those fields, each user's fields
+being kept in separate rows or attributes. The memory store rewrites the
+whole dictionary. Other containers see the change once their cached copy
+expires. Store operations are timed in metrics as prefs.<backend>.<operation>.
+
+Values returned by get() and get_all() are shared with the cache and must
+not be changed in place.
+"""
+_cache = LRUCache(settings.get("prefsCacheSize", 1000), ttl=settings.get("prefsCacheTtl", 300))
+_store = None
+
+
+def set_store(store):
+    """
+    Replaces the preferences store with store, a platform.stores.Store,
+    and empties the cache.
+    """
+    global _store
+    _store = store
+    _cache.clear()
+
+
+def _get_store():
+    """
+    Returns the preferences store, opening it from the settings on first
+    use.
+    """
+    if _store is None:
+        backend = settings.get("prefsStore", "sqlite")
+        if backend == "sqlite":
+            set_store(stores.SqliteFieldStore(settings.get("prefsStorePath", "/tmp/prefs.db"), table="pref_fields"))
+        elif backend == "dynamodb":
+            set_store(stores.DynamoStore(settings.get("prefsTable", "prefs"),
+                endpoint_url=settings.get("prefsStoreEndpoint") or None))
+        else:
+            set_store(stores.make_store(backend))
+    return _store
+
+
+def _timed(store, operation):
+    return metrics.timed("prefs.{}.{}".format(store.kind or type(store).__name__, operation))
+
+
+def get_all(user_id):
+    """
+    Returns the dictionary of a user's preferences, empty if there are none.
+    Params:
+        user_id: the page-scoped user id
+    """
+    user_id = str(user_id)
+    document = _cache.get(user_id)
+    if document is None:
+        store = _get_store()
+        with _timed(store, "get"):
+            document = store.get(user_id) or {}
+        _cache.put(user_id, document)
+    return document
+
+
+def get(user_id, field, default=None):
+    """
+    Returns the value of one of a user's preferences, or default if it is
+    not set.
+    Params:
+        user_id: the page-scoped user id
+        field: name of the preference
+        default: optional, returned if the preference is not set
+    """
+    return get_all(user_id).get(field, default)
+
+
+def update(user_id, changes, removals=()):
+    """
+    Sets and removes several of a user's preferences with one atomic write.
+    Returns the updated dictionary of preferences.
+    Params:
+        user_id: the page-scoped user id
+        changes: dictionary of the preferences to set and their values
+        removals: optional, names of the preferences to remove
+    """
+    user_id = str(user_id)
+    store = _get_store()
+    with _timed(store, "update_fields"):
+        document = store.update_fields(user_id, changes, removals)
+    _cache.put(user_id, document)
+    return document
+
+
+def set(user_id, field, value):
+    """
+    Sets one of a user's preferences. Returns the updated dictionary of
+    preferences.
+    """
+    return update(user_id, {field: value})
+
+
+def unset(user_id, *fields):
+    """
+    Removes one or more of a user's preferences. Returns the updated
+    dictionary of preferences.
+    """
+    return update(user_id, {}, fields)
+
+
+def delete(user_id):
+    """
+    Removes all of a user's preferences.
+    """
+    user_id = str(user_id)
+    store = _get_store()
+    with _timed(store, "delete"):
+        store.delete(user_id)
+    _cache.invalidate(user_id)
+
+
+def cache_stats():
+    """
+    Returns the hit, miss, eviction and expiration counters and the entry
+    count of the preferences cache.
+    """
+    return _cache.stats()
@@ -1,8 +1,14 @@
-from config import settings
+from cache import LRUCache, SingleFlight
+from config import page_context, page_settings, settings
 import json
 import logging
+import metrics
 import os
+import Queue
 import requests
+import stores
+import threading
+import time
 
 
 logger = logging.getLogger()
@@ -11,18 +17,337 @@ logger = logging.getLogger()
 default_fields = "first_name,last_name,locale,timezone,gender"
 
 
-def get(user_id, fields=default_fields):
+"""
+Profiles rarely change, so they are cached in two tiers. The first is in
+process, by user id, with its size and time to live set by the
+"profileCacheSize" and "profileCacheTtl" settings. The second is a store
+that outlives the process, with a time to live set by "profileStoreTtl".
+By default it is a sqlite database at "profileStorePath", and the
+"profileStore" setting can be "none" to turn it off or "memory". Any other
+Store can be plugged in with set_store().
+
+Bots ask for different field lists, so both tiers hold one entry per user
+with the union of the fields fetched so far:
+
+    {"fields": [field names fetched], "profile": {field: value}}
+
+A request for any subset of those fields is served from the entry, and a
+request for fields that are not there fetches only the missing ones and
+merges them in. Fields are recorded as fetched even if the graph API did
+not return them, so that unavailable fields are not asked for again.
+
+get() looks in memory, then the store, then calls the graph API, and writes
+what it finds through to the tiers that missed. Concurrent misses for the
+same user share a single load and its result or error.
+
+Entries also record when their oldest field was fetched. An entry older
+than "profileCacheTtl" is stale, and for up to "profileMaxStaleness" more
+seconds a stale entry is still returned at once, while a background thread
+fetches it again and replaces it in both tiers. Returning users are never
+kept waiting on the graph API. The same bound applies to entries loaded
+from the store, which are fetched again first if they are older than that,
+even within the store's own time to live. Setting "profileMaxStaleness" to
+0 turns this off, and then entries are returned from the store for as long
+as it keeps them. Under lambda the refresh thread only runs while the
+container is handling a request, so a refresh may finish during a later
+one.
+"""
+_cache_ttl = settings.get("profileCacheTtl", 3600)
+_max_staleness = settings.get("profileMaxStaleness", 3600)
+_profile_cache = LRUCache(settings.get("profileCacheSize", 1000), ttl=_cache_ttl + _max_staleness)
+_store_ttl = settings.get("profileStoreTtl", 86400)
+_store = None
+_store_opened = False
+_flights = SingleFlight()
+_refresh_queue = Queue.Queue()
+_refreshing = set()
+_refresh_lock = threading.Lock()
+_refresher = None
+
+
+def set_store(store):
     """
-    Calls the graph API to return the user profile for a specific
-    page-scoped user ID.
-    Params:
-        user_id: the page-scoped user id.
-        fields: comma-delimited list of fields to return
+    Replaces the second cache tier with store, a platform.stores.Store.
+    None turns the second tier off.
+    """
+    global _store, _store_opened
+    _store = store
+    _store_opened = True
+
+
+def _get_store():
+    """
+    Returns the second tier store, opening it from the settings on first
+    use, or None if there is none.
+    """
+    global _store_opened
+    if not _store_opened:
+        backend = settings.get("profileStore", "sqlite")
+        try:
+            if backend == "sqlite":
+                set_store(stores.SqliteStore(settings.get("profileStorePath", "/tmp/profiles.db"), table="profiles"))
+            elif backend != "none":
+                set_store(stores.make_store(backend))
+        except Exception as e:
+            logger.error("Failed to open profile store {}: {}".format(backend, e))
+        _store_opened = True
+    return _store
+
+
+def _store_get(user_id):
+    store = _get_store()
+    if store is None:
+        return None
+    try:
+        return store.get(user_id)
+    except Exception as e:
+        logger.error("Profile store get failed: {}".format(e))
+
+
+def _store_put(user_id, record):
+    store = _get_store()
+    if store is None:
+        return
+    try:
+        store.put(user_id, record, _store_ttl)
+    except Exception as e:
+        logger.error("Profile store put failed: {}".format(e))
+
+
+def _fetch(user_id, fields):
     """
-    url = settings.get("graphProfileUrl").format(user_id, fields, settings.get("pageToken"))
+    Calls the graph API for the profile of a single user.
+    """
+    url = settings.get("graphProfileUrl").format(user_id, fields, page_settings().get("pageToken"))
     logger.debug("Calling {}".format(url))
     response = requests.get(url)
     if response.status_code == 200:
         return json.loads(response.text)
     else:
-        raise Exception("500 Internal Server Error; graph API call failed with status: {}; message: {}".format(response.status_code, response.text))
\ No newline at end of file
+        raise Exception("500 Internal Server Error; graph API call failed with status: {}; message: {}".format(response.status_code, response.text))
+
+
+def _fetch_many(user_ids, fields):
+    """
+    Calls the graph API once for the profiles of several users. Returns a
+    dictionary of profiles keyed by user id.
+    """
+    url = settings.get("graphProfilesUrl").format(",".join(user_ids), fields, page_settings().get("pageToken"))
+    logger.debug("Calling {}".format(url))
+    response = requests.get(url)
+    if response.status_code == 200:
+        return json.loads(response.text)
+    else:
+        raise Exception("500 Internal Server Error; graph API call failed with status: {}; message: {}".format(response.status_code, response.text))
+
+
+def _split(fields):
+    """
+    Returns the field names in a comma-delimited list of fields.
+    """
+    return frozenset(field.strip() for field in fields.split(",") if field.strip())
+
+
+def _missing(entry, wanted):
+    """
+    Returns the names in wanted that have not been fetched into entry.
+    """
+    if entry is None:
+        return wanted
+    return wanted.difference(entry["fields"])
+
+
+def _merge(entry, fields, profile, fetched):
+    """
+    Returns a new entry with the fields and values of profile, fetched at
+    time fetched, added to those of entry. Cached entries are shared between
+    threads and never modified.
+    """
+    if entry is None:
+        return {"fields": sorted(fields), "profile": dict(profile), "fetched": fetched}
+    merged = dict(entry["profile"])
+    merged.update(profile)
+    return {
+        "fields": sorted(fields.union(entry["fields"])),
+        "profile": merged,
+        "fetched": min(fetched, entry.get("fetched", 0))
+    }
+
+
+def _merge_stored(entry, user_id):
+    """
+    Returns entry merged with the user's entry in the store, if any. A
+    stored entry too stale to be returned, see above, is a miss.
+    """
+    stored = _store_get(user_id)
+    # records written before entries held a field list are ignored
+    if stored is None or "fields" not in stored:
+        return entry
+    if _max_staleness and stored.get("fetched", 0) + _cache_ttl + _max_staleness < time.time():
+        return entry
+    return _merge(entry, frozenset(stored["fields"]), stored["profile"], stored.get("fetched", 0))
+
+
+def _revalidate(user_id, entry):
+    """
+    Queues a background refresh of entry if it is stale and refreshing is
+    turned on. Each user is queued at most once at a time.
+    """
+    global _refresher
+    if not _max_staleness or entry.get("fetched", 0) + _cache_ttl > time.time():
+        return
+    with _refresh_lock:
+        if user_id in _refreshing:
+            return
+        _refreshing.add(user_id)
+        if _refresher is None:
+            _refresher = threading.Thread(target=_refresh_worker, name="profile-refresh")
+            _refresher.daemon = True
+            _refresher.start()
+    # the refresh thread fetches with the token of the page asking now
+    _refresh_queue.put((user_id, ",".join(entry["fields"]), page_settings().get("pageId")))
+
+
+def _refresh_worker():
+    while True:
+        (user_id, fields, page_id) = _refresh_queue.get()
+        try:
+            with page_context(page_id):
+                _flights.do(user_id, _refresh, user_id, fields)
+            metrics.incr("profiles.refreshes")
+        except Exception as e:
+            metrics.incr("profiles.refresh_errors")
+            logger.error("Profile refresh for {} failed: {}".format(user_id, e))
+        finally:
+            with _refresh_lock:
+                _refreshing.discard(user_id)
+            _refresh_queue.task_done()
+
+
+def _refresh(user_id, fields):
+    """
+    Fetches all the fields of a stale entry again and replaces it in both
+    tiers.
+    """
+    entry = _merge(None, _split(fields), _fetch(user_id, fields), time.time())
+    _store_put(user_id, entry)
+    _profile_cache.put(user_id, entry)
+    return entry
+
+
+def _project(entry, wanted):
+    """
+    Returns the user id and the wanted fields of the profile in entry.
+    """
+    profile = entry["profile"]
+    result = dict((field, profile[field]) for field in wanted if field in profile)
+    if "id" in profile:
+        result["id"] = profile["id"]
+    return result
+
+
+def prefetch(user_ids, fields=default_fields):
+    """
+    Makes sure the profiles of several users are in the in-process cache,
+    so that the get() calls that follow are cache hits. Fields missing from
+    both tiers are fetched with as few graph API calls as possible, up to
+    "graphBatchSize" users per call, which can be set per page.
+    Params:
+        user_ids: iterable of page-scoped user ids, duplicates are ignored
+        fields: comma-delimited list of fields to fetch
+    Returns:
+        the number of profiles fetched from the graph API
+    """
+    wanted = _split(fields)
+    entries = {}
+    # users grouped by the fields they are missing, one batch per group
+    missing = {}
+    for user_id in set(str(user_id) for user_id in user_ids):
+        entry = _profile_cache.get(user_id)
+        if not _missing(entry, wanted):
+            continue
+        entry = _merge_stored(entry, user_id)
+        needed = _missing(entry, wanted)
+        if needed:
+            entries[user_id] = entry
+            missing.setdefault(needed, []).append(user_id)
+        else:
+            _profile_cache.put(user_id, entry)
+    batch_size = page_settings().get("graphBatchSize", 50)
+    for (needed, group) in missing.items():
+        for start in range(0, len(group), batch_size):
+            fetched = _fetch_many(group[start:start + batch_size], ",".join(sorted(needed)))
+            for (user_id, profile) in fetched.items():
+                entry = _merge(entries.get(user_id), needed, profile, time.time())
+                _store_put(user_id, entry)
+                _profile_cache.put(user_id, entry)
+    return sum(len(group) for group in missing.values())
+
+
+def get(user_id, fields=default_fields):
+    """
+    Returns the user profile for a specific page-scoped user ID, calling
+    the graph API for any fields that are not cached in either tier. A
+    stale profile is returned at once and refreshed in the background.
+    Params:
+        user_id: the page-scoped user id.
+        fields: comma-delimited list of fields to return
+    """
+    user_id = str(user_id)
+    wanted = _split(fields)
+    entry = _profile_cache.get(user_id)
+    # a shared load may have been for other fields, so check again after it
+    while _missing(entry, wanted):
+        entry = _flights.do(user_id, _load, user_id, wanted, entry)
+    _revalidate(user_id, entry)
+    return _project(entry, wanted)
+
+
+def _load(user_id, wanted, entry):
+    """
+    Loads the wanted fields of a profile that are missing from its entry in
+    the in-process cache from the store or the graph API, fetching only the
+    fields that neither tier has, and writes the merged entry through to the
+    tiers that missed. Only one _load runs at a time for each user, see get().
+    """
+    entry = _merge_stored(entry, user_id)
+    needed = _missing(entry, wanted)
+    if needed:
+        metrics.incr("profiles.store.misses")
+        profile = _fetch(user_id, ",".join(sorted(needed)))
+        entry = _merge(entry, needed, profile, time.time())
+        _store_put(user_id, entry)
+    else:
+        metrics.incr("profiles.store.hits")
+    _profile_cache.put(user_id, entry)
+    return entry
+
+
+def invalidate(user_id=None):
+    """
+    Drops the cached profile of a user from both tiers, so that the next
+    get() calls the graph API. Drops all cached profiles if user_id is None.
+    """
+    store = _get_store()
+    if user_id is None:
+        _profile_cache.clear()
+        if store is not None:
+            store.clear()
+        return
+    user_id = str(user_id)
+    _profile_cache.invalidate(user_id)
+    if store is not None:
+        store.delete(user_id)
+
+
+def cache_stats():
+    """
+    Returns the hit, miss, eviction and expiration counters and the entry
+    count of the in-process profile cache, which has one entry per user,
+    and the number of loads that were shared by concurrent callers instead
+    of being repeated. Second tier hits and misses are counted in metrics as
+    profiles.store.hits and profiles.store.misses.
+    """
+    stats = _profile_cache.stats()
+    stats["shared_loads"] = _flights.shared
+    return stats
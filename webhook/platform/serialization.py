@@ -0,0 +1,105 @@
+import json
+import logging
+import struct
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# msgpack's pure python fallback is much slower than json, so records are
+# only written with msgpack when its C extension is available
+use_msgpack = msgpack is not None and msgpack.Packer.__module__ != "msgpack.fallback"
+
+
+logger = logging.getLogger()
+
+
+class JsonCodec(object):
+    """
+    Serializes store values as json text. The default for all stores.
+    """
+    binary = False
+
+    def encode(self, value):
+        return json.dumps(value)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+"""
+BinaryCodec records start with a three byte header:
+
+    0xC1, flags, schema version
+
+0xC1 is never used by msgpack and can't start a json text, so records
+written by JsonCodec are still read, as schema version 0. The flags say
+how the payload that follows the header is encoded:
+
+    bit 0: compressed with zlib
+    bit 1: msgpack, otherwise compact json
+"""
+_magic = b"\xc1"
+_compressed = 0x01
+_msgpack = 0x02
+
+
+class BinaryCodec(object):
+    """
+    Serializes store values in a compact binary form, smaller and faster
+    to encode and decode than json text. Uses msgpack if its C extension is
+    installed and compact json if not, and compresses payloads larger than
+    compress_threshold bytes with zlib. Every record carries the schema
+    version it was written with, and older records are passed through
+    upgrade when they are read, so they are upgraded lazily, the next time
+    they are written. Records written with msgpack can only be read where
+    msgpack is installed.
+    Params:
+        version: the current schema version, 0 to 255
+        upgrade: optional, callable taking a value and the version it was
+            written with and returning the value at the current version
+        compress_threshold: optional, payloads larger than this many bytes
+            are compressed, None to never compress
+    """
+    binary = True
+
+    def __init__(self, version=1, upgrade=None, compress_threshold=512):
+        self.version = version
+        self.upgrade = upgrade
+        self.compress_threshold = compress_threshold
+
+    def encode(self, value):
+        if use_msgpack:
+            flags = _msgpack
+            payload = msgpack.packb(value, use_bin_type=True)
+        else:
+            flags = 0
+            payload = json.dumps(value, separators=(",", ":"))
+            if not isinstance(payload, bytes):
+                payload = payload.encode("utf-8")
+        if self.compress_threshold is not None and len(payload) > self.compress_threshold:
+            flags |= _compressed
+            payload = zlib.compress(payload)
+        return _magic + struct.pack("BB", flags, self.version) + payload
+
+    def decode(self, data):
+        if data[:1] != _magic:
+            return self._upgrade(json.loads(data), 0)
+        (flags, version) = struct.unpack("BB", data[1:3])
+        payload = data[3:]
+        if flags & _compressed:
+            payload = zlib.decompress(payload)
+        if flags & _msgpack:
+            if msgpack is None:
+                raise Exception("500 Internal Server Error; record is msgpack encoded but msgpack is not installed")
+            value = msgpack.unpackb(payload, raw=False)
+        else:
+            value = json.loads(payload.decode("utf-8"))
+        return self._upgrade(value, version)
+
+    def _upgrade(self, value, version):
+        if version < self.version and self.upgrade is not None:
+            value = self.upgrade(value, version)
+        return value
@@ -0,0 +1,379 @@
+from config import settings
+import contextlib
+import json
+import logging
+import metrics
+from serialization import BinaryCodec
+import stores
+import threading
+import time
+
+
+logger = logging.getLogger()
+
+
+"""
+Conversation state for each user, kept as a dictionary in a store keyed on
+the page-scoped user id, so that a bot can pick a conversation up where it
+left off on the next event. The backend is set by the "sessionStore"
+setting:
+
+    - "sqlite", the default, a local database at "sessionStorePath"
+    - "memory", a dict in this process, mostly for testing
+    - "dynamodb", the table named by "sessionTable", shared by all
+      containers. "sessionStoreEndpoint" can point it at a local stand-in.
+
+Any other Store can be plugged in with set_store(). Every operation is timed
+in metrics as sessions.<backend>.<operation>, so backends can be compared
+on numbers, see tests/bench_sessions.py.
+
+Inside a unit_of_work() block, which handlers.dispatch opens around each
+callback, sessions are buffered for the thread: each user's session is
+read from the store once, get() returns the same dictionary every time so
+the bot can change it in place, and put(), update() and delete() only
+change the buffer. When the block ends the sessions that changed are
+written back and the deleted ones removed in one batch, so a callback
+costs one read and at most one write per distinct user, however many
+events and operations it holds.
+
+The same user's callbacks can be handled by two containers at once, so
+sessions that were read are written back with a conditional write that
+fails if someone else has written the session since it was read. On a
+conflict update() reads the session again and calls its function again,
+up to "sessionMaxRetries" times. Inside a unit of work the update
+functions called for a user are replayed the same way when the session
+is written back. A session that was changed in any other way, in place or
+with put(), can't be replayed, so on a conflict the unit of work fails with
+a 409 after writing the other sessions, and Facebook sends the callback
+again. put() reads the version of a session it replaces, so that it is
+written conditionally too. Conditional writes and conflicts are counted in
+metrics as sessions.conditional_writes and sessions.conflicts.
+
+Sessions are stored with a BinaryCodec, compressed above
+"sessionCompressThreshold" bytes. The schema starts at version 0, and a
+bot that changes the shape of its sessions registers a function that
+upgrades them from the previous version with register_upgrade(). Older
+sessions are upgraded as they are read.
+
+Abandoned sessions expire "sessionTtl" seconds after they were last
+written, 0 for never. Expired sessions are no longer returned, and are
+removed from the store by sweep(), which a unit of work calls at most
+every "sessionSweepInterval" seconds. The memory and sqlite stores keep an
+index by expiry time, so a sweep only visits the expired sessions.
+Backends with native expiry, like DynamoDB's TTL, do their own sweeping.
+Swept sessions are counted in metrics as sessions.expired.
+"""
+_upgrades = {}
+
+
+def _upgrade(session, version):
+    while version < codec.version:
+        fn = _upgrades.get(version)
+        if fn is not None:
+            result = fn(session)
+            if result is not None:
+                session = result
+        version += 1
+    return session
+
+
+codec = BinaryCodec(version=0, upgrade=_upgrade, compress_threshold=settings.get("sessionCompressThreshold", 512))
+_ttl = settings.get("sessionTtl", 604800) or None
+_sweep_interval = settings.get("sessionSweepInterval", 300)
+_last_sweep = time.time()
+_sweep_lock = threading.Lock()
+_store = None
+_local = threading.local()
+# marks a session that was written without being read
+_unread = object()
+
+
+class _Buffered(object):
+    """
+    A session buffered by a unit of work.
+    """
+    def __init__(self, session, version, loaded):
+        # the session, None if deleted
+        self.session = session
+        # the version read, None if there was none
+        self.version = version
+        # json of the session as read, None if there was none, or _unread
+        # if it was deleted without being read
+        self.loaded = loaded
+        # update functions called on the session, to replay on a conflict
+        self.updates = []
+        # json of the session after the last update function, None if it
+        # has been changed in any other way
+        self.replayable = None if loaded is _unread else loaded or "{}"
+
+
+def register_upgrade(from_version, fn):
+    """
+    Registers a function that upgrades sessions written with schema version
+    from_version to the next version, and makes the current version at
+    least from_version + 1. fn may change the session in place and return
+    None, or return a new session.
+    """
+    _upgrades[from_version] = fn
+    codec.version = max(codec.version, from_version + 1)
+
+
+def set_store(store):
+    """
+    Replaces the session store with store, a platform.stores.Store, which
+    should be created with codec=sessions.codec so that sessions are
+    versioned. Stores that don't support versioned writes, like a
+    SqliteFieldStore, are a configuration error.
+    """
+    global _store
+    if store is not None and not store.versioned:
+        raise Exception("Session store {} doesn't support versioned writes; set sessionStore to sqlite, memory or dynamodb".format(
+            type(store).__name__))
+    _store = store
+
+
+def _get_store():
+    """
+    Returns the session store, opening it from the settings on first use.
+    """
+    if _store is None:
+        backend = settings.get("sessionStore", "sqlite")
+        if backend == "sqlite":
+            set_store(stores.SqliteStore(settings.get("sessionStorePath", "/tmp/sessions.db"), table="sessions", codec=codec))
+        elif backend == "dynamodb":
+            set_store(stores.DynamoStore(settings.get("sessionTable", "sessions"),
+                endpoint_url=settings.get("sessionStoreEndpoint") or None, codec=codec))
+        else:
+            set_store(stores.make_store(backend, codec=codec))
+    return _store
+
+
+def _timed(store, operation):
+    return metrics.timed("sessions.{}.{}".format(store.kind or type(store).__name__, operation))
+
+
+@contextlib.contextmanager
+def unit_of_work():
+    """
+    Context manager that buffers session reads and writes on this thread
+    until the block ends, then writes back the sessions that changed. If
+    the block raises the changes are discarded. Nested blocks join the
+    outermost one.
+    """
+    if getattr(_local, "work", None) is not None:
+        yield
+        return
+    _local.work = {}
+    try:
+        yield
+        work = _local.work
+    finally:
+        _local.work = None
+    _flush(work)
+    _maybe_sweep()
+
+
+def _flush(work):
+    """
+    Writes back the sessions of a unit of work that were changed or deleted.
+    A session counts as changed if its json differs from what was read, so
+    changes made in place are found without the bot calling put(). Empty
+    sessions are deleted, since get() returns an empty one for a user with
+    none. Raises an exception after writing the rest if a session could not
+    be written within the retries, or was written by someone else and can't
+    be replayed.
+    """
+    deleted = []
+    failed = []
+    for (user_id, buffered) in work.items():
+        session = buffered.session
+        if not session:
+            if buffered.loaded is not None:
+                deleted.append(user_id)
+            continue
+        dumped = json.dumps(session, sort_keys=True)
+        if dumped == buffered.loaded:
+            continue
+        try:
+            if dumped == buffered.replayable:
+                _write_versioned(user_id, session, buffered.version, buffered.updates)
+            elif not _write_versioned(user_id, session, buffered.version, None):
+                logger.error("Session for {} was written by someone else and can't be replayed".format(user_id))
+                failed.append(user_id)
+        except Exception as e:
+            logger.error("Failed to write session for {}: {}".format(user_id, e))
+            failed.append(user_id)
+    store = _get_store() if deleted else None
+    if deleted:
+        with _timed(store, "delete_many"):
+            store.delete_many(deleted)
+    if failed:
+        raise Exception("409 Conflict; failed to write sessions for {}".format(", ".join(failed)))
+
+
+def sweep():
+    """
+    Removes expired sessions from the store. Returns the number removed.
+    """
+    store = _get_store()
+    if store.native_ttl:
+        return 0
+    with _timed(store, "sweep"):
+        removed = store.sweep()
+    metrics.incr("sessions.expired", removed)
+    return removed
+
+
+def _maybe_sweep():
+    """
+    Calls sweep() if it has not been called for "sessionSweepInterval"
+    seconds. Errors are logged, they shouldn't fail the callback.
+    """
+    global _last_sweep
+    if not _ttl or not _sweep_interval:
+        return
+    with _sweep_lock:
+        if time.time() - _last_sweep < _sweep_interval:
+            return
+        _last_sweep = time.time()
+    try:
+        sweep()
+    except Exception as e:
+        logger.error("Session sweep failed: {}".format(e))
+
+
+def _read(user_id):
+    """
+    Returns the session of a user and its version.
+    """
+    store = _get_store()
+    with _timed(store, "get"):
+        return store.get_versioned(user_id)
+
+
+def _write(user_id, session):
+    store = _get_store()
+    with _timed(store, "put"):
+        store.put(user_id, session, _ttl)
+
+
+def _apply(session, updates):
+    for fn in updates:
+        result = fn(session)
+        if result is not None:
+            session = result
+    return session
+
+
+def _write_versioned(user_id, session, version, updates):
+    """
+    Writes session if the stored version is still version. On a conflict,
+    if updates is a list of update functions, reads the session again,
+    applies them to it, and tries again, up to "sessionMaxRetries" times.
+    Returns the session written, or None on a conflict when updates is None.
+    """
+    store = _get_store()
+    retries = settings.get("sessionMaxRetries", 3)
+    while True:
+        metrics.incr("sessions.conditional_writes")
+        with _timed(store, "put_if"):
+            if store.put_if(user_id, session, version, _ttl):
+                return session
+        metrics.incr("sessions.conflicts")
+        if updates is None:
+            return None
+        if retries <= 0:
+            raise Exception("409 Conflict; session for {} kept changing".format(user_id))
+        retries -= 1
+        (session, version) = _read(user_id)
+        session = _apply(session if session is not None else {}, updates)
+
+
+def get(user_id):
+    """
+    Returns the session of a user, or an empty dictionary if there is none.
+    Params:
+        user_id: the page-scoped user id
+    """
+    user_id = str(user_id)
+    work = getattr(_local, "work", None)
+    if work is None:
+        session = _read(user_id)[0]
+        return session if session is not None else {}
+    buffered = work.get(user_id)
+    if buffered is None:
+        (session, version) = _read(user_id)
+        buffered = work[user_id] = _Buffered(session, version,
+            json.dumps(session, sort_keys=True) if session is not None else None)
+    if buffered.session is None:
+        buffered.session = {}
+    return buffered.session
+
+
+def put(user_id, session):
+    """
+    Stores the session of a user, replacing any existing one. Inside a unit
+    of work the version of the existing one is read first, if it hasn't
+    been, and the session is only written if no one else writes it before
+    the unit of work ends.
+    Params:
+        user_id: the page-scoped user id
+        session: dictionary of values that can be serialized as json
+    """
+    user_id = str(user_id)
+    work = getattr(_local, "work", None)
+    if work is None:
+        _write(user_id, session)
+        return
+    if user_id not in work or work[user_id].loaded is _unread:
+        (current, version) = _read(user_id)
+        work[user_id] = _Buffered(current, version, json.dumps(current, sort_keys=True) if current is not None else None)
+    work[user_id].session = session
+    work[user_id].replayable = None
+
+
+def update(user_id, fn):
+    """
+    Reads the session of a user, passes it to fn, and stores the result.
+    fn may change the session in place and return None, or return a new
+    session. If the session is written by someone else in the meantime, fn
+    is called again on the new session, so it should not have other side
+    effects. Returns the stored session.
+    Params:
+        user_id: the page-scoped user id
+        fn: callable taking the session dictionary
+    """
+    user_id = str(user_id)
+    work = getattr(_local, "work", None)
+    if work is None:
+        (session, version) = _read(user_id)
+        session = _apply(session if session is not None else {}, [fn])
+        return _write_versioned(user_id, session, version, [fn])
+    session = get(user_id)
+    buffered = work[user_id]
+    if buffered.replayable is not None and buffered.replayable != json.dumps(session, sort_keys=True):
+        buffered.replayable = None
+    session = buffered.session = _apply(session, [fn])
+    buffered.updates.append(fn)
+    if buffered.replayable is not None:
+        buffered.replayable = json.dumps(session, sort_keys=True)
+    return session
+
+
+def delete(user_id):
+    """
+    Removes the session of a user, if any.
+    Params:
+        user_id: the page-scoped user id
+    """
+    user_id = str(user_id)
+    work = getattr(_local, "work", None)
+    if work is None:
+        store = _get_store()
+        with _timed(store, "delete"):
+            store.delete(user_id)
+    elif user_id in work:
+        work[user_id].session = None
+        work[user_id].replayable = None
+    else:
+        work[user_id] = _Buffered(None, None, _unread)
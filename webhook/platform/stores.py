@@ -0,0 +1,620 @@
+from serialization import JsonCodec
+import heapq
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+logger = logging.getLogger()
+
+
+class Store(object):
+    """
+    The interface for the key-value stores used to persist platform data.
+    Keys are strings and values are anything that can be serialized as
+    json. Values are serialized by the store's codec, JsonCodec unless
+    another from platform.serialization is passed to the constructor. A
+    store may be shared by several containers, so callers should not assume
+    that a value they put is the value they get back.
+
+    Every write stamps the value with a new version, a random token, so
+    that callers can read a value with get_versioned() and write it back
+    with put_if() only if no one else has written it in between. Stores
+    that can't do this set versioned to False.
+    """
+    kind = None
+    codec = JsonCodec()
+    native_ttl = False
+    versioned = True
+
+    def get(self, key):
+        """
+        Returns the value stored under key, or None if there is none or it
+        has expired.
+        """
+        raise NotImplementedError()
+
+    def put(self, key, value, ttl=None):
+        """
+        Stores value under key, replacing any existing value.
+        Params:
+            ttl: optional, seconds the value stays valid, None for no expiry
+        """
+        raise NotImplementedError()
+
+    def get_versioned(self, key):
+        """
+        Returns a tuple of the value stored under key and its version. The
+        value is None if there is none or it has expired, and the version
+        is None if nothing has ever been stored under key.
+        """
+        raise NotImplementedError()
+
+    def put_if(self, key, value, version, ttl=None):
+        """
+        Stores value under key only if the version stored under key is still
+        version, as returned by get_versioned(). Returns True if the value
+        was stored and False if someone else has written it since.
+        Params:
+            ttl: optional, seconds the value stays valid, None for no expiry
+        """
+        raise NotImplementedError()
+
+    def put_many(self, items, ttl=None):
+        """
+        Stores several values at once, as few round trips as the backend
+        allows.
+        Params:
+            items: dictionary of values keyed by key
+            ttl: optional, seconds the values stay valid, None for no expiry
+        """
+        for (key, value) in items.items():
+            self.put(key, value, ttl)
+
+    def update_fields(self, key, changes, removals=(), ttl=None):
+        """
+        Sets and removes fields of the dictionary stored under key, which is
+        created if there is none, as one atomic write, without the caller
+        reading and writing back the whole dictionary. Returns the updated
+        dictionary. Only DynamoStore and SqliteFieldStore write just the
+        fields that change. This default, like MemoryStore and SqliteStore,
+        reads and writes back the whole dictionary, though atomically.
+        Params:
+            changes: dictionary of the fields to set and their values
+            removals: optional, names of the fields to remove
+            ttl: optional, seconds the value stays valid, None for no expiry
+        """
+        document = self.get(key) or {}
+        document.update(changes)
+        for field in removals:
+            document.pop(field, None)
+        self.put(key, document, ttl)
+        return document
+
+    def delete(self, key):
+        """
+        Removes the value stored under key, if any.
+        """
+        raise NotImplementedError()
+
+    def delete_many(self, keys):
+        """
+        Removes the values stored under several keys at once.
+        """
+        for key in keys:
+            self.delete(key)
+
+    def clear(self):
+        """
+        Removes all values from the store.
+        """
+        raise NotImplementedError()
+
+    def sweep(self):
+        """
+        Removes expired values from the store, in time proportional to the
+        number removed rather than the size of the store. Returns the number
+        removed. Stores that expire values natively set native_ttl and do
+        nothing here.
+        """
+        return 0
+
+
+class ExpiryIndex(object):
+    """
+    A timing wheel of keys by expiry time. Keys are kept in buckets of
+    resolution seconds, and the buckets in a heap by time, so finding the
+    keys that have expired only looks at the buckets that have ended. A
+    key rewritten with a new expiry time stays in its old bucket as well,
+    so callers must check the keys they get back. Not thread-safe.
+    Params:
+        resolution: optional, seconds covered by each bucket
+    """
+    def __init__(self, resolution=60):
+        self.resolution = resolution
+        self._buckets = {}
+        self._heap = []
+
+    def __len__(self):
+        return sum(len(keys) for keys in self._buckets.values())
+
+    def add(self, key, expires):
+        """
+        Adds key to the bucket for expiry time expires.
+        """
+        bucket = int(expires // self.resolution)
+        keys = self._buckets.get(bucket)
+        if keys is None:
+            keys = self._buckets[bucket] = set()
+            heapq.heappush(self._heap, bucket)
+        keys.add(key)
+
+    def pop_expired(self, now):
+        """
+        Removes and returns the keys in all the buckets that ended at or
+        before now.
+        """
+        expired = []
+        end = int(now // self.resolution)
+        while self._heap and self._heap[0] < end:
+            expired.extend(self._buckets.pop(heapq.heappop(self._heap)))
+        return expired
+
+    def clear(self):
+        self._buckets.clear()
+        del self._heap[:]
+
+
+class MemoryStore(Store):
+    """
+    A store held in a dict in this process. Mostly useful for testing.
+    """
+    kind = "memory"
+
+    def __init__(self, codec=None):
+        self.codec = codec or self.codec
+        self._items = {}
+        self._expiry = ExpiryIndex()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.get_versioned(key)[0]
+
+    def get_versioned(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return (None, None)
+            if item[1] is not None and item[1] <= time.time():
+                return (None, item[2])
+        return (self.codec.decode(item[0]), item[2])
+
+    def _item(self, value, ttl):
+        # stored serialized so that callers can't modify stored values
+        return (self.codec.encode(value), time.time() + ttl if ttl is not None else None, uuid.uuid4().hex)
+
+    def _set(self, key, item):
+        self._items[key] = item
+        if item[1] is not None:
+            self._expiry.add(key, item[1])
+
+    def put(self, key, value, ttl=None):
+        item = self._item(value, ttl)
+        with self._lock:
+            self._set(key, item)
+
+    def put_if(self, key, value, version, ttl=None):
+        item = self._item(value, ttl)
+        with self._lock:
+            current = self._items.get(key)
+            if (current[2] if current is not None else None) != version:
+                return False
+            self._set(key, item)
+            return True
+
+    def update_fields(self, key, changes, removals=(), ttl=None):
+        with self._lock:
+            item = self._items.get(key)
+            expired = item is None or (item[1] is not None and item[1] <= time.time())
+            document = self.codec.decode(item[0]) if not expired else {}
+            document.update(changes)
+            for field in removals:
+                document.pop(field, None)
+            self._set(key, self._item(document, ttl))
+        return document
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._expiry.clear()
+
+    def sweep(self):
+        now = time.time()
+        removed = 0
+        with self._lock:
+            for key in self._expiry.pop_expired(now):
+                item = self._items.get(key)
+                # skips keys rewritten since, with a later or no expiry
+                if item is not None and item[1] is not None and item[1] <= now:
+                    del self._items[key]
+                    removed += 1
+        return removed
+
+
+class SqliteStore(Store):
+    """
+    A store kept in a table of a local sqlite database file. Under lambda
+    the file should be placed in /tmp, which survives while the container
+    is reused.
+    Params:
+        path: the database file, created if it does not exist
+        table: optional, name of the table, allowing several stores to
+            share a database file
+        codec: optional, the codec values are serialized with
+    """
+    kind = "sqlite"
+
+    def __init__(self, path, table="store", codec=None):
+        self.codec = codec or self.codec
+        self.path = path
+        self.table = table
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._create_table()
+        self._db.execute("CREATE INDEX IF NOT EXISTS {0}_expires ON {0} (expires)".format(table))
+
+    def _create_table(self):
+        self._db.execute("CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL, version TEXT)".format(self.table))
+        # tables created before values were versioned
+        if "version" not in [column[1] for column in self._db.execute("PRAGMA table_info({})".format(self.table))]:
+            self._db.execute("ALTER TABLE {} ADD COLUMN version TEXT".format(self.table))
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT value, expires FROM {} WHERE key = ?".format(self.table), (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] <= time.time():
+                self._db.execute("DELETE FROM {} WHERE key = ?".format(self.table), (key,))
+                return None
+        return self._decode(row[0])
+
+    def get_versioned(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT value, expires, version FROM {} WHERE key = ?".format(self.table), (key,)).fetchone()
+        if row is None:
+            return (None, None)
+        if row[1] is not None and row[1] <= time.time():
+            return (None, row[2])
+        return (self._decode(row[0]), row[2])
+
+    def _encode(self, value):
+        data = self.codec.encode(value)
+        return sqlite3.Binary(data) if self.codec.binary else data
+
+    def _decode(self, data):
+        # blobs come back as buffers, text written by another codec as unicode
+        if self.codec.binary and not isinstance(data, bytes):
+            data = data.encode("utf-8") if isinstance(data, type(u"")) else bytes(data)
+        return self.codec.decode(data)
+
+    def put(self, key, value, ttl=None):
+        value = self._encode(value)
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO {} (key, value, expires, version) VALUES (?, ?, ?, ?)".format(self.table),
+                (key, value, expires, uuid.uuid4().hex))
+
+    def put_if(self, key, value, version, ttl=None):
+        value = self._encode(value)
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            # IS matches a NULL version, left by tables from before versions
+            updated = self._db.execute("UPDATE {} SET value = ?, expires = ?, version = ? WHERE key = ? AND version IS ?".format(self.table),
+                (value, expires, uuid.uuid4().hex, key, version)).rowcount
+            if not updated and version is None:
+                updated = self._db.execute("INSERT OR IGNORE INTO {} (key, value, expires, version) VALUES (?, ?, ?, ?)".format(self.table),
+                    (key, value, expires, uuid.uuid4().hex)).rowcount
+        return updated == 1
+
+    def put_many(self, items, ttl=None):
+        expires = time.time() + ttl if ttl is not None else None
+        rows = [(key, self._encode(value), expires, uuid.uuid4().hex) for (key, value) in items.items()]
+        with self._lock:
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany("INSERT OR REPLACE INTO {} (key, value, expires, version) VALUES (?, ?, ?, ?)".format(self.table), rows)
+
+    def update_fields(self, key, changes, removals=(), ttl=None):
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            with self._db:
+                # takes the write lock before reading, so other connections
+                # to the file can't write in between
+                self._db.execute("BEGIN IMMEDIATE")
+                row = self._db.execute("SELECT value, expires FROM {} WHERE key = ?".format(self.table), (key,)).fetchone()
+                expired = row is None or (row[1] is not None and row[1] <= time.time())
+                document = self._decode(row[0]) if not expired else {}
+                document.update(changes)
+                for field in removals:
+                    document.pop(field, None)
+                self._db.execute("INSERT OR REPLACE INTO {} (key, value, expires, version) VALUES (?, ?, ?, ?)".format(self.table),
+                    (key, self._encode(document), expires, uuid.uuid4().hex))
+        return document
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute("DELETE FROM {} WHERE key = ?".format(self.table), (key,))
+
+    def delete_many(self, keys):
+        with self._lock:
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany("DELETE FROM {} WHERE key = ?".format(self.table), [(key,) for key in keys])
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM {}".format(self.table))
+
+    def sweep(self):
+        # a range scan of the index on expires, so only expired rows are visited
+        with self._lock:
+            return self._db.execute("DELETE FROM {} WHERE expires IS NOT NULL AND expires <= ?".format(self.table),
+                (time.time(),)).rowcount
+
+
+class SqliteFieldStore(SqliteStore):
+    """
+    A sqlite store for dictionaries that keeps each field in its own row,
+    keyed by key and field name, so update_fields() writes only the rows of
+    the fields it sets and removes, and get_field() reads a single row.
+    Reading a whole dictionary reads all of its rows. A ttl applies to the
+    fields written with it. Values are not versioned, so get_versioned()
+    and put_if() are not supported.
+    Params:
+        path: the database file, created if it does not exist
+        table: optional, name of the table, allowing several stores to
+            share a database file
+        codec: optional, the codec field values are serialized with
+    """
+    versioned = False
+
+    def __init__(self, path, table="fields", codec=None):
+        SqliteStore.__init__(self, path, table, codec)
+
+    def _create_table(self):
+        self._db.execute("CREATE TABLE IF NOT EXISTS {} (key TEXT NOT NULL, field TEXT NOT NULL, value TEXT NOT NULL, expires REAL, "
+            "PRIMARY KEY (key, field))".format(self.table))
+
+    def _read(self, key):
+        rows = self._db.execute("SELECT field, value FROM {} WHERE key = ? AND (expires IS NULL OR expires > ?)".format(self.table),
+            (key, time.time())).fetchall()
+        return dict((field, self._decode(value)) for (field, value) in rows)
+
+    def get(self, key):
+        with self._lock:
+            return self._read(key) or None
+
+    def get_field(self, key, field, default=None):
+        """
+        Returns the value of one field of the dictionary stored under key,
+        or default if it is not set.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT value FROM {} WHERE key = ? AND field = ? AND (expires IS NULL OR expires > ?)".format(self.table),
+                (key, field, time.time())).fetchone()
+        return self._decode(row[0]) if row is not None else default
+
+    def get_versioned(self, key):
+        raise NotImplementedError()
+
+    def put_if(self, key, value, version, ttl=None):
+        raise NotImplementedError()
+
+    def _write(self, key, changes, removals, ttl):
+        expires = time.time() + ttl if ttl is not None else None
+        self._db.executemany("INSERT OR REPLACE INTO {} (key, field, value, expires) VALUES (?, ?, ?, ?)".format(self.table),
+            [(key, field, self._encode(value), expires) for (field, value) in changes.items()])
+        self._db.executemany("DELETE FROM {} WHERE key = ? AND field = ?".format(self.table), [(key, field) for field in removals])
+
+    def put(self, key, value, ttl=None):
+        with self._lock:
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.execute("DELETE FROM {} WHERE key = ?".format(self.table), (key,))
+                self._write(key, value, (), ttl)
+
+    def put_many(self, items, ttl=None):
+        with self._lock:
+            with self._db:
+                self._db.execute("BEGIN")
+                for (key, value) in items.items():
+                    self._db.execute("DELETE FROM {} WHERE key = ?".format(self.table), (key,))
+                    self._write(key, value, (), ttl)
+
+    def update_fields(self, key, changes, removals=(), ttl=None):
+        with self._lock:
+            with self._db:
+                self._db.execute("BEGIN")
+                self._write(key, changes, removals, ttl)
+                # read back in the same transaction, so no other write comes between
+                return self._read(key)
+
+
+class DynamoStore(Store):
+    """
+    A store kept in a DynamoDB table, shared by all containers. The table
+    has a string hash key named "key", and values are stored in the
+    attribute "value", a string or, with a binary codec, a binary, with
+    their version in "version". The optional "expires" attribute holds the
+    expiry time in epoch seconds, so it can be used as the table's native
+    TTL attribute, see enable_native_ttl(); DynamoDB deletes expired items
+    lazily, so they are also checked on read. put_if() is a conditional
+    put_item.
+
+    update_fields() keeps each field of the dictionary in its own attribute,
+    named "field.<name>", so that it can set and remove fields with a single
+    update_item. Items written that way have no "value" attribute, and are
+    read back as the dictionary of their fields.
+    Params:
+        table: name of the table
+        client: optional, a boto3 DynamoDB client or anything with the same
+            get_item, put_item, update_item, delete_item, batch_write_item
+            and scan methods, by default a
+            boto3 client is created
+        endpoint_url: optional, passed to boto3 when creating the client, to
+            use a local stand-in such as DynamoDB Local
+        codec: optional, the codec values are serialized with
+    """
+    kind = "dynamodb"
+    native_ttl = True
+
+    def __init__(self, table, client=None, endpoint_url=None, codec=None):
+        self.codec = codec or self.codec
+        self.table = table
+        if client is None:
+            import boto3
+            client = boto3.client("dynamodb", endpoint_url=endpoint_url)
+        self._client = client
+
+    def get(self, key):
+        return self.get_versioned(key)[0]
+
+    def get_versioned(self, key):
+        item = self._client.get_item(TableName=self.table, Key={"key": {"S": key}}, ConsistentRead=True).get("Item")
+        if item is None:
+            return (None, None)
+        version = item["version"]["S"] if "version" in item else None
+        if "expires" in item and float(item["expires"]["N"]) <= time.time():
+            return (None, version)
+        if "value" not in item:
+            return (self._fields(item), version)
+        return (self._decode(item["value"]), version)
+
+    def _encode(self, value):
+        return {"B" if self.codec.binary else "S": self.codec.encode(value)}
+
+    def _decode(self, attribute):
+        return self.codec.decode(attribute["B"] if "B" in attribute else attribute["S"])
+
+    def _fields(self, item):
+        return dict((name[6:], self._decode(attribute)) for (name, attribute) in item.items() if name.startswith("field."))
+
+    def _item(self, key, value, ttl):
+        item = {
+            "key": {"S": key},
+            "value": self._encode(value),
+            "version": {"S": uuid.uuid4().hex}
+        }
+        if ttl is not None:
+            item["expires"] = {"N": str(int(time.time() + ttl))}
+        return item
+
+    def put(self, key, value, ttl=None):
+        self._client.put_item(TableName=self.table, Item=self._item(key, value, ttl))
+
+    def put_if(self, key, value, version, ttl=None):
+        kwargs = {"ExpressionAttributeNames": {"#v": "version"}}
+        if version is None:
+            kwargs["ConditionExpression"] = "attribute_not_exists(#v)"
+        else:
+            kwargs["ConditionExpression"] = "#v = :v"
+            kwargs["ExpressionAttributeValues"] = {":v": {"S": version}}
+        try:
+            self._client.put_item(TableName=self.table, Item=self._item(key, value, ttl), **kwargs)
+            return True
+        except Exception as e:
+            # botocore's ClientError, without importing botocore
+            if getattr(e, "response", {}).get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+                return False
+            raise
+
+    def put_many(self, items, ttl=None):
+        self._write_batches([{"PutRequest": {"Item": self._item(key, value, ttl)}} for (key, value) in items.items()])
+
+    def update_fields(self, key, changes, removals=(), ttl=None):
+        names = {"#version": "version"}
+        values = {":version": {"S": uuid.uuid4().hex}}
+        sets = ["#version = :version"]
+        for (n, (field, value)) in enumerate(changes.items()):
+            names["#s{}".format(n)] = "field." + field
+            values[":s{}".format(n)] = self._encode(value)
+            sets.append("#s{0} = :s{0}".format(n))
+        if ttl is not None:
+            names["#expires"] = "expires"
+            values[":expires"] = {"N": str(int(time.time() + ttl))}
+            sets.append("#expires = :expires")
+        expression = "SET " + ", ".join(sets)
+        if removals:
+            for (n, field) in enumerate(removals):
+                names["#r{}".format(n)] = "field." + field
+            expression += " REMOVE " + ", ".join("#r{}".format(n) for n in range(len(removals)))
+        response = self._client.update_item(TableName=self.table, Key={"key": {"S": key}}, UpdateExpression=expression,
+            ExpressionAttributeNames=names, ExpressionAttributeValues=values, ReturnValues="ALL_NEW")
+        return self._fields(response["Attributes"])
+
+    def delete(self, key):
+        self._client.delete_item(TableName=self.table, Key={"key": {"S": key}})
+
+    def delete_many(self, keys):
+        self._write_batches([{"DeleteRequest": {"Key": {"key": {"S": key}}}} for key in keys])
+
+    def _write_batches(self, requests):
+        """
+        Sends write requests with batch_write_item, 25 at a time, which is
+        the most DynamoDB accepts, resending any it reports as unprocessed.
+        """
+        for start in range(0, len(requests), 25):
+            pending = {self.table: requests[start:start + 25]}
+            while pending:
+                pending = self._client.batch_write_item(RequestItems=pending).get("UnprocessedItems")
+
+    def enable_native_ttl(self):
+        """
+        Turns on DynamoDB's own expiry of items on the "expires" attribute.
+        Only needs to be called once for a table, for example when it is
+        created.
+        """
+        self._client.update_time_to_live(TableName=self.table,
+            TimeToLiveSpecification={"Enabled": True, "AttributeName": "expires"})
+
+    def clear(self):
+        # scans the whole table, only meant for tests and maintenance
+        kwargs = {"TableName": self.table, "ProjectionExpression": "#k", "ExpressionAttributeNames": {"#k": "key"}}
+        while True:
+            response = self._client.scan(**kwargs)
+            for item in response.get("Items", []):
+                self._client.delete_item(TableName=self.table, Key={"key": item["key"]})
+            if "LastEvaluatedKey" not in response:
+                break
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def make_store(backend, **options):
+    """
+    Returns a new store of the named type: "memory", "sqlite", "sqlite_fields"
+    or "dynamodb".
+    Any other options are passed to the store's constructor.
+    """
+    if backend == "memory":
+        return MemoryStore(**options)
+    elif backend == "sqlite":
+        return SqliteStore(**options)
+    elif backend == "sqlite_fields":
+        return SqliteFieldStore(**options)
+    elif backend == "dynamodb":
+        return DynamoStore(**options)
+    else:
+        raise Exception("Unknown store backend: {}".format(backend))
@@ -1,4 +1,9 @@
+from config import settings
 import logging
+import metrics
+import random
+import threading
+import time
 
 
 logger = logging.getLogger()
@@ -40,175 +45,407 @@ def _raise_empty_value(property_path):
     _raise_bad_value(property_path, "cannot be 'None' or empty.")
 
 
-def _validate_button(button, base_property_path):
-    if not button:
-        _raise_empty_value(base_property_path)
-
-    if not "title" in button:
-        _raise_missing_property("{}.title".format(base_property_path))
-
-    if not button["title"]:
-        _raise_empty_value("{}.title".format(base_property_path))
-
-    if len(button["title"]) > _button_title_warn_len:
-        logger.warn("button title length of {} exceeds the recommended maximum of {}".format(
-            len(button["title"]), _button_title_warn_len))
-
-    if not "type" in button:
-        _raise_missing_property("{}.type".format(base_property_path))
-
-    if button["type"] == "web_url":
-        if not "url" in button:
-            _raise_missing_property("{}.url".format(base_property_path))
-
-        if not button["url"]:
-            _raise_empty_value("{}.url".format(base_property_path))
-
-    elif button["type"] == "postback":
-        if not "payload" in button:
-            _raise_missing_property("{}.payload".format(base_property_path))
-
-        if not button["payload"]:
-            _raise_empty_value("{}.payload".format(base_property_path))
-
-    else:
-        _raise_bad_value("{}.type".format(base_property_path), "must contain either 'web_url' or 'postback'")
-
-
-def _validate_element(element, base_property_path):
-    if not element:
-        _raise_empty_value(base_property_path)
-
-    if not "title" in element:
-        _raise_missing_property("{}.title".format(base_property_path))
-
-    if not element["title"]:
-        _raise_empty_value("{}.title".format(base_property_path))
-
-    if len(element["title"]) > _title_warn_len:
-        logger.warn("element title length of {} exceeds the recommended maximum of {}".format(
-            len(element["title"]), _title_warn_len))
-
-    if "subtitle" in element and len(element["subtitle"]) > _subtitle_warn_len:
-        logger.warn("element subtitle length of {} exceeds the recommended maximum of {}".format(
-            len(element["subtitle"]), _subtitle_warn_len))
-
-    if "buttons" in element:
-        if len(element["buttons"]) > _buttons_warn_count:
-            logger.warn("element button count of {} exceeds the recommended maximum of {}".format(
-                len(element["buttons"]), _buttons_warn_count))
-
-        for button in element["buttons"]:
-            _validate_button(button, "{}.button[]".format(base_property_path))
-
-
-def _validate_button_template(template, base_property_path):
-    if not "text" in template:
-        _raise_missing_property("{}.text".format(base_property_path))
-
-    if not template["text"]:
-        _raise_empty_value("{}.text".format(base_property_path))
-
-    if len(template["text"]) > _button_title_warn_len:
-        logger.warn("button title length of {} exceeds the recommended maximum of {}".format(
-            len(template["text"]), _button_title_warn_len))
-
-    if "buttons" in template:
-        if len(template["buttons"]) > _buttons_warn_count:
-            logger.warn("tmeplate button count of {} exceeds the recommended maximum of {}".format(
-                len(template["buttons"]), _buttons_warn_count))
-
-        for button in template["buttons"]:
-            _validate_button(button, "{}.button[]".format(base_property_path))
-
-
-
-def _validate_template(template, base_property_path):
-    if not "template_type" in template:
-        _raise_missing_property("{}.template_type".format(base_property_path))
-
-    if not template["template_type"]:
-        _raise_empty_value("{}.template_type".format(base_property_path))
-
-    if template["template_type"] == "button":
-        _validate_button_template(template, base_property_path)
-
-    elif template["template_type"] == "generic":
-        if not "elements" in template:
-            _raise_missing_property("{}.elements".format(base_property_path))
-
-        if not template["elements"]:
-            _raise_empty_value("{}.elements".format(base_property_path))
-
-        if len(template["elements"]) > _elements_warn_count:
-            logger.warn("tmeplate element count of {} exceeds the recommended maximum of {}".format(
-                len(template["elements"]), _elements_warn_count))
-
-        for element in template["elements"]:
-            _validate_element(element, "{}.elements[]".format(base_property_path))
-
-    else:
-        _raise_bad_value("{}.payload.template_type", "must contain either 'button' or 'generic'")
-
-
-def _validate_attachment(attachment, base_property_path):
-    if not attachment:
-        _raise_empty_value(base_property_path)
-
-    if not "payload" in attachment:
-        _raise_missing_property("{}.payload".format(base_property_path))
-
-    if not attachment["payload"]:
-        _raise_empty_value("{}.payload".format(base_property_path))
-
-    if not "type" in attachment:
-        _raise_missing_property("{}.type".format(base_property_path))
-
-    if not attachment["type"]:
-        _raise_empty_value("{}.type".format(base_property_path))
+"""
+Length warnings are aggregated rather than logged one by one. Each is
+counted under its template type and property path, and a single summary
+line is logged at most once every "validationWarningInterval" seconds,
+when a warning arrives or a callback has been handled after the interval
+has passed, so pending warnings are logged even if no more arrive. The
+details are available at any time from warning_stats().
+"""
+_warning_interval = settings.get("validationWarningInterval", 60)
+_warning_lock = threading.Lock()
+_warnings = {}
+_warnings_pending = {}
+_warnings_logged = time.time()
+
+
+def _warn(template, property_path, description, count, limit):
+    with _warning_lock:
+        key = (template, property_path)
+        stats = _warnings.get(key)
+        if stats is None:
+            stats = _warnings[key] = {
+                "template": template,
+                "property": property_path,
+                "description": description,
+                "limit": limit,
+                "count": 0,
+                "max": 0
+            }
+        stats["count"] += 1
+        stats["max"] = max(stats["max"], count)
+        _warnings_pending[key] = _warnings_pending.get(key, 0) + 1
+    metrics.incr("validation.outbound.warnings")
+    log_warning_summary_if_due()
+
+
+def log_warning_summary_if_due():
+    """
+    Logs the warning summary if there are warnings pending and the summary
+    interval has passed since the last one. Called when warnings occur, and
+    by handlers.dispatch() after every callback.
+    """
+    with _warning_lock:
+        due = _warnings_pending and time.time() - _warnings_logged >= _warning_interval
+    if due:
+        log_warning_summary()
+
+
+def log_warning_summary():
+    """
+    Logs one line summarizing the length warnings counted since the last
+    summary, if there were any.
+    """
+    global _warnings_logged
+    with _warning_lock:
+        pending = sorted(_warnings_pending.items())
+        _warnings_pending.clear()
+        elapsed = time.time() - _warnings_logged
+        _warnings_logged = time.time()
+        summary = "; ".join("{template} {property} {description} x{pending} (max {max}, recommended {limit})".format(
+            pending=count, **_warnings[key]) for (key, count) in pending)
+    if summary:
+        logger.warn("{} message length warnings in the last {:.0f}s: {}".format(
+            sum(count for (key, count) in pending), elapsed, summary))
+
+
+def warning_stats():
+    """
+    Returns a list of the length warnings counted since the last reset,
+    one dictionary per template type and property with the keys:
+    template, property, description, limit, count and max (the largest
+    length or count seen).
+    """
+    with _warning_lock:
+        return [dict(stats) for (key, stats) in sorted(_warnings.items())]
+
+
+def reset_warning_stats():
+    """
+    Clears the length warning counters.
+    """
+    with _warning_lock:
+        _warnings.clear()
+        _warnings_pending.clear()
 
-    if attachment["type"] == "image":
-        if not "url" in attachment["payload"]:
-            _raise_missing_property("{}.payload.url".format(base_property_path))
 
-        if not attachment["payload"]["url"]:
-            _raise_empty_value("{}.payload.url".format(base_property_path))
+"""
+The outbound message schema. A node is a tuple of checks that are applied in
+order to one object, and each check is a tuple whose first item names its
+kind:
+
+    ("nonempty",)                   the object itself must not be empty
+    ("present", key)                key must be in the object
+    ("required", key)               key must be in the object and not empty
+    ("warn", key, limit, desc)      count a warning if len(object[key])
+                                    exceeds limit
+    ("child", key, node)            apply node to object[key]
+    ("each", key, suffix, node)     apply node to each item in object[key]
+    ("oneof", cases, path, desc)    apply the node paired with the first key
+                                    in cases that is in the object
+    ("switch", key, cases, path, desc)
+                                    apply the node that cases maps the value
+                                    of object[key] to, to the object itself
+
+In 'path' the string "{path}" is replaced by the property path of the object.
+A 'path' or 'desc' is used to report an error when no case matches.
+"""
+_button_schema = (
+    ("nonempty",),
+    ("required", "title"),
+    ("warn", "title", _button_title_warn_len, "button title length"),
+    ("present", "type"),
+    ("switch", "type", {
+        "web_url": (("required", "url"),),
+        "postback": (("required", "payload"),)
+    }, "{path}.type", "must contain either 'web_url' or 'postback'")
+)
+
+_element_schema = (
+    ("nonempty",),
+    ("required", "title"),
+    ("warn", "title", _title_warn_len, "element title length"),
+    ("warn", "subtitle", _subtitle_warn_len, "element subtitle length"),
+    ("warn", "buttons", _buttons_warn_count, "element button count"),
+    ("each", "buttons", "button[]", _button_schema)
+)
+
+_template_schema = (
+    ("required", "template_type"),
+    ("switch", "template_type", {
+        "button": (
+            ("required", "text"),
+            ("warn", "text", _button_title_warn_len, "button title length"),
+            ("warn", "buttons", _buttons_warn_count, "template button count"),
+            ("each", "buttons", "button[]", _button_schema)
+        ),
+        "generic": (
+            ("required", "elements"),
+            ("warn", "elements", _elements_warn_count, "template element count"),
+            ("each", "elements", "elements[]", _element_schema)
+        )
+    }, "{}.payload.template_type", "must contain either 'button' or 'generic'")
+)
+
+_attachment_schema = (
+    ("nonempty",),
+    ("required", "payload"),
+    ("required", "type"),
+    ("switch", "type", {
+        "image": (("child", "payload", (("required", "url"),)),),
+        "template": (("child", "payload", _template_schema),)
+    }, "$.message.attachment.type", "must contain either 'image' or 'template'")
+)
+
+_message_schema = (
+    ("nonempty",),
+    ("present", "recipient"),
+    ("child", "recipient", (
+        ("oneof", (
+            ("id", (("nonempty",),)),
+            ("phone_number", (("nonempty",),))
+        ), "$.message.recipient", "must contain either 'id' or 'phone_number'"),
+    )),
+    ("required", "message"),
+    ("child", "message", (
+        ("oneof", (
+            ("text", (("nonempty",),)),
+            ("attachment", _attachment_schema)
+        ), "$.message", "must contain either 'text' or 'attachment'"),
+    ))
+)
+
+
+class _Compiler(object):
+    """
+    Compiles the message schema into the source of a single Python function
+    with every check, loop and branch inlined. Property paths and other
+    values are emitted as literals, so the generated code only formats
+    strings when it reports a problem. Once a property has been looked up
+    its value is kept in a local variable, and checks that follow in the
+    same branch reuse it instead of testing and indexing again.
+    """
+    def __init__(self):
+        self.lines = []
+        self.names = 0
+        # (object variable, key) -> variable holding its value, for the
+        # properties known to be present in the branch being emitted
+        self.bound = {}
+        # key -> value, for the switch cases enclosing the code being emitted
+        self.cases = {}
+
+    def variable(self):
+        self.names += 1
+        return "_v{}".format(self.names)
+
+    def emit(self, indent, line):
+        self.lines.append("{}{}".format("    " * indent, line))
+
+    def bind(self, var, key, indent):
+        """
+        Returns the variable holding var[key], emitting the lookup if it
+        has not been bound in this branch yet.
+        """
+        value = self.bound.get((var, key))
+        if value is None:
+            value = self.variable()
+            self.emit(indent, "{} = {}[{!r}]".format(value, var, key))
+            self.bound[(var, key)] = value
+        return value
+
+    def branch(self, node, var, path, indent):
+        """
+        Emits node as the body of a branch. Values bound inside the branch
+        are not visible to the code that follows it.
+        """
+        bound = dict(self.bound)
+        self.node(node, var, path, indent)
+        self.emit(indent, "pass")
+        self.bound = bound
+
+    def node(self, node, var, path, indent):
+        for check in node:
+            self.check(check, var, path, indent)
+
+    def check(self, check, var, path, indent):
+        kind = check[0]
+        emit = self.emit
+
+        if kind == "nonempty":
+            emit(indent, "if not {}:".format(var))
+            emit(indent + 1, "_raise_empty_value({!r})".format(path))
+            return
+
+        key = check[1]
+        key_path = "{}.{}".format(path, key)
+
+        if kind in ("present", "required"):
+            if not (var, key) in self.bound:
+                emit(indent, "if not {!r} in {}:".format(key, var))
+                emit(indent + 1, "_raise_missing_property({!r})".format(key_path))
+            if kind == "required":
+                value = self.bind(var, key, indent)
+                emit(indent, "if not {}:".format(value))
+                emit(indent + 1, "_raise_empty_value({!r})".format(key_path))
+
+        elif kind == "warn":
+            limit, description = check[2:]
+            value = self.bound.get((var, key))
+            if value:
+                emit(indent, "if len({}) > {}:".format(value, limit))
+            else:
+                value = "{}[{!r}]".format(var, key)
+                emit(indent, "if {!r} in {} and len({}) > {}:".format(key, var, value, limit))
+            emit(indent + 1, "_warn({!r}, {!r}, {!r}, len({}), {})".format(
+                self.cases.get("template_type", "message"), key_path, description, value, limit))
+
+        elif kind == "child":
+            self.node(check[2], self.bind(var, key, indent), key_path, indent)
+
+        elif kind == "each":
+            suffix, node = check[2:]
+            item = self.variable()
+            value = self.bound.get((var, key))
+            if value:
+                emit(indent, "for {} in {}:".format(item, value))
+                self.branch(node, item, "{}.{}".format(path, suffix), indent + 1)
+            else:
+                emit(indent, "if {!r} in {}:".format(key, var))
+                emit(indent + 1, "for {} in {}[{!r}]:".format(item, var, key))
+                self.branch(node, item, "{}.{}".format(path, suffix), indent + 2)
+
+        elif kind == "oneof":
+            cases, error_path, description = check[1:]
+            for (n, (case_key, node)) in enumerate(cases):
+                emit(indent, "{} {!r} in {}:".format("elif" if n else "if", case_key, var))
+                bound = dict(self.bound)
+                self.node(node, self.bind(var, case_key, indent + 1), "{}.{}".format(path, case_key), indent + 1)
+                self.bound = bound
+            emit(indent, "else:")
+            emit(indent + 1, "_raise_bad_value({!r}, {!r})".format(error_path.replace("{path}", path), description))
+
+        elif kind == "switch":
+            cases, error_path, description = check[2:]
+            value = self.bind(var, key, indent)
+            for (n, (case_value, node)) in enumerate(sorted(cases.items())):
+                emit(indent, "{} {} == {!r}:".format("elif" if n else "if", value, case_value))
+                cases_outside = self.cases
+                self.cases = dict(cases_outside, **{key: case_value})
+                self.branch(node, var, path, indent + 1)
+                self.cases = cases_outside
+            emit(indent, "else:")
+            emit(indent + 1, "_raise_bad_value({!r}, {!r})".format(error_path.replace("{path}", path), description))
+
+        else:
+            raise Exception("Unknown schema check: {}".format(kind))
+
+    def compile(self, name, node, path):
+        """
+        Returns the function generated from node, validating an object at
+        the given property path.
+        """
+        self.emit(0, "def {}(message):".format(name))
+        self.node(node, "message", path, 1)
+        namespace = {
+            "_raise_missing_property": _raise_missing_property,
+            "_raise_bad_value": _raise_bad_value,
+            "_raise_empty_value": _raise_empty_value,
+            "_warn": _warn
+        }
+        source = "\n".join(self.lines)
+        exec(compile(source, "<{} schema>".format(name), "exec"), namespace)
+        return namespace[name]
+
+
+_validate_message = _Compiler().compile("validate_message", _message_schema, "$")
 
-    elif attachment["type"] == "template":
-        _validate_template(attachment["payload"], "{}.payload".format(base_property_path))
 
-    else:
-        _raise_bad_value("$.message.attachment.type", "must contain either 'image' or 'template'")
+def validate_message(message):
+    """
+    Validates that an outbound message is complete and well-formed and
+    raises an exception describing the first problem found if it is not.
+    """
+    _validate_message(message)
 
 
-def validate_message(message):
+"""
+The validation policy, set by the "validationMode" setting:
+
+    strict      every message is fully validated (the default)
+    sampled     "validationSamplePercent" percent of messages are fully
+                validated, the rest only get a cheap structural check
+    trusted     messages built from templates by platform.messages are not
+                validated, all others are fully validated
+
+In every mode a message that was fully validated when it was rendered
+(see messages.make_cached_message) is not validated again. Counters named
+validation.outbound.<mode>.<full|structural|skipped|violations> are kept
+in metrics.
+"""
+_validation_modes = ("strict", "sampled", "trusted")
+_validation_mode = None
+_sample_rate = None
+
+
+def set_validation_mode(mode, sample_percent=None):
+    """
+    Changes the validation policy for outbound messages.
+    Params:
+        mode: one of "strict", "sampled" or "trusted"
+        sample_percent: optional, percentage of messages fully validated in
+            "sampled" mode, defaults to the "validationSamplePercent" setting
+    """
+    global _validation_mode, _sample_rate
+    if not mode in _validation_modes:
+        raise Exception("Unknown validation mode: {}; must be one of {}".format(mode, ", ".join(_validation_modes)))
+    if sample_percent is None:
+        sample_percent = settings.get("validationSamplePercent", 10)
+    _validation_mode = mode
+    _sample_rate = sample_percent / 100.0
+
+
+set_validation_mode(settings.get("validationMode", "strict"))
+
+
+def _check_structure(message):
+    """
+    The cheap check used for unsampled messages in "sampled" mode. Only
+    verifies the top level shape of the message.
+    """
     if not message:
         _raise_empty_value("$")
-
-    if not "recipient" in message:
+    recipient = message.get("recipient")
+    if not recipient:
         _raise_missing_property("$.recipient")
-
-    if "id" in message["recipient"]:
-        if not message["recipient"]["id"]:
-            _raise_empty_value("$.recipient.id")
-
-    elif "phone_number" in message["recipient"]:
-        if not message["recipient"]["phone_number"]:
-            _raise_empty_value("$.recipient.phone_number")
-
-    else:
+    if not ("id" in recipient or "phone_number" in recipient):
         _raise_bad_value("$.message.recipient", "must contain either 'id' or 'phone_number'")
-
-    if not "message" in message:
+    content = message.get("message")
+    if not content:
         _raise_missing_property("$.message")
-
-    if not message["message"]:
-        _raise_empty_value("$.message")
-
-    if "text" in message["message"]:
-        if not message["message"]["text"]:
-            _raise_empty_value("$.message.text")
-    elif "attachment" in message["message"]:
-        _validate_attachment(message["message"]["attachment"], "$.message.attachment")
+    if not ("text" in content or "attachment" in content):
+        _raise_bad_value("$.message", "must contain either 'text' or 'attachment'")
+
+
+def check_message(message):
+    """
+    Validates an outbound message according to the validation policy, and
+    raises an exception describing the first problem found if it is not
+    valid. Called by messages.send_message before every send.
+    """
+    if getattr(message, "validated", False):
+        return
+    mode = _validation_mode
+    if mode == "trusted" and getattr(message, "rendered", False):
+        metrics.incr("validation.outbound.trusted.skipped")
+        return
+    if mode == "sampled" and random.random() >= _sample_rate:
+        check, validate = "structural", _check_structure
     else:
-        _raise_bad_value("$.message", "must contain either 'text' or 'attachment'")
\ No newline at end of file
+        check, validate = "full", _validate_message
+    metrics.incr("validation.outbound.{}.{}".format(mode, check))
+    try:
+        validate(message)
+    except Exception:
+        metrics.incr("validation.outbound.{}.violations".format(mode))
+        raise
@@ -0,0 +1,134 @@
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+
+"""
+Compares the keyword matcher against a naive scan that tests every phrase
+in turn, for a table of thousands of synthetic intents, and if numpy is
+installed the classifier scoring one message at a time against scoring
+webhook sized batches, and a backend with and without the result cache for
+traffic where most messages are a few common phrases. Run from the tests
+directory:
+
+    python bench_nlu.py [intents] [messages]
+
+Reports the time to build the matcher, and to train and load the
+classifier, and the messages matched per second by each.
+"""
+parent = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parent)
+
+
+# just importing this to set up the library paths
+import webhook
+
+import nlu
+from nlu import classifier, keywords
+
+
+words = ["account", "balance", "cancel", "delivery", "order", "pizza", "refund", "status", "store", "hours",
+    "open", "close", "price", "menu", "vegan", "coupon", "address", "phone", "email", "password", "reset",
+    "track", "parcel", "return", "size", "color", "stock", "gift", "card", "help", "agent", "human"]
+
+
+def make_table(count, rng):
+    table = {}
+    while len(table) < count:
+        phrase = " ".join(rng.choice(words) for n in range(rng.randint(1, 3)))
+        table["{} {}".format(phrase, len(table))] = "intent_{}".format(len(table) % 500)
+    return table
+
+
+def make_messages(count, table, rng):
+    phrases = list(table)
+    messages = []
+    for n in range(count):
+        text = " ".join(rng.choice(words) for n in range(rng.randint(3, 12)))
+        if n % 2:
+            text = "{}, {}!".format(text, rng.choice(phrases))
+        messages.append(text)
+    return messages
+
+
+def naive_parse(table, text):
+    text = u" {} ".format(nlu.normalize(text))
+    scores = {}
+    for (phrase, intent) in table:
+        if phrase in text:
+            scores[intent] = scores.get(intent, 0) + len(phrase) - 2
+    return max(scores, key=scores.get) if scores else None
+
+
+def rate(fn, messages):
+    start = time.time()
+    for text in messages:
+        fn(text)
+    return len(messages) / (time.time() - start)
+
+
+def batch_rate(fn, messages, batch_size):
+    start = time.time()
+    for n in range(0, len(messages), batch_size):
+        fn(messages[n:n + batch_size])
+    return len(messages) / (time.time() - start)
+
+
+def bench_classifier(table, messages):
+    examples = [(phrase, intent) for (phrase, intent) in table.items()]
+    start = time.time()
+    model = classifier.train(examples)
+    print("{} intents, {} examples, trained in {:.3f}s".format(len(model.intents), len(examples), time.time() - start))
+    path = tempfile.mkdtemp()
+    try:
+        model.save(os.path.join(path, "intents.nlu"))
+        start = time.time()
+        model = classifier.load(os.path.join(path, "intents.nlu"))
+        print("model file {} bytes, loaded in {:.4f}s".format(os.path.getsize(os.path.join(path, "intents.nlu")), time.time() - start))
+        print("{:<10} {:>12}".format("batch", "messages/s"))
+        print("{:<10} {:>12.0f}".format(1, rate(model.parse, messages[:max(1, len(messages) // 10)])))
+        for batch_size in (10, 100):
+            print("{:<10} {:>12.0f}".format(batch_size, batch_rate(model.classify_batch, messages, batch_size)))
+        return model
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_cache(backend, messages, rng):
+    common = ["hi", "hello", "menu", "help", "thanks", "ok", "yes", "no", "order status", "talk to a human"]
+    traffic = [rng.choice(common) if rng.random() < 0.8 else rng.choice(messages) for n in range(len(messages))]
+    nlu.set_backend(backend)
+    try:
+        print("{:<10} {:>12}".format("cache", "messages/s"))
+        print("{:<10} {:>12.0f}".format("off", batch_rate(backend.parse_batch, traffic, 10)))
+        print("{:<10} {:>12.0f}".format("on", batch_rate(nlu.parse_batch, traffic, 10)))
+        print("hit rate {:.2f}".format(nlu.cache_stats()["hit_rate"]))
+    finally:
+        nlu.set_backend(None)
+
+
+def main(intents, count):
+    logging.getLogger().setLevel(logging.ERROR)
+    rng = random.Random(42)
+    table = make_table(intents, rng)
+    messages = make_messages(count, table, rng)
+    start = time.time()
+    matcher = keywords.KeywordMatcher(table)
+    print("{} phrases, {} states, built in {:.3f}s".format(len(table), len(matcher), time.time() - start))
+    padded = [(u" {} ".format(nlu.normalize(phrase)), intent) for (phrase, intent) in table.items()]
+    print("{:<10} {:>12}".format("matcher", "messages/s"))
+    print("{:<10} {:>12.0f}".format("keywords", rate(matcher.parse, messages)))
+    print("{:<10} {:>12.0f}".format("naive", rate(lambda text: naive_parse(padded, text), messages[:max(1, count // 10)])))
+    if classifier.numpy is not None:
+        bench_cache(bench_classifier(table, messages), messages, rng)
+    else:
+        print("numpy is not installed, skipping the classifier")
+        bench_cache(matcher, messages, rng)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000, int(sys.argv[2]) if len(sys.argv) > 2 else 5000)
@@ -0,0 +1,72 @@
+import json
+import logging
+import os
+import sys
+import timeit
+
+
+"""
+Benchmarks the generated callback validator against the original
+hand-written one on large batched callbacks. Run from the tests directory:
+
+    python bench_postback_validation.py [iterations]
+"""
+parent = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parent)
+
+
+# just importing this to set up the library paths
+import webhook
+
+from handlers import validation
+import reference_postback_validation
+
+
+def make_envelope(n):
+    envelope = {
+        "sender": {"id": 983440235096641 + n},
+        "recipient": {"id": 1789953497899630},
+        "timestamp": 1461992777559 + n
+    }
+    kind = n % 4
+    if kind == 0:
+        envelope["message"] = {"mid": "mid.1461992777559:e8027b338d2b553b73", "seq": n + 1, "text": "Message {}".format(n)}
+    elif kind == 1:
+        envelope["message"] = {"mid": "mid.1461992777559:e8027b338d2b553b74", "seq": n + 1, "attachments": [
+            {"type": "image", "payload": {"url": "http://some.where/but_not_here.png"}}]}
+    elif kind == 2:
+        envelope["delivery"] = {"mids": ["mid.1461992777559:e8027b338d2b553b73"], "watermark": 1234567890, "seq": n + 1}
+    else:
+        envelope["postback"] = {"payload": "SOME POSTBACK DATA HERE"}
+    return envelope
+
+
+def make_callback(entries, envelopes):
+    return {
+        "object": "page",
+        "entry": [{
+            "id": 1789953497899630,
+            "time": 1461992750443 + e,
+            "messaging": [make_envelope(n) for n in range(envelopes)]
+        } for e in range(entries)]
+    }
+
+
+def bench(validate, body, iterations):
+    return min(timeit.repeat(lambda: validate(body), number=iterations, repeat=5))
+
+
+def main(iterations):
+    logging.getLogger().setLevel(logging.ERROR)
+    print("{:<18} {:>14} {:>14} {:>9}".format("entries x msgs", "reference us", "generated us", "speedup"))
+    for (entries, envelopes) in [(1, 1), (1, 100), (10, 100), (100, 100)]:
+        body = make_callback(entries, envelopes)
+        count = max(1, iterations // (entries * envelopes))
+        reference = bench(reference_postback_validation.validate_postback, body, count)
+        generated = bench(validation.validate_postback, body, count)
+        print("{:<18} {:>14.2f} {:>14.2f} {:>8.2f}x".format(
+            "{} x {}".format(entries, envelopes), reference * 1e6 / count, generated * 1e6 / count, reference / generated))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
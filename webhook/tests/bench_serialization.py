@@ -0,0 +1,56 @@
+import json
+import logging
+import os
+import sys
+import timeit
+
+
+"""
+Compares the record size and the encode and decode times of the session
+codec against json text, for a small and a large session. Run from the
+tests directory:
+
+    python bench_serialization.py [iterations]
+
+The codec uses msgpack if its C extension is installed and compact json
+if not, the first line of the output says which.
+"""
+parent = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parent)
+
+
+# just importing this to set up the library paths
+import webhook
+
+from platform import serialization, sessions
+
+
+def make_test_sessions():
+    small = {"state": "awaiting_reply", "turn": 12, "user": {"first_name": "Pat", "locale": "en_US", "timezone": -5}}
+    large = dict(small)
+    large["context"] = [{"text": "message number {}".format(n), "intent": "smalltalk", "confidence": 0.87, "time": 1464990719275 + n}
+        for n in range(60)]
+    return [("small", small), ("large", large)]
+
+
+def bench(fn, iterations):
+    return min(timeit.repeat(fn, number=iterations, repeat=3)) * 1e6 / iterations
+
+
+def main(iterations):
+    logging.getLogger().setLevel(logging.ERROR)
+    codec = sessions.codec
+    print("codec payload: {}".format("msgpack" if serialization.use_msgpack else "compact json"))
+    print("{:<8} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "session", "json B", "codec B", "json enc", "codec enc", "json dec", "codec dec"))
+    for (name, session) in make_test_sessions():
+        text = json.dumps(session)
+        data = codec.encode(session)
+        print("{:<8} {:>10} {:>10} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+            name, len(text), len(data),
+            bench(lambda: json.dumps(session), iterations), bench(lambda: codec.encode(session), iterations),
+            bench(lambda: json.loads(text), iterations), bench(lambda: codec.decode(data), iterations)))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,75 @@
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+
+"""
+Benchmarks the session store backends, reporting the mean latency of each
+session operation from the metrics the sessions module records. Run from
+the tests directory:
+
+    python bench_sessions.py [iterations] [dynamodb endpoint url]
+
+Without an endpoint url the dynamodb backend runs against the in-memory
+stand-in in fake_dynamodb.py, which measures only the client-side cost.
+With one, for example DynamoDB Local, the table named by the
+"sessionTable" setting must already exist.
+"""
+parent = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parent)
+
+
+# just importing this to set up the library paths
+import webhook
+
+from config import settings
+import metrics
+from platform import sessions, stores
+from fake_dynamodb import FakeDynamoClient
+
+
+def make_session(n):
+    return {
+        "state": "awaiting_reply",
+        "turn": n,
+        "context": {"topic": "weather", "location": "Somewhere, USA", "history": ["hello", "what's it like out"] * 5}
+    }
+
+
+def bench(store, iterations):
+    sessions.set_store(store)
+    metrics.reset("sessions.")
+    for n in range(iterations):
+        user_id = str(1000000 + n % 100)
+        sessions.put(user_id, make_session(n))
+        sessions.get(user_id)
+        sessions.update(user_id, lambda session: session.update(turn=session["turn"] + 1))
+    for n in range(100):
+        sessions.delete(str(1000000 + n))
+    timings = metrics.snapshot("sessions.")["timings"]
+    return dict((name.split(".")[-1], timing["mean_ms"] * 1000) for (name, timing) in timings.items())
+
+
+def main(iterations, endpoint_url):
+    logging.getLogger().setLevel(logging.ERROR)
+    tempdir = tempfile.mkdtemp()
+    try:
+        backends = [
+            ("memory", stores.MemoryStore()),
+            ("sqlite", stores.SqliteStore(os.path.join(tempdir, "sessions.db"), table="sessions")),
+            ("dynamodb", stores.DynamoStore(settings.get("sessionTable", "sessions"),
+                client=None if endpoint_url else FakeDynamoClient(), endpoint_url=endpoint_url))
+        ]
+        print("{:<10} {:>10} {:>10} {:>10} {:>10}".format("backend", "get us", "put us", "update us", "delete us"))
+        for (name, store) in backends:
+            means = bench(store, iterations)
+            print("{:<10} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+                name, means["get"], means["put"], means["get"] + means["put"], means["delete"]))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000, sys.argv[2] if len(sys.argv) > 2 else None)
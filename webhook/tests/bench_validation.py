@@ -0,0 +1,53 @@
+import logging
+import os
+import sys
+import timeit
+
+
+"""
+Benchmarks the compiled outbound message validator against the original
+hand-written one on button and generic template messages. Run from the
+tests directory:
+
+    python bench_validation.py [iterations]
+"""
+parent = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parent)
+
+
+# just importing this to set up the library paths
+import webhook
+
+from platform import messages, validation
+import reference_message_validation
+
+
+def make_test_messages():
+    buttons = [
+        messages.make_url_button("This is a test title", "http://some.where/but_not_here"),
+        messages.make_postback_button("This is a test title", "This is a test payload")
+    ]
+    button_msg = messages.make_message("1789953497899630", "button_message", {"prompt_text": "Here lies a button"}, buttons)
+    generic_msg = messages.make_message("1789953497899630", "generic_message")
+    for n in range(10):
+        messages.add_message_element(generic_msg, "Element title {}".format(n), "Element subtitle",
+            "http://some.where/but_not_here.png", "http://some.where/but_not_here", buttons)
+    return [("button", button_msg), ("generic", generic_msg)]
+
+
+def bench(validate, message, iterations):
+    return min(timeit.repeat(lambda: validate(message), number=iterations, repeat=3))
+
+
+def main(iterations):
+    logging.getLogger().setLevel(logging.ERROR)
+    print("{:<10} {:>14} {:>14} {:>9}".format("template", "reference us", "compiled us", "speedup"))
+    for (name, message) in make_test_messages():
+        reference = bench(reference_message_validation.validate_message, message, iterations)
+        compiled = bench(validation.validate_message, message, iterations)
+        print("{:<10} {:>14.2f} {:>14.2f} {:>8.2f}x".format(
+            name, reference * 1e6 / iterations, compiled * 1e6 / iterations, reference / compiled))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
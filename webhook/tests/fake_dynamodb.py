@@ -0,0 +1,90 @@
+import copy
+import threading
+
+
+class FakeClientError(Exception):
+    """
+    Stands in for botocore's ClientError.
+    """
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.response = {"Error": {"Code": code}}
+
+
+class FakeDynamoClient(object):
+    """
+    Stands in for a boto3 DynamoDB client in the tests and benchmarks. Only
+    implements the calls made by platform.stores.DynamoStore, on tables held
+    in memory and created on first use, and only understands the condition
+    and update expressions that DynamoStore uses.
+    """
+    def __init__(self):
+        self.tables = {}
+        self.ttl = None
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _table(self, name):
+        self.calls += 1
+        return self.tables.setdefault(name, {})
+
+    def get_item(self, TableName, Key, ConsistentRead=False):
+        with self._lock:
+            item = self._table(TableName).get(Key["key"]["S"])
+            return {"Item": copy.deepcopy(item)} if item is not None else {}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+            ExpressionAttributeValues=None):
+        with self._lock:
+            table = self._table(TableName)
+            if ConditionExpression is not None:
+                current = table.get(Item["key"]["S"], {})
+                name = ExpressionAttributeNames["#v"]
+                if ConditionExpression == "attribute_not_exists(#v)":
+                    passed = name not in current
+                else:
+                    passed = current.get(name) == ExpressionAttributeValues[":v"]
+                if not passed:
+                    raise FakeClientError("ConditionalCheckFailedException")
+            table[Item["key"]["S"]] = copy.deepcopy(Item)
+            return {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeNames,
+            ExpressionAttributeValues, ReturnValues=None):
+        # only understands "SET #a = :a, ... REMOVE #b, ..."
+        with self._lock:
+            table = self._table(TableName)
+            item = table.setdefault(Key["key"]["S"], copy.deepcopy(Key))
+            (sets, _, removes) = UpdateExpression.partition(" REMOVE ")
+            for assignment in sets[len("SET "):].split(", "):
+                (name, value) = assignment.split(" = ")
+                item[ExpressionAttributeNames[name]] = copy.deepcopy(ExpressionAttributeValues[value])
+            for name in removes.split(", ") if removes else []:
+                item.pop(ExpressionAttributeNames[name], None)
+            return {"Attributes": copy.deepcopy(item)} if ReturnValues == "ALL_NEW" else {}
+
+    def delete_item(self, TableName, Key):
+        with self._lock:
+            self._table(TableName).pop(Key["key"]["S"], None)
+            return {}
+
+    def batch_write_item(self, RequestItems):
+        with self._lock:
+            for (name, requests) in RequestItems.items():
+                table = self._table(name)
+                for request in requests:
+                    if "PutRequest" in request:
+                        item = request["PutRequest"]["Item"]
+                        table[item["key"]["S"]] = copy.deepcopy(item)
+                    else:
+                        table.pop(request["DeleteRequest"]["Key"]["key"]["S"], None)
+            return {"UnprocessedItems": {}}
+
+    def update_time_to_live(self, TableName, TimeToLiveSpecification):
+        with self._lock:
+            self.ttl = dict(TimeToLiveSpecification)
+            return {"TimeToLiveSpecification": TimeToLiveSpecification}
+
+    def scan(self, TableName, **kwargs):
+        with self._lock:
+            return {"Items": [{"key": item["key"]} for item in self._table(TableName).values()]}
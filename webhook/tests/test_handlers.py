@@ -1,7 +1,12 @@
+import base64
+import hashlib
+import hmac
 import json
 import logging
 import os
+import random
 import sys
+import types
 import unittest
 
 
@@ -15,6 +20,10 @@ sys.path.insert(0, parent)
 
 from webhook import handler
 from config import settings
+import dialog
+from handlers import validation
+import metrics
+import reference_postback_validation
 
 
 """
@@ -23,7 +32,7 @@ Adds a console handler to the logger to be used during test runs.
 log_level = eval("logging.{}".format(settings["logLevel"]))
 logger = logging.getLogger()
 logger.setLevel(log_level)
-if not len([handler for handler in logger.handlers if isinstance(handler,logging.StreamHandler)]):
+if not len([h for h in logger.handlers if isinstance(h, logging.StreamHandler)]):
     sh = logging.StreamHandler()
     sh.setLevel(log_level)
     logger.addHandler(sh)
@@ -262,6 +271,128 @@ class TestUserPostback(TestPostbacksBase):
         handler(self.test_event, None)
 
 
+class TestBotRouting(TestPostbacksBase):
+    """
+    Tests that events are routed to the bot for their page, that the bot
+    is loaded on first use, and that other pages go to the default bot.
+    """
+    def setUp(self):
+        super(TestBotRouting, self).setUp()
+        self.received = []
+        bot = types.ModuleType("dialog.bots.routing_test_bot")
+        bot.ping = lambda: None
+        bot.message_in = lambda source, sender_id, time, message: self.received.append((source, message["text"]))
+        sys.modules["dialog.bots.routing_test_bot"] = bot
+        self.page_bots = dialog._page_bots
+        dialog._page_bots = {"2000": "routing_test_bot"}
+
+    def tearDown(self):
+        dialog._page_bots = self.page_bots
+        dialog._bots.pop("routing_test_bot", None)
+        del sys.modules["dialog.bots.routing_test_bot"]
+
+    def test(self):
+        for (n, page_id) in enumerate([2000, 1789953497899630]):
+            entry = self.make_entry(page_id, 1461992750443)
+            entry["messaging"].append(self.make_message(983440235096641, page_id, 1461992777559))
+            entry["messaging"][0]["message"] = {"mid": "mid.1461992777559:e8027b338d2b553b7{}".format(n), "seq": 75, "text": "Message {}".format(n)}
+            self.test_event["body"]["entry"].append(entry)
+        self.assertNotIn("routing_test_bot", dialog._bots)
+        handler(self.test_event, None)
+        self.assertEqual(self.received, [(2000, "Message 0")])
+        self.assertIs(dialog.bot_for("2000"), dialog._bots["routing_test_bot"])
+        self.assertIs(dialog.bot_for("1789953497899630"), dialog._bots[settings["activeBot"]])
+
+
+class TestMiddlewareChain(TestBotRouting):
+    """
+    Tests that a chain of middleware runs before the bot, that dedup drops
+    a resent message, and that every stage records its own time.
+    """
+    def setUp(self):
+        super(TestMiddlewareChain, self).setUp()
+        self.chain = dialog._chain
+        dialog._chain = dialog.build_chain(["ratelimit", "dedup"])
+        metrics.reset("dialog.")
+
+    def tearDown(self):
+        dialog._chain = self.chain
+        super(TestMiddlewareChain, self).tearDown()
+
+    def test(self):
+        entry = self.make_entry(2000, 1461992750443)
+        for n in range(2):
+            entry["messaging"].append(self.make_message(983440235096641, 2000, 1461992777559))
+            entry["messaging"][n]["message"] = {"mid": "mid.1461992777559:middleware", "seq": 75, "text": "Message"}
+        self.test_event["body"]["entry"].append(entry)
+        handler(self.test_event, None)
+        self.assertEqual(self.received, [(2000, "Message")])
+        self.assertEqual(metrics.counter("dialog.dedup.dropped"), 1)
+        timings = metrics.snapshot("dialog.stage.")["timings"]
+        self.assertEqual(timings["dialog.stage.ratelimit"]["count"], 2)
+        self.assertEqual(timings["dialog.stage.dedup"]["count"], 2)
+        self.assertEqual(timings["dialog.stage.bot"]["count"], 1)
+
+
+class TestMiddlewareRedelivery(TestMiddlewareChain):
+    """
+    Tests that dedup doesn't drop a resent message that the bot failed to
+    handle the first time.
+    """
+    def test(self):
+        bot = sys.modules["dialog.bots.routing_test_bot"]
+        handled = bot.message_in
+
+        def fail_once(*args):
+            bot.message_in = handled
+            raise Exception("500 Internal Server Error; bot failed")
+
+        bot.message_in = fail_once
+        entry = self.make_entry(2000, 1461992750443)
+        entry["messaging"].append(self.make_message(983440235096641, 2000, 1461992777559))
+        entry["messaging"][0]["message"] = {"mid": "mid.1461992777559:redelivered", "seq": 76, "text": "Message"}
+        self.test_event["body"]["entry"].append(entry)
+        self.assertRaises(Exception, handler, self.test_event, None)
+        self.assertEqual(self.received, [])
+        handler(self.test_event, None)
+        self.assertEqual(self.received, [(2000, "Message")])
+        self.assertEqual(metrics.counter("dialog.dedup.dropped"), 0)
+
+
+class TestSampledValidation(TestPostbacksBase):
+    """
+    Tests that in sampled mode an unsampled callback missing something the
+    handlers read is rejected with a 400 and counted, and a good one is
+    handled.
+    """
+    def setUp(self):
+        super(TestSampledValidation, self).setUp()
+        validation.set_validation_mode("sampled", 0)
+        metrics.reset("validation.inbound.")
+
+    def tearDown(self):
+        validation.set_validation_mode(settings.get("validationMode", "strict"))
+
+    def check(self, key, content, error):
+        self.test_event["body"]["entry"] = [self.make_entry(1789953497899630, 1461992750443)]
+        self.test_event["body"]["entry"][0]["messaging"].append(self.make_message(983440235096641, 1789953497899630, 1461992777559))
+        self.test_event["body"]["entry"][0]["messaging"][0][key] = content
+        with self.assertRaises(Exception) as cm:
+            handler(self.test_event, None)
+        self.assertTrue(str(cm.exception).startswith("400 Bad Request; {}".format(error)))
+
+    def test(self):
+        self.check("message", {"seq": 75, "text": "Message"}, "missing property: $.entry[].messaging[].message.mid")
+        self.check("read", {"watermark": 1461992777559, "seq": 76}, "bad value: $.entry[].messaging[]")
+        self.check("postback", {}, "missing property: $.entry[].messaging[].postback.payload")
+        self.check("delivery", {"mids": [], "seq": 76}, "missing property: $.entry[].messaging[].delivery.watermark")
+        self.assertEqual(metrics.counter("validation.inbound.sampled.violations"), 4)
+        self.test_event["body"]["entry"][0]["messaging"][0] = self.make_message(983440235096641, 1789953497899630, 1461992777559)
+        self.test_event["body"]["entry"][0]["messaging"][0]["postback"] = {"payload": "SOME POSTBACK DATA HERE"}
+        handler(self.test_event, None)
+        self.assertEqual(metrics.counter("validation.inbound.sampled.structural"), 5)
+
+
 class TestPostbackMissingEntry(TestPostbacksBase):
     """
     Tests a call to the webhook.handler with a user postback event that
@@ -283,5 +414,128 @@ class TestPostbackMissingMessage(TestPostbacksBase):
         self.assertRaises(Exception, handler, self.test_event, None)
 
 
+class TestGateBase(TestPostbacksBase):
+    def setUp(self):
+        super(TestGateBase, self).setUp()
+        self.test_event["body"]["entry"].append(self.make_entry(1789953497899630, 1461992750443))
+        self.test_event["body"]["entry"][0]["messaging"].append(self.make_message(983440235096641, 1789953497899630, 1461992777559))
+        self.test_event["body"]["entry"][0]["messaging"][0]["postback"] = {"payload": "SOME POSTBACK DATA HERE"}
+        raw_body = json.dumps(self.test_event["body"])
+        self.test_event["rawBody"] = base64.b64encode(raw_body)
+        self.app_secret = settings.get("appSecret")
+        settings["appSecret"] = "test-app-secret"
+        self.test_event["headers"]["X-Hub-Signature"] = "sha1={}".format(
+            hmac.new("test-app-secret", raw_body, hashlib.sha1).hexdigest())
+
+    def tearDown(self):
+        settings["appSecret"] = self.app_secret
+
+
+class TestGateSignedPostback(TestGateBase):
+    """
+    Tests a call to the webhook.handler with a correctly signed postback.
+    Should return nothing.
+    """
+    def test(self):
+        handler(self.test_event, None)
+
+
+class TestGateBadSignature(TestGateBase):
+    """
+    Tests a call to the webhook.handler with a body that does not match its
+    signature. Should raise an exception with "403" in the message.
+    """
+    def test(self):
+        self.test_event["rawBody"] = base64.b64encode(json.dumps({"object": "page", "entry": []}))
+        with self.assertRaises(Exception) as cm:
+            handler(self.test_event, None)
+        self.assertTrue(str(cm.exception).startswith("403"))
+
+
+class TestGateTooManyEntries(TestGateBase):
+    """
+    Tests a call to the webhook.handler with more entries than maxEntries
+    allows. Should raise an exception with "400" in the message.
+    """
+    def test(self):
+        settings["appSecret"] = ""
+        self.test_event["body"]["entry"] *= settings.get("maxEntries", 100) + 1
+        with self.assertRaises(Exception) as cm:
+            handler(self.test_event, None)
+        self.assertTrue(str(cm.exception).startswith("400 Bad Request; too many entries"))
+
+
+class TestValidationMatchesReference(TestPostbacksBase):
+    """
+    Fuzz tests the generated callback validator against the original
+    hand-written one. Random properties of a batched callback holding every
+    envelope type are deleted or replaced, and both validators must give the
+    same result. Where the reference fails with something other than a
+    validation error (wrong types) the generated validator only has to
+    reject the callback.
+    """
+    replacements = [None, "", 0, 1, "x", [], {}, [None], [{}]]
+
+    def setUp(self):
+        super(TestValidationMatchesReference, self).setUp()
+        body = self.test_event["body"]
+        for n in range(2):
+            body["entry"].append(self.make_entry(1789953497899630, 1461992750443))
+            messaging = body["entry"][n]["messaging"]
+            for kind in range(5):
+                messaging.append(self.make_message(983440235096641, 1789953497899630, 1461992777559))
+            messaging[0]["optin"] = {"ref": "PASS_THROUGH_PARAM"}
+            messaging[1]["message"] = {"mid": "mid.1461992777559:e8027b338d2b553b73", "seq": 75, "text": "Test."}
+            messaging[2]["message"] = {"mid": "mid.1461992777559:e8027b338d2b553b74", "seq": 76, "attachments": [
+                {"type": "image", "payload": {"url": "http://some.where/but_not_here.png"}},
+                {"type": "audio", "payload": {"url": "http://some.where/but_not_here.mp3"}}]}
+            messaging[3]["delivery"] = {"mids": ["mid.1461992777559:e8027b338d2b553b73"], "watermark": 1234567890, "seq": 75}
+            messaging[4]["postback"] = {"payload": "SOME POSTBACK DATA HERE"}
+
+    def containers(self, value):
+        """
+        Returns every dict and list nested in value, including value.
+        """
+        found = [value]
+        children = value.values() if isinstance(value, dict) else value
+        for child in children:
+            if isinstance(child, (dict, list)):
+                found.extend(self.containers(child))
+        return found
+
+    def mutate(self, rnd, body):
+        body = json.loads(json.dumps(body))
+        for n in range(rnd.randint(1, 3)):
+            containers = [c for c in self.containers(body) if len(c)]
+            if not containers:
+                break
+            container = rnd.choice(containers)
+            key = rnd.choice(list(container.keys()) if isinstance(container, dict) else range(len(container)))
+            if isinstance(container, dict) and rnd.random() < 0.3:
+                del container[key]
+            else:
+                container[key] = json.loads(json.dumps(rnd.choice(self.replacements)))
+        return body
+
+    def outcome(self, validate, body):
+        try:
+            validate(body)
+        except Exception as e:
+            return str(e)
+
+    def test(self):
+        rnd = random.Random(1461992750443)
+        body = self.test_event["body"]
+        self.assertEqual(self.outcome(validation.validate_postback, body), None)
+        for n in range(3000):
+            mutated = self.mutate(rnd, body)
+            expected = self.outcome(reference_postback_validation.validate_postback, mutated)
+            actual = self.outcome(validation.validate_postback, mutated)
+            if expected is None or expected.startswith("400 Bad Request"):
+                self.assertEqual(actual, expected)
+            else:
+                self.assertNotEqual(actual, None)
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+
+"""
+Add the parent directory to the path so that we can import the
+webhook and tests can access the entrypoint.
+"""
+parent = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parent)
+
+
+from config import settings
+
+# just importing this to set up the library paths
+import webhook
+
+import handlers
+import metrics
+import nlu
+from nlu import classifier, keywords, wit
+
+
+"""
+Adds a console handler to the logger to be used during test runs.
+"""
+log_level = eval("logging.{}".format(settings["logLevel"]))
+logger = logging.getLogger()
+logger.setLevel(log_level)
+if not len([handler for handler in logger.handlers if isinstance(handler,logging.StreamHandler)]):
+    sh = logging.StreamHandler()
+    sh.setLevel(log_level)
+    logger.addHandler(sh)
+
+
+test_keywords = {
+    "hello": "greeting",
+    "hi": "greeting",
+    "good morning": "greeting",
+    "order": "order",
+    "order a pizza": "order",
+    "pizza": "menu",
+    "café": "menu",
+    "cancel my order": "cancel"
+}
+
+
+class TestNluBase(unittest.TestCase):
+    def setUp(self):
+        logger.info("\n\n>>>>TEST CASE: {}".format(self.id()))
+        self.matcher = keywords.KeywordMatcher(test_keywords)
+
+    def phrases(self, text):
+        return sorted(match["phrase"] for match in self.matcher.parse(text)["matches"])
+
+
+class TestNormalize(TestNluBase):
+    """
+    Tests that normalize() folds case, accents and punctuation.
+    """
+    def test(self):
+        self.assertEqual(nlu.normalize(u"  Héllo,  WORLD!! it's_me "), u"hello world it s me")
+        self.assertEqual(nlu.normalize("Caf\xc3\xa9"), u"cafe")
+
+
+class TestKeywordWholeWords(TestNluBase):
+    """
+    Tests that phrases only match whole words, at the start, middle and end
+    of the text.
+    """
+    def test(self):
+        self.assertEqual(self.phrases("hi there"), [u"hi"])
+        self.assertEqual(self.phrases("say hi"), [u"hi"])
+        self.assertEqual(self.phrases("this is a history lesson"), [])
+        self.assertEqual(self.phrases("disorder"), [])
+        self.assertEqual(self.matcher.parse("this is a history lesson")["intent"], None)
+
+
+class TestKeywordOverlapping(TestNluBase):
+    """
+    Tests that overlapping and nested phrases are all found in one pass, and
+    that the intent with the most matched text wins.
+    """
+    def test(self):
+        self.assertEqual(self.phrases("I'd like to order a pizza"), [u"order", u"order a pizza", u"pizza"])
+        self.assertEqual(self.matcher.parse("I'd like to order a pizza")["intent"], "order")
+        self.assertEqual(self.phrases("please cancel my order"), [u"cancel my order", u"order"])
+        self.assertEqual(self.matcher.parse("please cancel my order")["intent"], "cancel")
+
+
+class TestKeywordAccents(TestNluBase):
+    """
+    Tests that accents, case and punctuation in either the phrases or the
+    text don't prevent a match, and the confidence is the matched fraction.
+    """
+    def test(self):
+        parsed = self.matcher.parse(u"CAFE?!")
+        self.assertEqual(parsed["intent"], "menu")
+        self.assertEqual(parsed["confidence"], 1.0)
+        parsed = self.matcher.parse(u"Good-morning, Café")
+        self.assertEqual(parsed["intent"], "greeting")
+        self.assertAlmostEqual(parsed["confidence"], 12.0 / 17)
+
+
+class TestKeywordVersion(TestNluBase):
+    """
+    Tests that the version changes with the table.
+    """
+    def test(self):
+        self.assertEqual(self.matcher.version, keywords.KeywordMatcher(dict(test_keywords)).version)
+        changed = dict(test_keywords, menu="menu")
+        self.assertNotEqual(self.matcher.version, keywords.KeywordMatcher(changed).version)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.text = json.dumps(body)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeWitSession(object):
+    """
+    Stands in for requests in the wit.ai tests, recording the urls and
+    headers of each call.
+    """
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+        self.calls = []
+
+    def get(self, url, headers=None):
+        self.calls.append((url, headers))
+        return FakeResponse(self.status_code, self.body)
+
+
+class TestWitBackend(TestNluBase):
+    """
+    Tests that the wit.ai backend sends the text and token, and returns the
+    most confident intent.
+    """
+    def test(self):
+        session = FakeWitSession({"msg_id": "1", "_text": "order a pizza", "entities": {
+            "intent": [{"value": "menu", "confidence": 0.2}, {"value": "order", "confidence": 0.9}]
+        }})
+        backend = wit.WitBackend("TOKEN", session=session)
+        parsed = backend.parse(u"order a pizza é")
+        self.assertEqual(parsed["intent"], "order")
+        self.assertEqual(parsed["confidence"], 0.9)
+        self.assertEqual(session.calls[0][0], "https://api.wit.ai/message?v=20160526&q=order%20a%20pizza%20%C3%A9")
+        self.assertEqual(session.calls[0][1], {"Authorization": "Bearer TOKEN"})
+        self.assertEqual(wit.WitBackend("TOKEN", session=FakeWitSession({"entities": {}})).parse("hmm")["intent"], None)
+        self.assertRaises(Exception, wit.WitBackend("TOKEN", session=FakeWitSession({}, 400)).parse, "hmm")
+
+
+class TestBackendSelection(TestNluBase):
+    """
+    Tests that parse() and parse_batch() use the backend that is set.
+    """
+    def test(self):
+        nlu.set_backend(self.matcher)
+        try:
+            self.assertEqual(nlu.parse("hello")["intent"], "greeting")
+            self.assertEqual([r["intent"] for r in nlu.parse_batch(["hello", None, "pizza"])], ["greeting", None, "menu"])
+            nlu.set_backend(nlu.NoBackend())
+            self.assertEqual(nlu.parse("hello")["intent"], None)
+        finally:
+            nlu.set_backend(None)
+
+
+test_examples = [
+    ("hello there", "greeting"), ("hi", "greeting"), ("good morning to you", "greeting"), ("hey, how are you", "greeting"),
+    ("I want to order a pizza", "order"), ("can I get a large pepperoni", "order"), ("place an order for delivery", "order"),
+    ("where is my delivery", "status"), ("has my order shipped yet", "status"), ("track my pizza order status", "status"),
+    ("what's on the menu", "menu"), ("do you have vegan options", "menu"), ("show me the menu please", "menu")
+]
+
+
+@unittest.skipIf(classifier.numpy is None, "numpy is not installed")
+class TestClassifier(TestNluBase):
+    """
+    Tests that the classifier finds the intents of texts it wasn't trained
+    on, in one batch, and finds none for texts without any words.
+    """
+    def test(self):
+        model = classifier.train(test_examples, dims=1024)
+        results = model.classify_batch(["hello, good morning!", "I'd like to order a large pizza",
+            "where's my order?", "the vegan menu", "?!"])
+        self.assertEqual([r["intent"] for r in results], ["greeting", "order", "status", "menu", None])
+        self.assertTrue(0 < results[0]["confidence"] <= 1.0)
+        self.assertTrue(len(results[1]["matches"]) <= 3)
+        self.assertEqual(model.parse("hello, good morning!"), results[0])
+        self.assertEqual(model.classify_batch([]), [])
+
+
+@unittest.skipIf(classifier.numpy is None, "numpy is not installed")
+class TestClassifierFile(TestNluBase):
+    """
+    Tests that a saved model is mapped from its file at load and scores the
+    same as the model that was saved, and that bad files are rejected.
+    """
+    def setUp(self):
+        super(TestClassifierFile, self).setUp()
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test(self):
+        model = classifier.train(test_examples, dims=1024)
+        path = os.path.join(self.dir, "intents.nlu")
+        model.save(path)
+        loaded = classifier.load(path)
+        self.assertTrue(isinstance(loaded.centroids, classifier.numpy.memmap))
+        self.assertEqual(loaded.version, model.version)
+        self.assertEqual(loaded.intents, model.intents)
+        texts = ["hi", "track my order", "menu"]
+        self.assertEqual(loaded.classify_batch(texts), model.classify_batch(texts))
+        with open(path, "r+b") as f:
+            f.write(b"JUNK")
+        self.assertRaises(Exception, classifier.load, path)
+
+
+class TestParseMessages(TestNluBase):
+    """
+    Tests that the texts of all the messages in a callback are parsed in one
+    batch, and each message gets its result.
+    """
+    def test(self):
+        batches = []
+
+        class BatchMatcher(keywords.KeywordMatcher):
+            def parse_batch(self, texts):
+                batches.append(texts)
+                return super(BatchMatcher, self).parse_batch(texts)
+
+        nlu.set_backend(BatchMatcher(test_keywords))
+        try:
+            body = {"object": "page", "entry": [
+                {"id": "1", "time": 1, "messaging": [
+                    {"sender": {"id": "10"}, "message": {"mid": "a", "seq": 1, "text": "hello"}},
+                    {"sender": {"id": "10"}, "delivery": {"mids": ["a"], "seq": 1, "watermark": 1}}]},
+                {"id": "2", "time": 1, "messaging": [
+                    {"sender": {"id": "20"}, "message": {"mid": "b", "seq": 2, "text": "cancel my order"}},
+                    {"sender": {"id": "20"}, "message": {"mid": "c", "seq": 3, "attachments": []}}]}
+            ]}
+            handlers.parse_messages(body)
+        finally:
+            nlu.set_backend(None)
+        self.assertEqual(batches, [["hello", "cancel my order"]])
+        self.assertEqual(body["entry"][0]["messaging"][0]["message"]["nlu"]["intent"], "greeting")
+        self.assertEqual(body["entry"][1]["messaging"][0]["message"]["nlu"]["intent"], "cancel")
+        self.assertFalse("nlu" in body["entry"][1]["messaging"][1]["message"])
+
+
+class CountingMatcher(keywords.KeywordMatcher):
+    """
+    A keyword matcher that records the texts it is asked to parse.
+    """
+    def __init__(self, table, version=None):
+        super(CountingMatcher, self).__init__(table, version)
+        self.parsed = []
+
+    def parse_batch(self, texts):
+        self.parsed.extend(texts)
+        return super(CountingMatcher, self).parse_batch(texts)
+
+
+class TestResultCache(TestNluBase):
+    """
+    Tests that repeated texts, including ones that differ only in case,
+    accents and punctuation, are parsed once, that long texts aren't
+    cached, and that the lookups are counted.
+    """
+    def test(self):
+        backend = CountingMatcher(test_keywords)
+        nlu.set_backend(backend)
+        metrics.reset("nlu.cache")
+        try:
+            long_text = "hello " * 30
+            results = nlu.parse_batch(["hello", "Hello!", "menu", long_text])
+            results.extend(nlu.parse_batch(["HELLO", "menu", long_text]))
+            results.append(nlu.parse("héllo"))
+        finally:
+            nlu.set_backend(None)
+        self.assertEqual(backend.parsed, ["hello", "menu", long_text, long_text])
+        self.assertEqual([r["intent"] for r in results], ["greeting", "greeting", None, "greeting", "greeting", None, "greeting", "greeting"])
+        counters = metrics.snapshot("nlu.cache")["counters"]
+        self.assertEqual(counters["nlu.cache.hits"], 3)
+        self.assertEqual(counters["nlu.cache.misses"], 5)
+        # results are copies, changing one doesn't change the cache
+        results[0]["intent"] = "changed"
+        nlu.set_backend(backend)
+        try:
+            self.assertEqual(nlu.parse("hello")["intent"], "greeting")
+        finally:
+            nlu.set_backend(None)
+
+
+class TestResultCacheInvalidation(TestNluBase):
+    """
+    Tests that a backend with a new model version doesn't get the old
+    model's results, and that invalidate() drops them.
+    """
+    def test(self):
+        old = CountingMatcher(test_keywords)
+        new = CountingMatcher(dict(test_keywords, hello="hello"))
+        try:
+            nlu.set_backend(old)
+            self.assertEqual(nlu.parse("hello")["intent"], "greeting")
+            nlu.set_backend(new)
+            self.assertEqual(nlu.cache_stats()["entries"], 0)
+            self.assertEqual(nlu.parse("hello")["intent"], "hello")
+            self.assertEqual(nlu.parse("hello")["intent"], "hello")
+            nlu.invalidate()
+            self.assertEqual(nlu.parse("hello")["intent"], "hello")
+        finally:
+            nlu.set_backend(None)
+        self.assertEqual(new.parsed, ["hello", "hello"])
@@ -1,7 +1,11 @@
 import json
 import logging
 import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
 
@@ -18,7 +22,12 @@ from config import settings
 # just importing this to set up the library paths
 import webhook
 
-from platform import messages, profiles, validation
+import config
+import handlers
+import metrics
+from platform import messages, prefs, profiles, serialization, sessions, stores, validation
+from fake_dynamodb import FakeDynamoClient
+import reference_message_validation
 
 
 """
@@ -190,6 +199,669 @@ class TestMakeGenericMessage(unittest.TestCase):
         self.assertEqual(message, self.expected)
 
 
+class TestMakeCachedMessage(unittest.TestCase):
+    def setUp(self):
+        logger.info("\n\n>>>>TEST CASE: {}".format(self.id()))
+        messages.clear_message_cache()
+
+    def test(self):
+        """
+        Tests messages.make_cached_message by checking that cached copies
+        match make_message output, differ only in recipient id, and are
+        counted as cache hits.
+        """
+        buttons = [messages.make_postback_button("Help", "HELP")]
+        before = messages.message_cache_stats()
+        first = messages.make_cached_message("1789953497899630", "button_message", {"prompt_text": "Menu"}, buttons)
+        second = messages.make_cached_message("983440235096641", "button_message", {"prompt_text": "Menu"}, buttons)
+        self.assertEqual(first, messages.make_message("1789953497899630", "button_message", {"prompt_text": "Menu"}, buttons))
+        self.assertEqual(second["recipient"]["id"], "983440235096641")
+        self.assertEqual(first["message"], second["message"])
+        self.assertFalse(first["message"] is second["message"])
+        self.assertTrue(second.validated)
+        stats = messages.message_cache_stats()
+        self.assertEqual(stats["hits"] - before["hits"], 1)
+        self.assertEqual(stats["entries"], 1)
+        self.assertTrue(stats["bytes"] > 0)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+
+class FakeSession(object):
+    """
+    Stands in for requests.Session in the broadcast tests, recording every
+    posted message and failing the sends to any id listed in fail_ids.
+    """
+    posted = []
+    urls = []
+    fail_ids = []
+
+    def post(self, url, headers=None, data=None):
+        message = json.loads(data)
+        FakeSession.posted.append(message)
+        FakeSession.urls.append(url)
+        if message["recipient"]["id"] in FakeSession.fail_ids:
+            return FakeResponse(400, "bad recipient")
+        return FakeResponse(200, json.dumps({"recipient_id": message["recipient"]["id"]}))
+
+
+class FakeRequests(object):
+    Session = FakeSession
+
+
+class TestBroadcastBase(unittest.TestCase):
+    def setUp(self):
+        logger.info("\n\n>>>>TEST CASE: {}".format(self.id()))
+        FakeSession.posted = []
+        FakeSession.urls = []
+        FakeSession.fail_ids = []
+        self.requests = messages.requests
+        messages.requests = FakeRequests
+        self.recipients = [str(n) for n in range(1000, 1050)]
+
+    def tearDown(self):
+        messages.requests = self.requests
+
+
+class TestBroadcast(TestBroadcastBase):
+    def test(self):
+        """
+        Tests messages.broadcast by checking that every recipient is sent
+        the rendered message exactly once and failures are reported.
+        """
+        FakeSession.fail_ids = ["1007"]
+        report = messages.broadcast(iter(self.recipients), "text_message",
+            {"message_text": "Broadcast test."}, concurrency=4, rate=0)
+        self.assertEqual(report["sent"], 49)
+        self.assertEqual(report["failed"][0]["id"], "1007")
+        self.assertEqual(sorted(m["recipient"]["id"] for m in FakeSession.posted), self.recipients)
+        for message in FakeSession.posted:
+            self.assertEqual(message["message"], {"text": "Broadcast test."})
+
+
+class TestBroadcastResume(TestBroadcastBase):
+    def test(self):
+        """
+        Tests that messages.broadcast resumes from its checkpoint file and
+        only sends to recipients after the recorded position.
+        """
+        fd, checkpoint_file = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with open(checkpoint_file, "wb") as f:
+                f.write(json.dumps({"template": "text_message", "position": 20, "failed": []}))
+            report = messages.broadcast(self.recipients, "text_message",
+                {"message_text": "Broadcast test."}, concurrency=4, rate=0, checkpoint_file=checkpoint_file)
+            self.assertEqual(report["skipped"], 20)
+            self.assertEqual(report["sent"], 30)
+            self.assertEqual(sorted(m["recipient"]["id"] for m in FakeSession.posted), self.recipients[20:])
+            with open(checkpoint_file, "rb") as f:
+                self.assertEqual(json.loads(f.read())["position"], 50)
+        finally:
+            os.remove(checkpoint_file)
+
+
+class TestBroadcastCheckpointFails(TestBroadcastBase):
+    def test(self):
+        """
+        Tests that messages.broadcast stops and raises, rather than hanging,
+        when its checkpoint file can't be written.
+        """
+        recipients = [str(n) for n in range(1000, 1100)]
+        result = []
+        thread = threading.Thread(target=lambda: result.append(self.assertRaises(Exception, messages.broadcast,
+            recipients, "text_message", {"message_text": "Broadcast test."}, concurrency=4, rate=0,
+            checkpoint_file="/nonexistent/dir/ckpt", checkpoint_every=1)))
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(result), 1)
+        self.assertTrue(len(FakeSession.posted) < len(recipients))
+
+
+class FakeProfileRequests(object):
+    """
+    Stands in for the requests module in the profile tests, counting graph
+    API calls and answering with a profile built from the url.
+    """
+    calls = []
+    delay = 0
+
+    @staticmethod
+    def profile(user_id, fields):
+        profile = {"id": user_id}
+        for field in fields.split(","):
+            profile[field] = "{} {}".format("User" if field == "first_name" else field, user_id)
+        return profile
+
+    @staticmethod
+    def get(url):
+        FakeProfileRequests.calls.append(url)
+        time.sleep(FakeProfileRequests.delay)
+        fields = url.split("fields=")[1].split("&")[0]
+        if "?ids=" in url:
+            user_ids = url.split("?ids=")[1].split("&")[0].split(",")
+            return FakeResponse(200, json.dumps(dict(
+                (user_id, FakeProfileRequests.profile(user_id, fields)) for user_id in user_ids)))
+        user_id = url.split("/")[-1].split("?")[0]
+        return FakeResponse(200, json.dumps(FakeProfileRequests.profile(user_id, fields)))
+
+
+class TestProfilesBase(unittest.TestCase):
+    def setUp(self):
+        logger.info("\n\n>>>>TEST CASE: {}".format(self.id()))
+        FakeProfileRequests.calls = []
+        FakeProfileRequests.delay = 0
+        self.requests = profiles.requests
+        profiles.requests = FakeProfileRequests
+        self.tempdir = tempfile.mkdtemp()
+        profiles.set_store(stores.SqliteStore(os.path.join(self.tempdir, "profiles.db")))
+        profiles.invalidate()
+
+    def tearDown(self):
+        profiles.requests = self.requests
+        profiles.invalidate()
+        shutil.rmtree(self.tempdir)
+
+
+class TestProfileCache(TestProfilesBase):
+    def test(self):
+        """
+        Tests that profiles.get only calls the graph API on a miss, that
+        invalidate forces a refetch, and that the cache counts hits.
+        """
+        before = profiles.cache_stats()
+        first = profiles.get("983440235096641")
+        second = profiles.get("983440235096641")
+        self.assertEqual(first, second)
+        self.assertEqual(len(FakeProfileRequests.calls), 1)
+        profiles.invalidate("983440235096641")
+        profiles.get("983440235096641")
+        self.assertEqual(len(FakeProfileRequests.calls), 2)
+        self.assertEqual(profiles.cache_stats()["hits"] - before["hits"], 1)
+
+
+class TestProfileStore(TestProfilesBase):
+    def test(self):
+        """
+        Tests that a profile dropped from the in-process cache, as after a
+        cold start, is served from the store without calling the graph API.
+        """
+        first = profiles.get("983440235096641")
+        profiles._profile_cache.clear()
+        self.assertEqual(profiles.get("983440235096641"), first)
+        self.assertEqual(len(FakeProfileRequests.calls), 1)
+
+
+class TestProfileSingleFlight(TestProfilesBase):
+    def test(self):
+        """
+        Tests that concurrent profiles.get calls for the same user share a
+        single graph API call.
+        """
+        FakeProfileRequests.delay = 0.1
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(profiles.get("983440235096641"))) for n in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(FakeProfileRequests.calls), 1)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(result == results[0] for result in results))
+
+
+class TestProfileFieldUnion(TestProfilesBase):
+    def test(self):
+        """
+        Tests that a request for a subset of the fields already fetched for
+        a user is served from the cache, and that a request for other fields
+        fetches only the missing ones and merges them into the entry.
+        """
+        profile = profiles.get("1000", "first_name,last_name")
+        self.assertEqual(profile, {"id": "1000", "first_name": "User 1000", "last_name": "last_name 1000"})
+        self.assertEqual(profiles.get("1000", "first_name"), {"id": "1000", "first_name": "User 1000"})
+        self.assertEqual(len(FakeProfileRequests.calls), 1)
+        profile = profiles.get("1000", "last_name,locale")
+        self.assertEqual(profile["locale"], "locale 1000")
+        self.assertEqual(len(FakeProfileRequests.calls), 2)
+        self.assertIn("fields=locale&", FakeProfileRequests.calls[1])
+        profiles._profile_cache.clear()
+        profiles.get("1000", "first_name,locale")
+        self.assertEqual(len(FakeProfileRequests.calls), 2)
+
+
+class TestProfileRevalidate(TestProfilesBase):
+    def test(self):
+        """
+        Tests that a stale profile is returned without waiting on the graph
+        API, and is replaced by a background refresh.
+        """
+        profiles.get("1000", "first_name")
+        entry = dict(profiles._profile_cache.get("1000"))
+        entry["fetched"] -= profiles._cache_ttl + 1
+        entry["profile"] = {"id": "1000", "first_name": "Old name"}
+        profiles._profile_cache.put("1000", entry)
+        FakeProfileRequests.delay = 0.1
+        self.assertEqual(profiles.get("1000", "first_name")["first_name"], "Old name")
+        profiles._refresh_queue.join()
+        self.assertEqual(len(FakeProfileRequests.calls), 2)
+        self.assertEqual(profiles.get("1000", "first_name")["first_name"], "User 1000")
+        self.assertEqual(len(FakeProfileRequests.calls), 2)
+
+
+class TestProfileStoreStaleness(TestProfilesBase):
+    def test(self):
+        """
+        Tests that an entry in the store older than the staleness bound is
+        fetched again rather than returned, once it has left the in-process
+        cache, and that a fresher one is returned.
+        """
+        profiles.get("1000", "first_name")
+        entry = dict(profiles._profile_cache.get("1000"))
+        entry["fetched"] -= profiles._cache_ttl + profiles._max_staleness + 1
+        entry["profile"] = {"id": "1000", "first_name": "Old name"}
+        profiles._get_store().put("1000", entry)
+        profiles._profile_cache.clear()
+        self.assertEqual(profiles.get("1000", "first_name")["first_name"], "User 1000")
+        self.assertEqual(len(FakeProfileRequests.calls), 2)
+        profiles._profile_cache.clear()
+        self.assertEqual(profiles.get("1000", "first_name")["first_name"], "User 1000")
+        self.assertEqual(len(FakeProfileRequests.calls), 2)
+
+
+class TestPageTokens(TestProfilesBase):
+    def setUp(self):
+        TestProfilesBase.setUp(self)
+        self.pages = config._pages
+        config._pages = {"2000": {"pageToken": "PAGE_2000_TOKEN"}}
+        config._page_cache.clear()
+        self.messages_requests = messages.requests
+        messages.requests = FakeRequests
+        FakeSession.urls = []
+
+    def tearDown(self):
+        config._pages = self.pages
+        config._page_cache.clear()
+        messages.requests = self.messages_requests
+        TestProfilesBase.tearDown(self)
+
+    def test(self):
+        """
+        Tests that profile fetches, background refreshes and broadcast sends
+        made while handling an event use the token of the event's page, and
+        the global token outside of one.
+        """
+        with config.page_context("2000"):
+            profiles.get("1000", "first_name")
+            messages.broadcast(["1000", "1001"], "text_message", {"message_text": "Hi."}, concurrency=2, rate=0)
+            entry = dict(profiles._profile_cache.get("1000"))
+            entry["fetched"] -= profiles._cache_ttl + 1
+            profiles._profile_cache.put("1000", entry)
+            profiles.get("1000", "first_name")
+        profiles._refresh_queue.join()
+        with config.page_context("3000"):
+            profiles.get("1001", "first_name")
+        self.assertTrue(all("PAGE_2000_TOKEN" in url for url in FakeProfileRequests.calls[:2] + FakeSession.urls))
+        self.assertEqual(len(FakeSession.urls), 2)
+        self.assertIn("access_token={}".format(settings["pageToken"]), FakeProfileRequests.calls[2])
+
+
+class TestPageBatchSize(TestProfilesBase):
+    def setUp(self):
+        TestProfilesBase.setUp(self)
+        self.pages = config._pages
+        config._pages = {"2000": {"graphBatchSize": 2}}
+        config._page_cache.clear()
+
+    def tearDown(self):
+        config._pages = self.pages
+        config._page_cache.clear()
+        TestProfilesBase.tearDown(self)
+
+    def test(self):
+        """
+        Tests that profiles.prefetch uses the batch size of the page whose
+        event is being handled.
+        """
+        with config.page_context("2000"):
+            self.assertEqual(profiles.prefetch(["1000", "1001", "1002", "1003", "1004"]), 5)
+        self.assertEqual(len(FakeProfileRequests.calls), 3)
+
+
+class TestProfilePrefetch(TestProfilesBase):
+    def test(self):
+        """
+        Tests that profiles.prefetch loads several profiles with one graph
+        API call, skipping those already cached, and that get() then hits
+        the cache.
+        """
+        profiles.get("1000")
+        fetched = profiles.prefetch(["1000", "1001", "1002", "1001"])
+        self.assertEqual(fetched, 2)
+        self.assertEqual(len(FakeProfileRequests.calls), 2)
+        self.assertEqual(profiles.get("1002")["first_name"], "User 1002")
+        self.assertEqual(len(FakeProfileRequests.calls), 2)
+
+
+class TestStoreSweep(unittest.TestCase):
+    def setUp(self):
+        logger.info("\n\n>>>>TEST CASE: {}".format(self.id()))
+        self.tempdir = tempfile.mkdtemp()
+        self.time = stores.time.time
+        self.now = self.time()
+        stores.time.time = lambda: self.now
+
+    def tearDown(self):
+        stores.time.time = self.time
+        shutil.rmtree(self.tempdir)
+
+    def test(self):
+        """
+        Tests that sweeping the memory and sqlite stores removes only the
+        expired values, including values rewritten with a later expiry,
+        and that the dynamodb store leaves expiry to the table's TTL.
+        """
+        for store in (stores.MemoryStore(), stores.SqliteStore(os.path.join(self.tempdir, "store.db"))):
+            store.put("forever", 1)
+            store.put("soon", 2, 30)
+            store.put("later", 3, 600)
+            store.put("rewritten", 4, 30)
+            store.put("rewritten", 5, 600)
+            self.now += 120
+            self.assertEqual(store.sweep(), 1)
+            self.assertEqual(store.get_versioned("soon"), (None, None))
+            self.assertEqual(store.get("rewritten"), 5)
+            self.now += 600
+            self.assertEqual(store.sweep(), 2)
+            self.assertEqual(store.get("forever"), 1)
+        client = FakeDynamoClient()
+        store = stores.DynamoStore("sessions", client=client)
+        self.assertTrue(store.native_ttl)
+        store.enable_native_ttl()
+        self.assertEqual(client.ttl, {"Enabled": True, "AttributeName": "expires"})
+
+
+class TestSessionsBase(unittest.TestCase):
+    def setUp(self):
+        logger.info("\n\n>>>>TEST CASE: {}".format(self.id()))
+        self.tempdir = tempfile.mkdtemp()
+        self.store = self.make_store()
+        sessions.set_store(self.store)
+        metrics.reset("sessions.")
+
+    def tearDown(self):
+        sessions.set_store(None)
+        shutil.rmtree(self.tempdir)
+
+    def check_sessions(self):
+        """
+        Runs each session operation against the store under test.
+        """
+        self.assertEqual(sessions.get("1000"), {})
+        sessions.put("1000", {"state": "start", "turns": 1})
+        self.assertEqual(sessions.get("1000"), {"state": "start", "turns": 1})
+        session = sessions.update("1000", lambda session: session.update(turns=session["turns"] + 1))
+        self.assertEqual(session["turns"], 2)
+        sessions.update("1000", lambda session: {"state": "done"})
+        self.assertEqual(sessions.get("1000"), {"state": "done"})
+        sessions.delete("1000")
+        self.assertEqual(sessions.get("1000"), {})
+        timings = metrics.snapshot("sessions.{}.".format(self.store.kind))["timings"]
+        self.assertEqual(timings["sessions.{}.get".format(self.store.kind)]["count"], 6)
+        self.assertEqual(timings["sessions.{}.put".format(self.store.kind)]["count"], 1)
+        self.assertEqual(timings["sessions.{}.put_if".format(self.store.kind)]["count"], 2)
+
+
+class TestSessionsMemory(TestSessionsBase):
+    def make_store(self):
+        return stores.MemoryStore(codec=sessions.codec)
+
+    def test(self):
+        self.check_sessions()
+
+
+class TestSessionsSqlite(TestSessionsBase):
+    def make_store(self):
+        return stores.SqliteStore(os.path.join(self.tempdir, "sessions.db"), table="sessions", codec=sessions.codec)
+
+    def test(self):
+        self.check_sessions()
+
+
+class TestSessionsDynamo(TestSessionsBase):
+    def make_store(self):
+        return stores.DynamoStore("sessions", client=FakeDynamoClient(), codec=sessions.codec)
+
+    def test(self):
+        self.check_sessions()
+
+
+class TestStandardPlatform(unittest.TestCase):
+    def setUp(self):
+        logger.info("\n\n>>>>TEST CASE: {}".format(self.id()))
+
+    def test(self):
+        """
+        Tests that installed packages that use the standard library platform
+        module still work after our platform package has been imported, by
+        creating a real boto3 client for a DynamoStore, if boto3 is installed.
+        """
+        import platform
+        self.assertEqual(platform.python_version().split(".")[0], str(sys.version_info[0]))
+        self.assertTrue(platform.system())
+        try:
+            import boto3
+        except ImportError:
+            raise unittest.SkipTest("boto3 is not installed")
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        store = stores.DynamoStore("sessions", endpoint_url="http://localhost:8000")
+        self.assertEqual(store._client.meta.service_model.service_name, "dynamodb")
+
+
+class TestSessionSerialization(TestSessionsBase):
+    def make_store(self):
+        return stores.SqliteStore(os.path.join(self.tempdir, "sessions.db"), table="sessions", codec=sessions.codec)
+
+    def setUp(self):
+        TestSessionsBase.setUp(self)
+        self.use_msgpack = serialization.use_msgpack
+        self.version = sessions.codec.version
+
+    def tearDown(self):
+        serialization.use_msgpack = self.use_msgpack
+        sessions.codec.version = self.version
+        sessions._upgrades.clear()
+        TestSessionsBase.tearDown(self)
+
+    def test(self):
+        """
+        Tests that sessions round trip with and without msgpack and with
+        compression, that records written as json text are still read, and
+        that older records are upgraded as they are read.
+        """
+        small = {"state": "start", "turns": 1, "name": u"Jos\u00e9"}
+        large = {"state": "start", "history": ["what's the weather like"] * 100}
+        for use_msgpack in (serialization.msgpack is not None, False):
+            serialization.use_msgpack = use_msgpack
+            for session in (small, large):
+                data = sessions.codec.encode(session)
+                self.assertEqual(sessions.codec.decode(data), session)
+                self.assertLess(len(data), len(json.dumps(session)))
+            self.assertTrue(ord(sessions.codec.encode(large)[1:2]) & 0x01)
+        serialization.use_msgpack = self.use_msgpack
+        json_store = stores.SqliteStore(self.store.path, table="sessions")
+        json_store.put("1000", {"turns": 3})
+        sessions.put("1001", {"turns": 4})
+        sessions.register_upgrade(0, lambda session: {"turns": session["turns"], "state": "start"})
+        self.assertEqual(sessions.get("1000"), {"turns": 3, "state": "start"})
+        self.assertEqual(sessions.get("1001"), {"turns": 4, "state": "start"})
+        sessions.put("1001", {"turns": 5})
+        self.assertEqual(ord(self.store._db.execute("SELECT value FROM sessions WHERE key = '1001'").fetchone()[0][2:3]), 1)
+
+
+class TestSessionUnitOfWork(TestSessionsBase):
+    def make_store(self):
+        self.client = FakeDynamoClient()
+        return stores.DynamoStore("sessions", client=self.client, codec=sessions.codec)
+
+    def test(self):
+        """
+        Tests that inside a unit of work each session is read once, changes
+        made in place are written back in one batch at the end, unchanged
+        and deleted sessions are handled, and nothing is written if the
+        block raises.
+        """
+        sessions.put("1000", {"turns": 0})
+        sessions.put("1001", {"turns": 0})
+        sessions.put("1002", {"turns": 0})
+        self.client.calls = 0
+        with sessions.unit_of_work():
+            for n in range(5):
+                sessions.get("1000")["turns"] += 1
+                sessions.update("1000", lambda session: session.update(turns=session["turns"] + 1))
+                sessions.get("1001")
+                sessions.get("1003")
+            sessions.delete("1002")
+            self.assertEqual(sessions.get("1002"), {})
+            self.assertEqual(self.client.calls, 3)
+        # one conditional put and one batch of deletes
+        self.assertEqual(self.client.calls, 5)
+        self.assertEqual(sessions.get("1000"), {"turns": 10})
+        self.assertEqual(sessions.get("1002"), {})
+        self.assertNotIn("1003", self.client.tables["sessions"])
+        try:
+            with sessions.unit_of_work():
+                sessions.put("1001", {"turns": 1})
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(sessions.get("1001"), {"turns": 0})
+
+
+class TestSessionConflicts(TestSessionsBase):
+    def make_store(self):
+        return stores.DynamoStore("sessions", client=FakeDynamoClient(), codec=sessions.codec)
+
+    def test(self):
+        """
+        Tests that an update that loses a race with another writer is
+        retried on the new session, inside and outside a unit of work, and
+        that an in-place change or put() that can't be replayed fails with a
+        409 and leaves the other write in place.
+        """
+        sessions.put("1000", {"turns": 0})
+
+        def concurrent(session):
+            if not session.get("other"):
+                self.store.put("1000", {"turns": session["turns"], "other": True})
+            session["turns"] += 1
+        self.assertEqual(sessions.update("1000", concurrent), {"turns": 1, "other": True})
+        self.assertEqual(metrics.counter("sessions.conflicts"), 1)
+
+        with sessions.unit_of_work():
+            sessions.update("1000", lambda session: session.update(turns=session["turns"] + 1))
+            self.store.put("1000", {"turns": 5})
+        self.assertEqual(sessions.get("1000"), {"turns": 6})
+        self.assertEqual(metrics.counter("sessions.conflicts"), 2)
+
+        with self.assertRaises(Exception) as cm:
+            with sessions.unit_of_work():
+                sessions.get("1000")["turns"] = 0
+                self.store.put("1000", {"turns": 7})
+        self.assertTrue(str(cm.exception).startswith("409 Conflict"))
+        self.assertEqual(sessions.get("1000"), {"turns": 7})
+        self.assertEqual(metrics.counter("sessions.conflicts"), 3)
+
+        with self.assertRaises(Exception) as cm:
+            with sessions.unit_of_work():
+                sessions.put("1000", {"turns": 0})
+                sessions.put("1001", {"turns": 0})
+                self.store.put("1000", {"turns": 8})
+        self.assertTrue(str(cm.exception).startswith("409 Conflict"))
+        self.assertEqual(sessions.get("1000"), {"turns": 8})
+        self.assertEqual(sessions.get("1001"), {"turns": 0})
+        self.assertEqual(metrics.counter("sessions.conflicts"), 4)
+        self.assertEqual(metrics.counter("sessions.conditional_writes"), 7)
+
+
+class TestPrefs(unittest.TestCase):
+    def setUp(self):
+        logger.info("\n\n>>>>TEST CASE: {}".format(self.id()))
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        prefs.set_store(None)
+        shutil.rmtree(self.tempdir)
+
+    def test(self):
+        """
+        Tests partial updates and single field reads against each backend,
+        and that reads after the first are served from the cache.
+        """
+        client = FakeDynamoClient()
+        for store in (stores.MemoryStore(), stores.SqliteStore(os.path.join(self.tempdir, "prefs.db"), table="prefs"),
+                stores.SqliteFieldStore(os.path.join(self.tempdir, "prefs.db")), stores.DynamoStore("prefs", client=client)):
+            prefs.set_store(store)
+            self.assertEqual(prefs.get("1000", "units", "metric"), "metric")
+            prefs.set("1000", "units", "imperial")
+            prefs.update("1000", {"language": "en", "alerts": True})
+            self.assertEqual(prefs.unset("1000", "alerts"), {"units": "imperial", "language": "en"})
+            prefs.set_store(store)
+            before = prefs.cache_stats()
+            self.assertEqual(prefs.get("1000", "units"), "imperial")
+            self.assertEqual(prefs.get("1000", "language"), "en")
+            self.assertIsNone(prefs.get("1000", "alerts"))
+            self.assertEqual(prefs.cache_stats()["hits"] - before["hits"], 2)
+            prefs.delete("1000")
+            self.assertEqual(prefs.get_all("1000"), {})
+        client.calls = 0
+        prefs.set("1001", "units", "metric")
+        self.assertEqual(client.calls, 1)
+
+
+class TestSqliteFieldStore(unittest.TestCase):
+    def setUp(self):
+        logger.info("\n\n>>>>TEST CASE: {}".format(self.id()))
+        self.tempdir = tempfile.mkdtemp()
+        self.store = stores.SqliteFieldStore(os.path.join(self.tempdir, "fields.db"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def rows(self, key):
+        return self.store._db.execute("SELECT field FROM fields WHERE key = ? ORDER BY field", (key,)).fetchall()
+
+    def test(self):
+        """
+        Tests that the field store keeps a row per field, that updates only
+        write the named fields, that other fields are left untouched, and
+        that expired fields aren't read, and that it can't be used to store
+        sessions, which need versioned writes.
+        """
+        self.store.put("1000", {"units": "metric", "language": "en"})
+        self.assertEqual(self.rows("1000"), [(u"language",), (u"units",)])
+        self.store._db.execute("UPDATE fields SET value = ? WHERE key = ? AND field = ?", ('"fr"', "1000", "language"))
+        self.assertEqual(self.store.update_fields("1000", {"units": "imperial"}), {"units": "imperial", "language": "fr"})
+        self.assertEqual(self.store.update_fields("1000", {}, ["language"]), {"units": "imperial"})
+        self.assertEqual(self.store.get_field("1000", "units"), "imperial")
+        self.assertEqual(self.store.get_field("1000", "language", "en"), "en")
+        self.store.update_fields("1000", {"alerts": True}, ttl=-1)
+        self.assertEqual(self.store.get("1000"), {"units": "imperial"})
+        self.assertEqual(self.store.sweep(), 1)
+        self.store.delete("1000")
+        self.assertIsNone(self.store.get("1000"))
+        self.assertEqual(self.rows("1000"), [])
+        with self.assertRaises(Exception) as cm:
+            sessions.set_store(self.store)
+        self.assertIn("doesn't support versioned writes", str(cm.exception))
+
+
 class TestValidationBase(unittest.TestCase):
     def assertRaisesWithMsg(self, exc_type, test_func, content, *args, **kwargs):
         """
@@ -978,5 +1650,192 @@ class TestValidationGenericMessageEmptyElementTitle(TestValidationBase):
             self.test_msg)
 
 
+class TestValidationMatchesReference(TestValidationBase):
+    def setUp(self):
+        logger.info("\n\n>>>>TEST CASE: {}".format(self.id()))
+        buttons = [
+            messages.make_url_button("This is a test title", "http://some.where/but_not_here"),
+            messages.make_postback_button("This is a test title", "This is a test payload")
+        ]
+        generic = messages.make_message("1789953497899630", "generic_message")
+        messages.add_message_element(generic, "This is a test title", "This is a test subtitle",
+            "http://some.where/but_not_here.png", "http://some.where/but_not_here", buttons)
+        self.test_msgs = [
+            messages.make_message("1789953497899630", "button_message", {"prompt_text": "Here lies a button"}, buttons),
+            generic,
+            messages.make_message("1789953497899630", "image_message", {"image_url": "http://some.where/but_not_here.png"}),
+            messages.make_message("1789953497899630", "text_message", {"message_text": "This is a basic test message."})
+        ]
+
+    def mutations(self, value):
+        """
+        Yields copies of value with each nested property in turn deleted,
+        emptied or replaced by an unexpected value.
+        """
+        if isinstance(value, dict):
+            items = value.items()
+        elif isinstance(value, list):
+            items = list(enumerate(value))
+        else:
+            return
+        for (k, v) in items:
+            for replacement in [None, "", "other", [], {}]:
+                mutated = json.loads(json.dumps(value))
+                mutated[k] = replacement
+                yield mutated
+            if isinstance(value, dict):
+                mutated = json.loads(json.dumps(value))
+                del mutated[k]
+                yield mutated
+            for inner in self.mutations(v):
+                mutated = json.loads(json.dumps(value))
+                mutated[k] = inner
+                yield mutated
+
+    def outcome(self, validate, message):
+        try:
+            validate(message)
+        except Exception as e:
+            return str(e)
+
+    def test(self):
+        """
+        Tests that the compiled validator reports the same result as the
+        reference validator for every single-property mutation of the
+        test messages. Where the reference fails with something other than
+        a validation error (wrong types) the compiled validator only has to
+        reject the message.
+        """
+        count = 0
+        for message in self.test_msgs:
+            for mutated in self.mutations(message):
+                expected = self.outcome(reference_message_validation.validate_message, mutated)
+                actual = self.outcome(validation.validate_message, mutated)
+                if expected is None or expected.startswith("Invalid message"):
+                    self.assertEqual(actual, expected)
+                else:
+                    self.assertNotEqual(actual, None)
+                count += 1
+        self.assertTrue(count > 100)
+
+
+class TestValidationModes(TestValidationBase):
+    def setUp(self):
+        logger.info("\n\n>>>>TEST CASE: {}".format(self.id()))
+        metrics.reset("validation.outbound")
+        # deeply invalid, but structurally sound
+        self.test_msg = messages.make_message("1789953497899630", "button_message", {"prompt_text": "Menu"})
+        self.test_msg["message"]["attachment"]["payload"]["template_type"] = "carousel"
+
+    def tearDown(self):
+        validation.set_validation_mode("strict")
+
+    def test(self):
+        """
+        Tests that sampled mode only applies the structural check to
+        unsampled messages, that trusted mode skips rendered messages but
+        not plain dicts, and that each mode counts its checks and violations.
+        """
+        validation.set_validation_mode("sampled", 0)
+        validation.check_message(self.test_msg)
+        self.assertRaisesWithMsg(Exception, validation.check_message, "missing property: $.message", {"recipient": {"id": "1"}})
+
+        validation.set_validation_mode("trusted")
+        validation.check_message(self.test_msg)
+        self.assertRaisesWithMsg(Exception, validation.check_message, "template_type", dict(self.test_msg))
+
+        validation.set_validation_mode("strict")
+        self.assertRaisesWithMsg(Exception, validation.check_message, "template_type", self.test_msg)
+
+        counters = metrics.snapshot("validation.outbound")["counters"]
+        self.assertEqual(counters["validation.outbound.sampled.structural"], 2)
+        self.assertEqual(counters["validation.outbound.sampled.violations"], 1)
+        self.assertEqual(counters["validation.outbound.trusted.skipped"], 1)
+        self.assertEqual(counters["validation.outbound.trusted.violations"], 1)
+        self.assertEqual(counters["validation.outbound.strict.violations"], 1)
+
+
+class TestValidationWarningStats(TestValidationBase):
+    def setUp(self):
+        logger.info("\n\n>>>>TEST CASE: {}".format(self.id()))
+        validation.reset_warning_stats()
+        self.test_msg = messages.make_message("1789953497899630", "generic_message")
+        for n in range(12):
+            messages.add_message_element(self.test_msg, "A title that is longer than forty-five characters")
+
+    def test(self):
+        """
+        Tests that length warnings are counted per template and property
+        instead of being logged, and are reported by warning_stats().
+        """
+        validation.validate_message(self.test_msg)
+        validation.validate_message(self.test_msg)
+        stats = dict((s["property"], s) for s in validation.warning_stats())
+        title = stats["$.message.attachment.payload.elements[].title"]
+        self.assertEqual(title["template"], "generic")
+        self.assertEqual(title["count"], 24)
+        self.assertEqual(title["max"], 49)
+        self.assertEqual(title["limit"], 45)
+        self.assertEqual(stats["$.message.attachment.payload.elements"]["count"], 2)
+        validation.log_warning_summary()
+        validation.reset_warning_stats()
+        self.assertEqual(validation.warning_stats(), [])
+
+
+
+class FakeClock(object):
+    """
+    Stands in for the time module in platform.validation.
+    """
+    now = 1000.0
+
+    @staticmethod
+    def time():
+        return FakeClock.now
+
+
+class FakeLogger(object):
+    def __init__(self):
+        self.warnings = []
+
+    def warn(self, message):
+        self.warnings.append(message)
+
+
+class TestValidationWarningSummary(TestValidationWarningStats):
+    def setUp(self):
+        TestValidationWarningStats.setUp(self)
+        self.time = validation.time
+        self.logger = validation.logger
+        validation.time = FakeClock
+        validation.logger = FakeLogger()
+        FakeClock.now = 1000.0
+        validation.log_warning_summary()
+
+    def tearDown(self):
+        validation.time = self.time
+        validation.logger = self.logger
+        validation.reset_warning_stats()
+
+    def test(self):
+        """
+        Tests that pending length warnings are logged once the summary
+        interval has passed, at the end of a callback, even if no more
+        warnings arrive.
+        """
+        # the summary is due after callbacks that fail validation too
+        FakeClock.now += 10
+        validation.validate_message(self.test_msg)
+        self.assertRaises(Exception, handlers.dispatch, "POST", {}, {"object": "page", "entry": []})
+        self.assertEqual(validation.logger.warnings, [])
+        FakeClock.now += validation._warning_interval
+        self.assertRaises(Exception, handlers.dispatch, "POST", {}, {"object": "page", "entry": []})
+        self.assertEqual(len(validation.logger.warnings), 1)
+        self.assertTrue(validation.logger.warnings[0].startswith("13 message length warnings in the last 70s"))
+        FakeClock.now += validation._warning_interval
+        validation.log_warning_summary_if_due()
+        self.assertEqual(len(validation.logger.warnings), 1)
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file